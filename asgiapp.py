@@ -0,0 +1,34 @@
+# PAIKEA_DOTENV=.env uvicorn asgiapp:app --host 127.0.0.1 --port 8889
+import os
+from dotenv import load_dotenv
+load_dotenv(os.environ['PAIKEA_DOTENV'])
+
+import logging
+from logging.handlers import TimedRotatingFileHandler
+from paikea.ingest_asgi import create_ingest_app
+from paikea.settings import Config, ProdConfig
+
+
+def create_app():
+    if os.environ['PAIKEA_ENV'] == 'PROD':
+        config = ProdConfig
+    else:
+        config = Config
+
+    handler = TimedRotatingFileHandler(filename=Config.LOG_FILE,
+                                       when="W6", interval=1,
+                                       backupCount=52, encoding=None,
+                                       delay=False, utc=True, atTime=None)
+    handler.setLevel(Config.LOG_LEVEL)
+    handler.setFormatter(logging.Formatter(Config.LOG_FORMAT))
+
+    logger = logging.getLogger('paikea.ingest_asgi')
+    logger.addHandler(handler)
+    logger.setLevel(Config.LOG_LEVEL)
+
+    app = create_ingest_app(config)
+    logger.info("Ingest app initialized")
+    return app
+
+
+app = create_app()
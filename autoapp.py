@@ -14,6 +14,7 @@ from flask import (
     g
 )
 import paikea.views as views
+from paikea.commands import commands
 from paikea.extensions import db, migrate, ma
 from paikea.settings import Config, ProdConfig
 
@@ -79,6 +80,9 @@ def create_app():
     for bp in views.blueprints:
         app.register_blueprint(bp)
 
+    for command in commands:
+        app.cli.add_command(command)
+
     db.init_app(app)
     migrate.init_app(app, db, render_as_batch=True)
     ma.init_app(app)
@@ -1,6 +1,47 @@
+from kombu import Queue
+
 broker_url = 'pyamqp://'
 result_backend = 'rpc://'
 task_serializer = 'json'
 accept_content = ['json']
 timezone = 'Etc/UTC'
 enable_utc = True
+
+# priority lanes: commands a person is waiting on are never queued behind a
+# burst of telemetry, see paikea.tasks.queue_in_lane.  Run a worker for the
+# commands lane on its own, e.g. celery worker -Q commands
+task_queues = (
+    Queue('commands', routing_key='commands'),
+    Queue('telemetry', routing_key='telemetry'),
+    Queue('delivery', routing_key='delivery'),
+    Queue('firmware', routing_key='firmware'),
+    # the default queue before the lanes, consumed for one release so tasks
+    # queued before the upgrade still run.  Not declared, as it exists
+    # without x-max-priority.  Remove in the next release.
+    Queue('celery', routing_key='celery', no_declare=True),
+)
+task_default_queue = 'telemetry'
+task_queue_max_priority = 10
+task_default_priority = 5
+task_routes = {
+    'paikea.tasks.send_beacon': {'queue': 'commands'},
+    'paikea.tasks.update_beacon_interval': {'queue': 'commands'},
+    'paikea.tasks.on_new_rockcore': {'queue': 'commands'},
+    'paikea.tasks.send_to_endpoints': {'queue': 'delivery'},
+    'paikea.tasks.dispatch_outbox': {'queue': 'delivery'},
+    'paikea.tasks.prepare_update_directory': {'queue': 'firmware'},
+    'paikea.tasks.clear_upgrade_directory': {'queue': 'firmware'},
+}
+
+# picks up 'new' messages in bulk, see paikea.tasks.process_new_rbms
+beat_schedule = {
+    'process-new-rbms': {
+        'task': 'paikea.tasks.process_new_rbms',
+        'schedule': 10.0,
+    },
+    # sends due deliveries with OUTBOX_ENABLED, see paikea.outbox
+    'dispatch-outbox': {
+        'task': 'paikea.tasks.dispatch_outbox',
+        'schedule': 5.0,
+    },
+}
@@ -0,0 +1,41 @@
+"""unique rock_block_message imei, momsn
+
+Revision ID: 3f1c2a9d8e01
+Revises: 
+Create Date: 2026-10-18 09:12:40.118263
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3f1c2a9d8e01'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # duplicate pushes stored before this revision would violate the
+    # constraint; they must be resolved by hand as PK001/PK004 and status
+    # rows refer to them
+    conn = op.get_bind()
+    dups = conn.execute(sa.text(
+        "SELECT imei, momsn, COUNT(*) FROM rock_block_message "
+        "WHERE momsn IS NOT NULL GROUP BY imei, momsn HAVING COUNT(*) > 1"
+    )).fetchall()
+    if dups:
+        raise RuntimeError(
+            f"{len(dups)} duplicated (imei, momsn) in rock_block_message, "
+            f"e.g. {tuple(dups[0][:2])}.  Remove duplicates and retry.")
+
+    with op.batch_alter_table('rock_block_message', schema=None) as batch_op:
+        batch_op.create_unique_constraint(
+            'uq_rock_block_message_imei_momsn', ['imei', 'momsn'])
+
+
+def downgrade():
+    with op.batch_alter_table('rock_block_message', schema=None) as batch_op:
+        batch_op.drop_constraint(
+            'uq_rock_block_message_imei_momsn', type_='unique')
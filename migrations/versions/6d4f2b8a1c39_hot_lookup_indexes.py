@@ -0,0 +1,64 @@
+"""hot lookup indexes
+
+Revision ID: 6d4f2b8a1c39
+Revises: a7c3e9f1d258
+Create Date: 2026-10-18 17:21:40.118302
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '6d4f2b8a1c39'
+down_revision = 'a7c3e9f1d258'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(op.f('ix_rock_block_modem_imei'), 'rock_block_modem',
+                    ['imei'], unique=False)
+    op.create_index(op.f('ix_rb_message_status_rbm_id'), 'rb_message_status',
+                    ['rbm_id'], unique=False)
+    op.create_index(op.f('ix_rb_message_status_claimed_by'),
+                    'rb_message_status', ['claimed_by'], unique=False)
+    op.create_index('ix_rb_message_status_status_id', 'rb_message_status',
+                    ['status', 'id'], unique=False)
+    op.create_index(op.f('ix_buoy_iam'), 'buoy', ['iam'], unique=False)
+    op.create_index(op.f('ix_buoy_rb_id'), 'buoy', ['rb_id'], unique=False)
+    op.create_index(op.f('ix_handset_iam'), 'handset', ['iam'], unique=False)
+    op.create_index(op.f('ix_handset_rb_id'), 'handset', ['rb_id'],
+                    unique=False)
+    op.create_index(op.f('ix_p_k001_rbm_id'), 'p_k001', ['rbm_id'],
+                    unique=False)
+    op.create_index(op.f('ix_p_k004_rbm_id'), 'p_k004', ['rbm_id'],
+                    unique=False)
+    op.create_index('ix_endpoint_route_source', 'endpoint_route',
+                    ['source_device', 'source_device_type', 'msg_type'],
+                    unique=False)
+    op.create_index('ix_endpoint_route_endpoint', 'endpoint_route',
+                    ['endpoint_id', 'endpoint_type'], unique=False)
+    op.create_index('ix_device_firmware_upgrade_device',
+                    'device_firmware_upgrade',
+                    ['device_type', 'device_id', 'status'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_device_firmware_upgrade_device',
+                  table_name='device_firmware_upgrade')
+    op.drop_index('ix_endpoint_route_endpoint', table_name='endpoint_route')
+    op.drop_index('ix_endpoint_route_source', table_name='endpoint_route')
+    op.drop_index(op.f('ix_p_k004_rbm_id'), table_name='p_k004')
+    op.drop_index(op.f('ix_p_k001_rbm_id'), table_name='p_k001')
+    op.drop_index(op.f('ix_handset_rb_id'), table_name='handset')
+    op.drop_index(op.f('ix_handset_iam'), table_name='handset')
+    op.drop_index(op.f('ix_buoy_rb_id'), table_name='buoy')
+    op.drop_index(op.f('ix_buoy_iam'), table_name='buoy')
+    op.drop_index('ix_rb_message_status_status_id',
+                  table_name='rb_message_status')
+    op.drop_index(op.f('ix_rb_message_status_claimed_by'),
+                  table_name='rb_message_status')
+    op.drop_index(op.f('ix_rb_message_status_rbm_id'),
+                  table_name='rb_message_status')
+    op.drop_index(op.f('ix_rock_block_modem_imei'),
+                  table_name='rock_block_modem')
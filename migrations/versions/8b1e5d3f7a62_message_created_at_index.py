@@ -0,0 +1,25 @@
+"""message created_at index
+
+Revision ID: 8b1e5d3f7a62
+Revises: 6d4f2b8a1c39
+Create Date: 2026-10-18 19:02:11.540817
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '8b1e5d3f7a62'
+down_revision = '6d4f2b8a1c39'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_rock_block_message_created_at', 'rock_block_message',
+                    ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_rock_block_message_created_at',
+                  table_name='rock_block_message')
@@ -0,0 +1,31 @@
+"""rock_block_message msg_type
+
+Revision ID: 8b2d4e6f0a13
+Revises: 3f1c2a9d8e01
+Create Date: 2026-10-18 12:40:05.531907
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8b2d4e6f0a13'
+down_revision = '3f1c2a9d8e01'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # existing rows are classified with `flask messages backfill-types`
+    with op.batch_alter_table('rock_block_message', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('msg_type', sa.String(length=8),
+                                      nullable=True))
+        batch_op.create_index(batch_op.f('ix_rock_block_message_msg_type'),
+                              ['msg_type'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('rock_block_message', schema=None) as batch_op:
+        batch_op.drop_index(batch_op.f('ix_rock_block_message_msg_type'))
+        batch_op.drop_column('msg_type')
@@ -0,0 +1,39 @@
+"""message_stage
+
+Revision ID: a7c3e9f1d258
+Revises: f2b6d8e0a145
+Create Date: 2026-10-18 16:04:12.671305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a7c3e9f1d258'
+down_revision = 'f2b6d8e0a145'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'message_stage',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('rbm_id', sa.Integer(), nullable=False),
+        sa.Column('stage', sa.String(length=16), nullable=False),
+        sa.Column('endpoint', sa.String(length=80), nullable=True),
+        sa.Column('at', sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint('id', name=op.f('pk_message_stage'))
+    )
+    op.create_index(op.f('ix_message_stage_rbm_id'), 'message_stage',
+                    ['rbm_id'], unique=False)
+    op.create_index('ix_message_stage_stage_at', 'message_stage',
+                    ['stage', 'at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_message_stage_stage_at', table_name='message_stage')
+    op.drop_index(op.f('ix_message_stage_rbm_id'),
+                  table_name='message_stage')
+    op.drop_table('message_stage')
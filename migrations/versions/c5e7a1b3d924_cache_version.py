@@ -0,0 +1,29 @@
+"""cache_version
+
+Revision ID: c5e7a1b3d924
+Revises: 8b2d4e6f0a13
+Create Date: 2026-10-18 13:21:44.207391
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5e7a1b3d924'
+down_revision = '8b2d4e6f0a13'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'cache_version',
+        sa.Column('name', sa.String(length=32), nullable=False),
+        sa.Column('version', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('name', name=op.f('pk_cache_version'))
+    )
+
+
+def downgrade():
+    op.drop_table('cache_version')
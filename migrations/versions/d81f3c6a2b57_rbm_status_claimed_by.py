@@ -0,0 +1,27 @@
+"""rb_message_status claimed_by
+
+Revision ID: d81f3c6a2b57
+Revises: c5e7a1b3d924
+Create Date: 2026-10-18 13:58:12.660814
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd81f3c6a2b57'
+down_revision = 'c5e7a1b3d924'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('rb_message_status', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('claimed_by', sa.String(length=64),
+                                      nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('rb_message_status', schema=None) as batch_op:
+        batch_op.drop_column('claimed_by')
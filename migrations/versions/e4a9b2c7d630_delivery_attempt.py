@@ -0,0 +1,53 @@
+"""delivery_attempt
+
+Revision ID: e4a9b2c7d630
+Revises: d81f3c6a2b57
+Create Date: 2026-10-18 14:36:05.118420
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4a9b2c7d630'
+down_revision = 'd81f3c6a2b57'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table(
+        'delivery_attempt',
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('logical_del', sa.Boolean(), nullable=True),
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('route_id', sa.Integer(), nullable=True),
+        sa.Column('endpoint_type', sa.String(length=64), nullable=False),
+        sa.Column('endpoint_id', sa.Integer(), nullable=False),
+        sa.Column('msg_type', sa.String(length=64), nullable=False),
+        sa.Column('msg_id', sa.Integer(), nullable=False),
+        sa.Column('idempotency_key', sa.String(length=128), nullable=False),
+        sa.Column('status', sa.String(length=16), nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('next_attempt_at', sa.DateTime(), nullable=True),
+        sa.Column('claimed_by', sa.String(length=64), nullable=True),
+        sa.Column('claimed_at', sa.DateTime(), nullable=True),
+        sa.Column('delivered_at', sa.DateTime(), nullable=True),
+        sa.Column('last_error', sa.String(length=512), nullable=True),
+        sa.ForeignKeyConstraint(
+            ['route_id'], ['endpoint_route.id'],
+            name=op.f('fk_delivery_attempt_route_id_endpoint_route')),
+        sa.PrimaryKeyConstraint('id', name=op.f('pk_delivery_attempt')),
+        sa.UniqueConstraint('idempotency_key',
+                            name=op.f('uq_delivery_attempt_idempotency_key'))
+    )
+    op.create_index('ix_delivery_attempt_status_next_attempt_at',
+                    'delivery_attempt', ['status', 'next_attempt_at'],
+                    unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_delivery_attempt_status_next_attempt_at',
+                  table_name='delivery_attempt')
+    op.drop_table('delivery_attempt')
@@ -0,0 +1,32 @@
+"""device_command_message coalesce_status and coalesced_into
+
+Revision ID: f2b6d8e0a145
+Revises: e4a9b2c7d630
+Create Date: 2026-10-18 15:22:41.530917
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2b6d8e0a145'
+down_revision = 'e4a9b2c7d630'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('device_command_message',
+                              schema=None) as batch_op:
+        batch_op.add_column(sa.Column('coalesce_status', sa.String(length=16),
+                                      nullable=True))
+        batch_op.add_column(sa.Column('coalesced_into', sa.Integer(),
+                                      nullable=True))
+
+
+def downgrade():
+    with op.batch_alter_table('device_command_message',
+                              schema=None) as batch_op:
+        batch_op.drop_column('coalesced_into')
+        batch_op.drop_column('coalesce_status')
@@ -0,0 +1,308 @@
+"""
+Per process caches of rarely changing tables.
+
+Celery workers look up the same few hundred modems for every message.  A
+VersionedCache holds them in a bounded LRU, and is dropped when the
+CacheVersion row for its name changes.  Anything changing the cached rows
+calls invalidate on the cache before committing, which increments the
+version in the same transaction.  Each process checks the version at most
+every CACHE_CHECK_SECONDS, so a steady state lookup makes no query.
+
+The routing table is compiled and held the same way, see RouteTable.
+"""
+import time
+import threading
+from collections import OrderedDict, defaultdict, namedtuple
+from flask import current_app as app
+from paikea.extensions import db
+import paikea.models as md
+
+
+class LRUCache:
+    ''' A bounded mapping which discards the least recently used key.
+
+    :param int maxsize: maximum number of keys
+    '''
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                self._data.move_to_end(key)
+            except KeyError:
+                return default
+            return self._data[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+def cache_version(name):
+    ''' Current version of the named cache, 0 if it was never changed '''
+    version = db.session.query(md.CacheVersion.version).\
+        filter_by(name=name).scalar()
+    return version or 0
+
+
+def bump_cache_version(name):
+    ''' Increment the version of the named cache.  Not committed, so the
+    change is published with the caller's transaction.
+    '''
+    updated = db.session.query(md.CacheVersion).filter_by(name=name).\
+        update({'version': md.CacheVersion.version + 1},
+               synchronize_session=False)
+    if not updated:
+        db.session.add(md.CacheVersion(name=name, version=1))
+
+
+class VersionedCache(LRUCache):
+    ''' LRUCache dropped whenever its CacheVersion changes.
+
+    :param str name: CacheVersion name
+    :param int maxsize: maximum number of keys
+    :param float check_seconds: seconds between checks of the version
+    '''
+
+    def __init__(self, name, maxsize=1024, check_seconds=5):
+        super().__init__(maxsize)
+        self.name = name
+        self.check_seconds = check_seconds
+        self.version = None
+        self._checked_at = 0
+
+    def revalidate(self):
+        ''' Drop the cache if its version changed since the last check '''
+        now = time.monotonic()
+        if now - self._checked_at < self.check_seconds:
+            return
+        version = cache_version(self.name)
+        if version != self.version:
+            self.clear()
+            self.version = version
+        self._checked_at = now
+
+    def get(self, key, default=None):
+        self.revalidate()
+        return super().get(key, default)
+
+    def put(self, key, value):
+        self.revalidate()
+        super().put(key, value)
+
+    def invalidate(self):
+        ''' Drop this process's cache and bump the version for the others,
+        on the caller's commit.
+        '''
+        self.clear()
+        self._checked_at = 0
+        bump_cache_version(self.name)
+
+
+#: Cached modem details: RockBlockModem id and device_type, and the id of the
+#: linked Buoy or Handset
+ModemInfo = namedtuple('ModemInfo', ['id', 'device_type', 'device_id'])
+
+LINKED_DEVICES = {
+    'buoy': md.Buoy,
+    'handset': md.Handset,
+}
+
+
+def get_modem_cache():
+    ''' The imei to ModemInfo cache for this app, created on first use '''
+    cache = app.extensions.get('paikea_modem_cache')
+    if cache is None:
+        cache = VersionedCache('modems', app.config['MODEM_CACHE_SIZE'],
+                               app.config['CACHE_CHECK_SECONDS'])
+        app.extensions['paikea_modem_cache'] = cache
+    return cache
+
+
+def lookup_modem(imei):
+    ''' ModemInfo for the modem with an imei, from the cache if possible.
+
+    :param str imei: modem imei
+    :return: the modem, None if there is none
+    :rtype: ModemInfo
+    :raises ValueError: if more than one modem has the imei
+    '''
+    cache = get_modem_cache()
+    info = cache.get(imei)
+    if info is not None:
+        return info
+
+    modems = db.session.query(md.RockBlockModem).filter_by(imei=imei).all()
+    if not modems:
+        return None
+    if len(modems) > 1:
+        raise ValueError(f"Multiple RockBlockModems with imei: {imei}")
+
+    modem = modems[0]
+    device_id = modem.device_id
+    if device_id is None and modem.device_type in LINKED_DEVICES:
+        device_id = db.session.query(LINKED_DEVICES[modem.device_type].id).\
+            filter_by(rb_id=modem.id).limit(1).scalar()
+
+    info = ModemInfo(modem.id, modem.device_type, device_id)
+    cache.put(imei, info)
+    return info
+
+
+def invalidate_modems():
+    ''' Call before committing a change to a RockBlockModem or its link to a
+    device, so every process reloads its modems.
+    '''
+    get_modem_cache().invalidate()
+
+
+class CompiledRoute(namedtuple('CompiledRoute', [
+        'id', 'source_device_type', 'source_device', 'msg_type',
+        'endpoint_type', 'endpoint_id', 'endpoint'])):
+    ''' An enabled EndpointRoute with its endpoint loaded, standing in for
+    the route when delivering a message
+    '''
+
+    def get_endpoint(self):
+        return self.endpoint
+
+
+def detached_copy(row):
+    ''' A copy of a row outside of any session, with its columns loaded, so
+    it can be shared by the threads of a process
+    '''
+    model = type(row)
+    return model(**{column.key: getattr(row, column.key)
+                    for column in model.__table__.columns})
+
+
+def compile_routes():
+    ''' Load the enabled routes, and their endpoints with one query per
+    endpoint table.  Routes whose endpoint is missing are left out.
+
+    :return: ({(source device type, source device id, msg type): routes},
+        {(endpoint type, endpoint id): endpoint})
+    :rtype: tuple
+    '''
+    routes = db.session.query(md.EndpointRoute).filter_by(enabled=True).\
+        order_by(md.EndpointRoute.id).all()
+
+    wanted = defaultdict(set)
+    for route in routes:
+        wanted[md.EndpointRoute.endpoint_types[route.endpoint_type]].add(
+            route.endpoint_id)
+    rows = {}
+    for model, ids in wanted.items():
+        rows[model] = {row.id: detached_copy(row) for row in
+                       db.session.query(model).filter(model.id.in_(ids))}
+
+    table = defaultdict(list)
+    endpoints = {}
+    for route in routes:
+        model = md.EndpointRoute.endpoint_types[route.endpoint_type]
+        endpoint = rows[model].get(route.endpoint_id)
+        if endpoint is None:
+            app.logger.warning(f"Route {route.id}: no {route.endpoint_type} "
+                               f"endpoint {route.endpoint_id}")
+            continue
+        endpoints[(route.endpoint_type, route.endpoint_id)] = endpoint
+        table[(route.source_device_type, route.source_device,
+               route.msg_type)].append(CompiledRoute(
+                   route.id, route.source_device_type, route.source_device,
+                   route.msg_type, route.endpoint_type, route.endpoint_id,
+                   endpoint))
+    return dict(table), endpoints
+
+
+class RouteTable:
+    ''' The enabled routes of this process compiled into a map from
+    (source device type, source device id, msg type) to CompiledRoutes, so
+    routing a message makes no query.
+
+    The table is rebuilt when the 'routes' CacheVersion changes, or the
+    'modems' one, as modems are endpoints too.  As for VersionedCache, the
+    versions are checked at most every check_seconds.
+
+    :param float check_seconds: seconds between checks of the versions
+    '''
+    names = ('routes', 'modems')
+
+    def __init__(self, check_seconds=5):
+        self.check_seconds = check_seconds
+        self.version = None
+        self._routes = None
+        self._endpoints = {}
+        self._checked_at = 0
+        self._lock = threading.Lock()
+
+    def versions(self):
+        found = dict(db.session.query(md.CacheVersion.name,
+                                      md.CacheVersion.version).
+                     filter(md.CacheVersion.name.in_(self.names)))
+        return tuple(found.get(name, 0) for name in self.names)
+
+    def revalidate(self):
+        ''' Rebuild the table if a version changed since the last check '''
+        now = time.monotonic()
+        if self._routes is not None and \
+                now - self._checked_at < self.check_seconds:
+            return
+        with self._lock:
+            version = self.versions()
+            if self._routes is None or version != self.version:
+                self._routes, self._endpoints = compile_routes()
+                self.version = version
+            self._checked_at = now
+
+    def lookup(self, source_type, source, msg_type):
+        ''' Enabled routes of messages of a type from a source
+
+        :rtype: list
+        '''
+        self.revalidate()
+        return self._routes.get((source_type, source, msg_type), [])
+
+    def endpoint(self, endpoint_type, endpoint_id):
+        ''' The loaded endpoint of an enabled route, None if there is none '''
+        self.revalidate()
+        return self._endpoints.get((endpoint_type, endpoint_id))
+
+    def clear(self):
+        self._routes = None
+
+    def invalidate(self):
+        ''' Rebuild this process's table and bump the version for the
+        others, on the caller's commit.
+        '''
+        self.clear()
+        bump_cache_version('routes')
+
+
+def get_route_table():
+    ''' The RouteTable for this app, created on first use '''
+    table = app.extensions.get('paikea_route_table')
+    if table is None:
+        table = RouteTable(app.config['CACHE_CHECK_SECONDS'])
+        app.extensions['paikea_route_table'] = table
+    return table
+
+
+def invalidate_routes():
+    ''' Call before committing a change to an EndpointRoute or an endpoint,
+    so every process rebuilds its routes.
+    '''
+    get_route_table().invalidate()
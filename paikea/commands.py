@@ -0,0 +1,174 @@
+"""
+Flask CLI commands for running and maintaining the backend, registered on the
+app by create_app.
+"""
+import os
+import time
+import fcntl
+import click
+from flask import current_app as app
+from flask.cli import AppGroup
+from paikea.ingest import classify_stored_messages
+from paikea.reprocess import (
+    BUILDERS,
+    reprocess,
+)
+import paikea.spool as spool
+import paikea.outbox as outbox
+import paikea.triage as triage
+
+
+spool_cli = AppGroup('spool', help="Incoming message write-ahead spool")
+
+
+@spool_cli.command('drain')
+@click.option('--once', is_flag=True, help="Drain the spool and exit")
+@click.option('--batch-size', type=int, default=None,
+              help="Messages per database transaction")
+@click.option('--interval', type=float, default=None,
+              help="Seconds between polls of the spool")
+def drain_spool(once, batch_size, interval):
+    """ Commit spooled RockBlock pushes to the database and queue them for
+    processing.  Anything left unacknowledged by a previous run is replayed
+    first.  Only one drainer may run against a spool directory.
+    """
+    directory = spool.spool_dir()
+    batch_size = batch_size or app.config['SPOOL_DRAIN_BATCH']
+    interval = interval or app.config['SPOOL_DRAIN_INTERVAL']
+    os.makedirs(directory, exist_ok=True)
+
+    lock = open(os.path.join(directory, "drainer.lock"), 'w')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        raise click.ClickException(
+            f"Spool drainer already running: {directory}")
+
+    replayed = spool.drain(directory, batch_size)
+    app.logger.info(f"Spool drainer started, replayed {replayed} messages")
+
+    while not once:
+        time.sleep(interval)
+        try:
+            spool.drain(directory, batch_size)
+        except Exception:
+            app.logger.error("Spool drain failed", exc_info=True)
+
+
+messages_cli = AppGroup('messages', help="Stored RockBlock messages")
+
+
+@messages_cli.command('backfill-types')
+@click.option('--batch-size', type=int, default=1000,
+              help="Messages per database transaction")
+def backfill_types(batch_size):
+    """ Classify the packet type of stored messages which have no msg_type,
+    such as those received before it was set at ingest.
+    """
+    classified = classify_stored_messages(batch_size)
+    click.echo(f"Classified {classified} messages")
+
+
+@messages_cli.command('reprocess')
+@click.option('--since', type=click.DateTime(), default=None,
+              help="Only messages transmitted from this time, UTC")
+@click.option('--until', type=click.DateTime(), default=None,
+              help="Only messages transmitted before this time, UTC")
+@click.option('--imei', default=None, help="Only messages from this modem")
+@click.option('--msg-type', 'msg_types', multiple=True,
+              type=click.Choice(list(BUILDERS)),
+              help="Only messages of this packet type, repeatable")
+@click.option('--batch-size', type=int, default=1000,
+              help="Messages per database transaction")
+@click.option('--workers', type=int, default=None,
+              help="Parsing processes, the number of CPUs by default")
+@click.option('--dispatch', is_flag=True,
+              help="Send the records to their endpoints")
+@click.option('--rate', type=float, default=None,
+              help="Most records dispatched a second")
+@click.option('--checkpoint', type=click.Path(dir_okay=False),
+              default=None, help="Progress file, to resume an interrupted run")
+def reprocess_messages(since, until, imei, msg_types, batch_size, workers,
+                       dispatch, rate, checkpoint):
+    """ Reparse stored PK001 and PK004 messages in bulk, such as after a
+    parser fix, updating their records in place.  Runs without celery.
+    """
+    filters = {'since': since.isoformat() if since else None,
+               'until': until.isoformat() if until else None,
+               'imei': imei,
+               'msg_types': sorted(msg_types)}
+
+    def progress(state):
+        click.echo(f"Reprocessed up to {state['last_id']}: "
+                   f"{state['parsed']} messages")
+
+    try:
+        state = reprocess(filters, batch_size, workers, dispatch, rate,
+                          checkpoint, progress)
+    except ValueError as e:
+        raise click.ClickException(f"{e}")
+    click.echo(f"Parsed {state['parsed']} messages, upserted "
+               f"{state['upserted']} records, {state['errors']} errors, "
+               f"{state['skipped']} skipped, {state['failed_sends']} "
+               "failed sends")
+
+
+outbox_cli = AppGroup('outbox', help="Endpoint delivery outbox")
+
+
+@outbox_cli.command('retry-dead')
+def retry_dead():
+    """ Requeue every dead-lettered delivery for another round of attempts.
+    """
+    requeued = outbox.retry_dead()
+    click.echo(f"Requeued {requeued} deliveries")
+
+
+errors_cli = AppGroup('errors', help="Message parsing errors")
+
+
+@errors_cli.command('groups')
+@click.option('--status', default='new',
+              help="error_status of the errors counted, 'all' for every one")
+def error_groups(status):
+    """ Count parsing errors by source and error text.
+    """
+    for group in triage.error_groups(None if status == 'all' else status):
+        retry = "" if group['retryable'] else " (not retryable)"
+        click.echo(f"{group['count']:>8}  {group['msg_source']}: "
+                   f"{group['error']}{retry}")
+
+
+@errors_cli.command('retry')
+@click.option('--source', 'msg_source', default='Iridium',
+              help="Source of the errors")
+@click.option('--error', default=None,
+              help="Error text of the group, every error by default")
+@click.option('--batch-size', type=int, default=100,
+              help="Errors per batch")
+@click.option('--limit', type=int, default=None,
+              help="Most errors to retry")
+def retry_errors(msg_source, error, batch_size, limit):
+    """ Re-run the messages of a group of new parsing errors, such as after a
+    protocol fix, and report how many now succeed.
+    """
+    def progress(totals):
+        click.echo(f"Retried {totals['retried']}: "
+                   f"{totals['resolved']} resolved")
+
+    try:
+        totals = triage.retry_errors(msg_source, error, batch_size=batch_size,
+                                     limit=limit, progress=progress)
+    except ValueError as e:
+        raise click.ClickException(f"{e}")
+    click.echo(f"Retried {totals['retried']} errors: {totals['resolved']} "
+               f"resolved, {totals['superseded']} failed again, "
+               f"{totals['failed']} could not be run")
+
+
+commands = [
+    spool_cli,
+    messages_cli,
+    outbox_cli,
+    errors_cli,
+]
@@ -0,0 +1,142 @@
+"""
+Suppression of duplicate RockBlock pushes.
+
+The Iridium network retries a push until it is acknowledged, so the same
+message, identified by modem imei and momsn, can arrive more than once.  The
+unique constraint on RockBlockMessage (imei, momsn) guarantees a duplicate is
+never stored.  To keep the common case of a new message from costing a
+query, each process holds a Bloom filter of recently seen messages, seeded
+from the most recent rows.  Only a message the filter may have seen is
+checked against the database.
+"""
+import math
+import hashlib
+import threading
+from flask import current_app as app
+from paikea.extensions import db
+import paikea.models as md
+
+
+class BloomFilter:
+    ''' A fixed size Bloom filter over string keys.
+
+    :param int capacity: number of keys before the error rate is exceeded
+    :param float error_rate: false positive probability at capacity
+    '''
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.n_bits = max(8, int(-capacity * math.log(error_rate) /
+                                 math.log(2) ** 2))
+        self.n_hashes = max(1, round(self.n_bits / capacity * math.log(2)))
+        self.bits = bytearray((self.n_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.n_bits for i in range(self.n_hashes))
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(key))
+
+
+def message_key(imei, momsn):
+    ''' Key identifying a RockBlock push, or None if it has no momsn '''
+    if momsn is None or momsn == '':
+        return None
+    try:
+        momsn = int(momsn)
+    except (TypeError, ValueError):
+        return None
+    return (imei, momsn)
+
+
+class DuplicateFilter:
+    ''' Per process pre-filter for duplicate RockBlock pushes.
+
+    The Bloom filter is seeded on first use from the most recent messages and
+    rebuilt once it holds more keys than its capacity.  Messages stored by
+    other processes are not in the filter; for those the unique constraint
+    is the backstop.
+
+    :param int capacity: Bloom filter capacity
+    :param float error_rate: Bloom filter false positive rate at capacity
+    '''
+
+    def __init__(self, capacity=100000, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bloom = None
+        self.duplicates = 0
+        self._lock = threading.Lock()
+
+    def _seed(self):
+        self.bloom = BloomFilter(self.capacity, self.error_rate)
+        recent = db.session.query(
+            md.RockBlockMessage.imei,
+            md.RockBlockMessage.momsn).\
+            order_by(md.RockBlockMessage.id.desc()).\
+            limit(self.capacity // 2)
+        for imei, momsn in recent:
+            key = message_key(imei, momsn)
+            if key:
+                self.bloom.add(f"{key[0]}:{key[1]}")
+
+    def might_contain(self, key):
+        ''' False if the message is certainly not stored '''
+        with self._lock:
+            if self.bloom is None or self.bloom.count > self.capacity:
+                self._seed()
+            return f"{key[0]}:{key[1]}" in self.bloom
+
+    def add(self, key):
+        with self._lock:
+            if self.bloom is not None:
+                self.bloom.add(f"{key[0]}:{key[1]}")
+
+    def count_duplicate(self, key):
+        with self._lock:
+            self.duplicates += 1
+        app.logger.info(f"Duplicate RockBlock push suppressed: {key}")
+
+    def is_duplicate(self, key):
+        ''' Check a message against the filter, confirming possible
+        duplicates with the database.
+
+        :param tuple key: (imei, momsn) from message_key
+        :rtype: bool
+        '''
+        if key is None or not self.might_contain(key):
+            return False
+        return existing_keys([key]) == {key}
+
+
+def existing_keys(keys):
+    ''' The subset of (imei, momsn) keys already stored, in one query '''
+    keys = set(keys)
+    if not keys:
+        return set()
+    rows = db.session.query(
+        md.RockBlockMessage.imei,
+        md.RockBlockMessage.momsn).filter(
+            md.RockBlockMessage.imei.in_({k[0] for k in keys}),
+            md.RockBlockMessage.momsn.in_({k[1] for k in keys}))
+    return {(imei, momsn) for imei, momsn in rows} & keys
+
+
+def get_duplicate_filter():
+    ''' The DuplicateFilter for this app, created on first use '''
+    dedup = app.extensions.get('paikea_dedup')
+    if dedup is None:
+        dedup = DuplicateFilter(app.config['DEDUP_BLOOM_CAPACITY'],
+                                app.config['DEDUP_BLOOM_ERROR_RATE'])
+        app.extensions['paikea_dedup'] = dedup
+    return dedup
@@ -1,7 +1,10 @@
 """
 When messages are being sent from the server, they must be formatted for the
-specific endpoint.  The functions of this module look up messages by ID from
-the database and format the messages for each enpoint.
+specific endpoint.  The functions of this module format a message for each
+enpoint, given either a FormatContext holding the message already loaded by
+the caller, or its ID, in which case the message is looked up from the
+database.  A FormatContext is shared by the formatters of every endpoint of
+a message, so its source RockBlockMessage is loaded at most once.
 
 The FORMATTER_TABLE contains the actual mapping for the functions as a nested
 dict of [<message type>][<destination>] = formatter
@@ -23,27 +26,72 @@ def get_msg(model, m_id):
         raise e
 
 
-def PK001_to_SQS(pd_id):
-    """ Formats a PK001 message for an SQS destination"""
-    msg = get_msg(md.PK001, pd_id)
+class FormatContext:
+    ''' A message loaded for formatting, with the RockBlockMessage it was
+    parsed from if the caller has it.
 
-    if msg:
-        rbm = get_msg(md.RockBlockMessage, msg.rbm_id)
-        return json.dumps(rbm.to_dict())
+    :param record: PK001, PK004 or DeviceCommandMessage
+    :param RockBlockMessage rbm: source message of record, loaded on first use
+        if not given
+    '''
+
+    def __init__(self, record, rbm=None):
+        self.record = record
+        self._rbm = rbm
+        self._payload = None
+
+    @property
+    def msg_id(self):
+        return self.record.id
+
+    @property
+    def rbm(self):
+        if self._rbm is None:
+            self._rbm = get_msg(md.RockBlockMessage, self.record.rbm_id)
+        return self._rbm
+
+    @property
+    def payload(self):
+        ''' Decoded payload bytes of the source message '''
+        if self._payload is None:
+            self._payload = binascii.unhexlify(self.rbm.data)
+        return self._payload
+
+
+def format_context(model, msg):
+    ''' FormatContext of msg, loading it by ID from the table of model if
+    it is not one already
+    '''
+    if isinstance(msg, FormatContext):
+        return msg
+    return FormatContext(get_msg(model, msg))
+
+
+def message_id(msg):
+    ''' ID of a message given as a FormatContext or an ID '''
+    if isinstance(msg, FormatContext):
+        return msg.msg_id
+    return msg
 
 
-def PK001_to_Rockstar(pd_id):
+def PK001_to_SQS(pd):
+    """ Formats a PK001 message for an SQS destination"""
+    ctx = format_context(md.PK001, pd)
+    return json.dumps(ctx.rbm.to_dict())
+
+
+def PK001_to_Rockstar(pd):
     """ Formats a PK001 message for a RockStar destination """
-    msg = get_msg(md.PK001, pd_id)
+    msg = format_context(md.PK001, pd).record
     out = f"{msg.device_transmit_time}:  {msg.device_latitude} {msg.device_NS},"\
         f" {msg.device_longitude} {msg.device_EW}"
     return out
 
 
-def PK001_to_Handset(pd_id):
+def PK001_to_Handset(pd):
     """ Formats a PK001 message for a handset destination via Iridium
     RockBlock API"""
-    msg = get_msg(md.PK001, pd_id)
+    msg = format_context(md.PK001, pd).record
     if msg:
         lat = convert_nmea(float(msg.device_latitude))   # convert to DDMM.mmmm
         lon = convert_nmea(abs(float(msg.device_longitude)))  # convert to DDDMM.mmmm
@@ -61,35 +109,45 @@ def PK001_to_Handset(pd_id):
         return out
 
 
-def PK004_to_Handset(pd_id):
+def PK004_to_Handset(pd):
     """ Formats a PK004 message for a handset destination via Iridium RockBlock
     API"""
-    msg = get_msg(md.PK004, pd_id)
-    if msg:
-        rbm = get_msg(md.RockBlockMessage, msg.rbm_id)
-        out = "+DATA:" + binascii.unhexlify(rbm.data).decode('ascii')
-        out = out.replace(";", ",", 1)  # reformat packet for iridium receiver
-        return out.encode('ascii')
+    ctx = format_context(md.PK004, pd)
+    out = "+DATA:" + ctx.payload.decode('ascii')
+    out = out.replace(";", ",", 1)  # reformat packet for iridium receiver
+    return out.encode('ascii')
 
 
-def Command_to_Buoy(cmd_id):
+def command_packet(msg):
+    """ The packet for a DeviceCommand message, without the +DATA: prefix """
+    if msg.command == "beacon" or msg.command == "PK005":
+        if msg.value == "ON" or msg.value == "1":
+            return "PK005,1;"
+        elif msg.value == "OFF" or msg.value == "0":
+            return "PK005,0;"
+    if msg.command == "update" or msg.command == "PK006":
+        return "PK006,{};".format(int(msg.value))
+
+
+def Command_to_Buoy(cmd):
     """ Formats a DeviceCommand message for a Buoy destination via Iridium
     RockBlock API"""
-    msg = get_msg(md.DeviceCommandMessage, cmd_id)
-    cmd = None
+    msg = format_context(md.DeviceCommandMessage, cmd).record
     if msg:
-        if msg.command == "beacon" or msg.command == "PK005":
-            if msg.value == "ON" or msg.value == "1":
-                cmd = "+DATA:PK005,1;"
-            elif msg.value == "OFF" or msg.value == "0":
-                cmd = "+DATA:PK005,0;"
-        if msg.command == "update" or msg.command == "PK006":
-            cmd = "+DATA:PK006,{};".format(int(msg.value))
-
+        cmd = "+DATA:" + command_packet(msg)
         cmd = binascii.hexlify(cmd.encode('ascii')).decode('ascii')
         return cmd
 
 
+def Commands_to_Buoy(cmds):
+    """ Formats several DeviceCommand messages for a Buoy destination as a
+    single MT payload via Iridium RockBlock API"""
+    msgs = [format_context(md.DeviceCommandMessage, cmd).record
+            for cmd in cmds]
+    cmd = "+DATA:" + "".join(command_packet(msg) for msg in msgs)
+    return binascii.hexlify(cmd.encode('ascii')).decode('ascii')
+
+
 FORMATTER_TABLE = {
     'pk001': {
         'sqs': PK001_to_SQS,
@@ -0,0 +1,164 @@
+"""
+Persistence of incoming RockBlock pushes.  The incoming views hand parsed
+message data to these functions, which store the messages and their 'new'
+status records and queue them for processing.
+
+Duplicate pushes, by (imei, momsn), are counted and dropped here, see
+paikea.dedup.
+"""
+import time
+from sqlalchemy.exc import IntegrityError
+from paikea.extensions import db
+from paikea.dedup import (
+    get_duplicate_filter,
+    existing_keys,
+    message_key,
+)
+from paikea.paikea_protocol import payload_msg_type
+from paikea.utils import insert_rows
+import paikea.models as md
+import paikea.stages as stages
+import paikea.tasks as tasks
+
+
+def _key(record):
+    return message_key(record.get('imei'), record.get('momsn'))
+
+
+def _insert(rows, received_at):
+    insert_rows(md.RockBlockMessage, rows, ('imei', 'momsn'))
+    db.session.execute(
+        md.RBMessageStatus.__table__.insert(),
+        [{'rbm_id': row['id'], 'status': 'new'} for row in rows])
+    rbm_ids = [row['id'] for row in rows]
+    stages.add_stages(rbm_ids, 'received', received_at)
+    stages.add_stages(rbm_ids, 'committed')
+    db.session.commit()
+
+
+def store_rockblock_messages(records, received_at=None):
+    """ Bulk insert RockBlockMessages and a 'new' RBMessageStatus for each in
+    a single transaction.  Duplicates of stored messages, or of another
+    message in records, are counted and skipped.  Each message's msg_type is
+    classified from its payload prefix.
+
+    :param list records: dicts of RockBlock push data, see parse_push
+    :param float received_at: epoch seconds the push arrived, for stage
+        timing, now by default
+    :return: ids of the new RockBlockMessages, in the order of records
+    :rtype: list
+    """
+    received_at = received_at or time.time()
+    dedup = get_duplicate_filter()
+    rows = []
+    keys = set()
+    for record in records:
+        key = _key(record)
+        if key and (key in keys or dedup.is_duplicate(key)):
+            dedup.count_duplicate(key)
+            continue
+        if key:
+            keys.add(key)
+        row = dict(record)
+        row['msg_type'] = payload_msg_type(row.get('data'))
+        rows.append(row)
+
+    if not rows:
+        return []
+
+    try:
+        _insert(rows, received_at)
+    except IntegrityError:
+        # stored by another process since the filter was checked
+        db.session.rollback()
+        stored = existing_keys(keys)
+        for key in stored:
+            dedup.count_duplicate(key)
+        rows = [{k: v for k, v in row.items() if k != 'id'}
+                for row in rows if _key(row) not in stored]
+        if not rows:
+            return []
+        try:
+            _insert(rows, received_at)
+        except Exception as e:
+            db.session.rollback()
+            raise e
+    except Exception as e:
+        db.session.rollback()
+        raise e
+
+    for key in keys:
+        dedup.add(key)
+
+    return [row['id'] for row in rows]
+
+
+def ingest_rockblock_message(data, received_at=None):
+    """ Store a single RockBlock push and queue it for processing, in the
+    commands lane if it is a command.
+
+    :param dict data: RockBlock push data
+    :param float received_at: epoch seconds the push arrived
+    :return: id of the new RockBlockMessage, None if it was a duplicate
+    :rtype: int
+    """
+    rbm_ids = store_rockblock_messages([data], received_at)
+    if not rbm_ids:
+        return None
+
+    tasks.queue_in_lane(tasks.on_new_rbm, payload_msg_type(data.get('data')),
+                        rbm_ids[0])
+    return rbm_ids[0]
+
+
+def ingest_rockblock_batch(records, received_at=None):
+    """ Store a batch of RockBlock pushes and queue a single task to process
+    all of them.
+
+    :param list records: dicts of RockBlock push data
+    :param float received_at: epoch seconds the batch arrived
+    :return: ids of the new RockBlockMessages
+    :rtype: list
+    """
+    rbm_ids = store_rockblock_messages(records, received_at)
+    if rbm_ids:
+        tasks.on_new_rbm_batch.delay(rbm_ids)
+    return rbm_ids
+
+
+def classify_stored_messages(batch_size=1000):
+    """ Set msg_type on stored RockBlockMessages which have none, such as
+    those received before it was classified at ingest.  Messages are
+    updated in batches of batch_size, each in its own transaction.
+
+    :param int batch_size: messages per transaction
+    :return: number of messages classified
+    :rtype: int
+    """
+    classified = 0
+    last_id = 0
+    while True:
+        rows = db.session.query(
+            md.RockBlockMessage.id,
+            md.RockBlockMessage.data).filter(
+                md.RockBlockMessage.msg_type.is_(None),
+                md.RockBlockMessage.id > last_id).\
+            order_by(md.RockBlockMessage.id).\
+            limit(batch_size).all()
+        if not rows:
+            return classified
+
+        last_id = rows[-1].id
+        updates = []
+        for rbm_id, data in rows:
+            msg_type = payload_msg_type(data)
+            if msg_type:
+                updates.append({'id': rbm_id, 'msg_type': msg_type})
+
+        db.session.bulk_update_mappings(md.RockBlockMessage, updates)
+        try:
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            raise e
+        classified += len(updates)
@@ -0,0 +1,275 @@
+"""
+Asynchronous ingest server for the device push endpoints.
+
+A Flask worker is tied up for the whole of a push, including the database
+commit and broker publish.  During a constellation-wide burst that caps the
+number of pushes in flight at the number of workers.  IngestApp is a minimal
+ASGI application serving only the routes of the incoming blueprint,
+``POST /rockblock/incoming`` and ``POST /rockstar/incoming``, so a single
+process can hold thousands of concurrent pushes.  It runs alongside
+``autoapp.create_app``, which keeps serving everything else, see asgiapp.py.
+
+Messages are stored through an SQLAlchemy asyncio engine.  The driver is
+derived from SQLALCHEMY_DATABASE_URI, e.g. sqlite -> aiosqlite, mysql ->
+aiomysql, postgresql -> asyncpg, or set with INGEST_ASYNC_DATABASE_URI.
+Duplicate pushes are rejected by the RockBlockMessage unique constraint.
+
+Celery has no asyncio producer, so tasks are published from a small thread
+pool, INGEST_BROKER_THREADS, and awaited without blocking the event loop.
+"""
+import os
+import json
+import time
+import asyncio
+import logging
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.orm import sessionmaker
+from paikea.utils import parse_push
+from paikea.paikea_protocol import payload_msg_type
+from paikea.spool import Spool
+import paikea.models as md
+import paikea.serializers as ser
+import paikea.tasks as tasks
+
+
+logger = logging.getLogger('paikea.ingest_asgi')
+
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'mysql': 'mysql+aiomysql',
+    'postgres': 'postgresql+asyncpg',
+    'postgresql': 'postgresql+asyncpg',
+}
+
+
+def async_database_uri(uri, root_path=None):
+    ''' Database URI using the asyncio driver for the URI's backend.
+
+    Relative sqlite paths are resolved against root_path, as Flask-SQLAlchemy
+    does for the app.
+
+    :param str uri: SQLAlchemy database URI
+    :param str root_path: directory relative sqlite paths are relative to
+    :rtype: str
+    '''
+    url = make_url(uri)
+    backend = url.drivername.split('+')[0]
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No asyncio driver for {url.drivername}")
+
+    url = url.set(drivername=ASYNC_DRIVERS[backend])
+    if backend == 'sqlite' and root_path and url.database and \
+            url.database != ':memory:' and not os.path.isabs(url.database):
+        url = url.set(database=os.path.join(root_path, url.database))
+    return str(url)
+
+
+class IngestApp:
+    ''' ASGI application for RockBlock and RockStar pushes.
+
+    :param config: config object, as passed to Flask's config.from_object
+    '''
+
+    def __init__(self, config):
+        self.config = config
+        uri = getattr(config, 'INGEST_ASYNC_DATABASE_URI', None) or \
+            async_database_uri(config.SQLALCHEMY_DATABASE_URI,
+                               config.PROJECT_ROOT)
+
+        engine_args = {}
+        if not uri.startswith('sqlite'):
+            engine_args = {
+                'pool_size': config.INGEST_DB_POOL_SIZE,
+                'max_overflow': config.INGEST_DB_MAX_OVERFLOW,
+                'pool_pre_ping': True,
+            }
+        self.engine = create_async_engine(uri, **engine_args)
+        self.session = sessionmaker(self.engine, class_=AsyncSession,
+                                    expire_on_commit=False)
+        self.executor = ThreadPoolExecutor(
+            max_workers=config.INGEST_BROKER_THREADS,
+            thread_name_prefix='ingest-broker')
+
+        self.spool = None
+        if config.SPOOL_ENABLED:
+            self.spool = Spool(
+                config.SPOOL_DIR or os.path.join(config.PROJECT_ROOT,
+                                                 'instance', 'spool'),
+                segment_bytes=config.SPOOL_SEGMENT_BYTES,
+                segment_seconds=config.SPOOL_SEGMENT_SECONDS,
+                group_commit_wait=config.SPOOL_GROUP_COMMIT_WAIT)
+
+        self.routes = {
+            '/rockblock/incoming': self.rockblock_incoming,
+            '/rockstar/incoming': self.rockstar_incoming,
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        handler = self.routes.get(scope['path'].rstrip('/') or '/')
+        if handler is None:
+            await self.respond(send, 404, "Not Found")
+            return
+        if scope['method'] != 'POST':
+            await self.respond(send, 405, "Method Not Allowed")
+            return
+
+        body = await self.read_body(receive)
+        if body is None:
+            await self.respond(send, 413, "Request Entity Too Large")
+            return
+
+        status, text = await handler(body)
+        await self.respond(send, status, text)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def close(self):
+        ''' Release the database pool, broker threads and spool segment '''
+        await self.engine.dispose()
+        self.executor.shutdown(wait=True)
+        if self.spool is not None:
+            self.spool.seal()
+
+    async def read_body(self, receive):
+        ''' The request body, or None if it exceeds INGEST_MAX_BODY '''
+        chunks = []
+        size = 0
+        more_body = True
+        while more_body:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunk = message.get('body', b'')
+            size += len(chunk)
+            if size > self.config.INGEST_MAX_BODY:
+                return None
+            chunks.append(chunk)
+            more_body = message.get('more_body', False)
+        return b''.join(chunks)
+
+    @staticmethod
+    async def respond(send, status, text):
+        body = text.encode('utf-8')
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [
+                (b'content-type', b'text/plain; charset=utf-8'),
+                (b'content-length', str(len(body)).encode('ascii')),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def publish(self, task, *args, msg_type=None):
+        ''' Queue a celery task without blocking the event loop, in the lane
+        for msg_type
+        '''
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(
+            self.executor,
+            partial(tasks.queue_in_lane, task, msg_type, *args))
+
+    async def rockblock_incoming(self, body):
+        ''' Store a RockBlock push with a 'new' status and queue on_new_rbm.
+        As with the Flask view, an unreadable push is refused and a duplicate
+        is acknowledged.  Any other database failure is a 500, so RockBLOCK
+        delivers the push again.
+        '''
+        if self.spool is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self.executor, self.spool.append, body)
+            return 200, "OK"
+
+        received_at = time.time()
+        logger.info(f"Request data: {body}")
+        try:
+            data = parse_push(body)
+        except ValueError as e:
+            logger.error(f"Unreadable RockBlock push: {e}")
+            return 400, f"{e}"
+
+        msg_type = payload_msg_type(data.get('data'))
+        async with self.session() as session:
+            rbm = md.RockBlockMessage(msg_type=msg_type, **data)
+            session.add(rbm)
+            try:
+                await session.flush()
+                session.add(md.RBMessageStatus(rbm_id=rbm.id, status='new'))
+                if self.config.STAGE_TIMING_ENABLED:
+                    session.add_all([
+                        md.MessageStage(rbm_id=rbm.id, stage='received',
+                                        at=received_at),
+                        md.MessageStage(rbm_id=rbm.id, stage='committed',
+                                        at=time.time())])
+                await session.commit()
+            except IntegrityError:
+                await session.rollback()
+                logger.info("Duplicate RockBlock push suppressed: "
+                            f"{(data.get('imei'), data.get('momsn'))}")
+                return 200, "OK"
+            except SQLAlchemyError:
+                await session.rollback()
+                logger.error(f"Incoming message commit failed: {data}",
+                             exc_info=True)
+                return 500, "Committing failed"
+
+        try:
+            await self.publish(tasks.on_new_rbm, rbm.id, msg_type=msg_type)
+        except Exception:
+            # the message is stored as 'new', so it is not lost
+            logger.error(f"Queueing on_new_rbm failed for {rbm.id}",
+                         exc_info=True)
+        return 200, "OK"
+
+    async def rockstar_incoming(self, body):
+        ''' Store a RockCore push and queue on_new_rockcore '''
+        try:
+            data = json.loads(body)
+        except ValueError as e:
+            logger.error(f"Request JSON not available: {body}")
+            return 400, f"{e}"
+
+        if 'JWT' in data:
+            jwt = data.pop('JWT')  # NOQA
+            # FIXME: validate JWT wtih pubkey from rock core
+
+        try:
+            msg = ser.RockCorePushAPI().load(data, transient=True)
+        except Exception as e:
+            logger.error(f"RockCore API deserialization failed: {data}")
+            return 400, f"{e}"
+
+        async with self.session() as session:
+            session.add(msg)
+            try:
+                await session.commit()
+            except SQLAlchemyError:
+                await session.rollback()
+                logger.error(f"Committing failed: {data}", exc_info=True)
+                return 500, "Committing failed"
+
+        await self.publish(tasks.on_new_rockcore, msg.id)
+        return 200, "OK"
+
+
+def create_ingest_app(config):
+    ''' Create the ASGI ingest app from a config object '''
+    return IngestApp(config)
@@ -1,16 +1,20 @@
 import os
 from datetime import datetime
-import requests
 from flask import current_app as app
-import boto3
 from paikea.extensions import db
+import paikea.transport as transport
+from paikea.sqs import (
+    get_sqs_client,
+    sqs_message,
+    sqs_batches,
+)
 
 
 class ReportingMixin:
     """ Mixin to track creation and logical deletion status for records
     """
     #: DateTime, defaults to utc timestamp of record creation
-    created_at = db.Column(db.DateTime, default=datetime.utcnow())
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
     #: Boolean, logically delete record from table
     logical_del = db.Column(db.Boolean, default=False)
 
@@ -18,6 +22,14 @@ class ReportingMixin:
 class RockBlockMessage(ReportingMixin, db.Model):
     """ Serialization of incoming Iridium API message from a RockBlock Modem
     """
+    #: A modem's message is identified by its imei and momsn, the unique
+    #: constraint rejects duplicate pushes.  created_at is indexed for the
+    #: time windows of the message page and reprocessing.
+    __table_args__ = (
+        db.UniqueConstraint('imei', 'momsn',
+                            name='uq_rock_block_message_imei_momsn'),
+        db.Index('ix_rock_block_message_created_at', 'created_at'), )
+
     #: Integer, Primary Key
     id = db.Column(db.Integer, primary_key=True)
     #: String(128), IMEI for rockblock modem
@@ -40,6 +52,9 @@ class RockBlockMessage(ReportingMixin, db.Model):
     iridium_session_status = db.Column(db.String(128))
     #: String(1024) Iridium message payload
     data = db.Column(db.String(1024))
+    #: String(8), packet type from the payload prefix, e.g. PK001, set at
+    #: ingest.  None if the payload has no packet type.
+    msg_type = db.Column(db.String(8), index=True)
     #: Relationship to RockBlock Message Status table
     status = db.relationship("RBMessageStatus", uselist=False,
                              back_populates='rbm')
@@ -61,12 +76,19 @@ class RBMessageStatus(ReportingMixin, db.Model):
     """ Status table to track the processing of an incoming RockBlockMessage.
     This status table is used rather than updating the RockBlockMessage record.
     """
+    #: New messages are claimed oldest first
+    __table_args__ = (
+        db.Index('ix_rb_message_status_status_id', 'status', 'id'), )
+
     #: Integer, Primary Key
     id = db.Column(db.Integer, primary_key=True)
     #: Integer, Foreign Key linking this status to a RockBlockMessage
-    rbm_id = db.Column(db.Integer, db.ForeignKey('rock_block_message.id'))
+    rbm_id = db.Column(db.Integer, db.ForeignKey('rock_block_message.id'),
+                       index=True)
     #: String(128), status indicator
     status = db.Column(db.String(128))
+    #: String(64), token of the batch task which claimed the message
+    claimed_by = db.Column(db.String(64), index=True)
 
     #: Relationship to RockBlockMessage
     rbm = db.relationship("RockBlockMessage",
@@ -81,7 +103,7 @@ class RockBlockModem(ReportingMixin, db.Model):
     #: Integer, Primary Key
     id = db.Column(db.Integer, primary_key=True)
     #: String(128) Modem IMEI as assigned by Iridium
-    imei = db.Column(db.String(128))
+    imei = db.Column(db.String(128), index=True)
     #: String(32), iridium device type, assigned by Iridium
     modem_type = db.Column(db.String(32))
     #: String(64), Iridium assigned serial for Modem
@@ -98,12 +120,14 @@ class RockBlockModem(ReportingMixin, db.Model):
     #: e.g. buoy or handset
     device_type = db.Column(db.String(32))
 
-    def send(self, enc_msg):
+    def send(self, enc_msg, idempotency_key=None):
         """ Send a message to this modem via the RockBlock API.  Message is
         sent as-is and therefore should be already encoded
 
         :param enc_msg: message to be sent hex encoded
         :type enc_msg: bytes
+        :param str idempotency_key: unused, the RockBlock API cannot discard
+            a redelivered message
         """
 
         url = "https://core.rock7.com/rockblock/MT"
@@ -120,7 +144,7 @@ class RockBlockModem(ReportingMixin, db.Model):
         resp = None
         try:
             app.logger.warning(f"sending {enc_msg} to {url}")
-            resp = requests.post(url, data)
+            resp = transport.post(url, data)
         except Exception as e:
             print(f"RB message to {self.imei} failed")
             raise e
@@ -138,9 +162,10 @@ class Buoy(ReportingMixin, db.Model):
     #: String(16), firmware version of ESP32 in Buoy
     firmware_version = db.Column(db.String(16))
     #: String(16), Server ID for Buoy
-    iam = db.Column(db.String(16))
+    iam = db.Column(db.String(16), index=True)
     #: Integer, Foreign Key to RockBlockModem by modem ID.
-    rb_id = db.Column(db.Integer, db.ForeignKey('rock_block_modem.id'))
+    rb_id = db.Column(db.Integer, db.ForeignKey('rock_block_modem.id'),
+                      index=True)
     #: Relationship to RockBlockModem table
     rb = db.relationship("RockBlockModem",
                          uselist=False)
@@ -158,9 +183,10 @@ class Handset(ReportingMixin, db.Model):
     #: String(16), firmware version of ESP32 in Hanset
     firmware_version = db.Column(db.String(16))
     #: String(16), server device ID
-    iam = db.Column(db.String(16))
+    iam = db.Column(db.String(16), index=True)
     #: Integer, Foreign Key to RockBlockModem by modem ID
-    rb_id = db.Column(db.Integer, db.ForeignKey('rock_block_modem.id'))
+    rb_id = db.Column(db.Integer, db.ForeignKey('rock_block_modem.id'),
+                      index=True)
     #: Relationship to RockBlockModem table
     rb = db.relationship("RockBlockModem",
                          uselist=False)
@@ -177,7 +203,8 @@ class PK001(ReportingMixin, db.Model):
     #: Integer, Primary Key
     id = db.Column(db.Integer, primary_key=True)
     #: Integer, Foreign Key to source RockBlockMessage
-    rbm_id = db.Column(db.Integer, db.ForeignKey('rock_block_message.id'))
+    rbm_id = db.Column(db.Integer, db.ForeignKey('rock_block_message.id'),
+                       index=True)
     #: DateTime, Transmit time as recorded by Iridium constellation, UTC
     ird_transmit_time = db.Column(db.DateTime)
     #: Numeric(9, 6), Latitude of the receiving Iridium Satellite
@@ -216,7 +243,8 @@ class PK004(ReportingMixin, db.Model):
     #: Integer, Primary Key
     id = db.Column(db.Integer, primary_key=True)
     #: Integer, Foreign Key linking this record to source Rock Block Message
-    rbm_id = db.Column(db.Integer, db.ForeignKey('rock_block_message.id'))
+    rbm_id = db.Column(db.Integer, db.ForeignKey('rock_block_message.id'),
+                       index=True)
     #: Float, device latitude in degrees decimal
     lat = db.Column(db.Float, nullable=False)
     #: String(1), North/South indicator for device latitude
@@ -309,7 +337,7 @@ class RockStar(ReportingMixin, db.Model):
     serial = db.Column(db.String(64), nullable=False)
     msgs = db.relationship("RockCorePushAPI")
 
-    def send(self, msg):
+    def send(self, msg, idempotency_key=None):
         url = "https://core.rock7.com/API2/SendMessage/"
         user = os.environ.get('ROCKCORE_USER')
         pwrd = os.environ.get('ROCKCORE_PASS')
@@ -324,7 +352,7 @@ class RockStar(ReportingMixin, db.Model):
         url += self.serial
 
         app.logger.warning(f"sending {msg} to rockstar: {self.serial}")
-        reponse = requests.post(url, params=params)
+        reponse = transport.post(url, params=params)
         print(f"Response: {reponse}")
 
 
@@ -337,31 +365,51 @@ class SQS_Endpoint(ReportingMixin, db.Model):
     #: URL of the SQS queue
     url = db.Column(db.String(128), nullable=False)
 
-    def get_queue(self):
-        ''' Retrieves the AWS boto3 queue representation for this record'''
-        for queue in boto3.resource('sqs').queues.all():
-            if self.url == queue.url:
-                return queue
-        print(f"SQS queue not accessible: {self.queue_name}")
-
-    def send(self, msg):
+    def send(self, msg, idempotency_key=None):
         ''' Attempts to send the msg to the AWS SQS queue using boto3.
 
         Credentails are handled via boto3's usual methods and not explicitly
         by this function.
 
         :param msg: The formatted message to send as the MessageBody
+        :param str idempotency_key: sent as the IdempotencyKey message
+            attribute, so consumers can discard a redelivered message
+        '''
+        kwargs = sqs_message(msg, idempotency_key)
+        try:
+            app.logger.warning(f"sending {msg} to SQS {self.queue_name}")
+            get_sqs_client().send_message(QueueUrl=self.url, **kwargs)
+        except Exception as e:
+            print(f"Problem sending to SQS queue: {self.url}")
+            raise e
+
+    def send_batch(self, msgs):
+        ''' Send several messages with as few send_message_batch calls as the
+        SQS limits allow, 10 messages or 256 KiB per call.  A message the
+        queue rejects does not fail the others.
+
+        :param list msgs: (formatted message, idempotency key or None)
+        :return: {index in msgs: error} of the messages not sent
+        :rtype: dict
         '''
-        queue = self.get_queue()
-        if queue:
+        client = get_sqs_client()
+        errors = {}
+        app.logger.warning(f"sending {len(msgs)} messages to SQS "
+                           f"{self.queue_name}")
+        for batch in sqs_batches(msgs):
+            entries = [dict(Id=str(index), **sqs_message(msg, key))
+                       for index, msg, key in batch]
             try:
-                app.logger.warning(f"sending {msg} to SQS {self.queue_name}")
-                queue.send_message(MessageBody=msg)
+                response = client.send_message_batch(QueueUrl=self.url,
+                                                     Entries=entries)
             except Exception as e:
-                print(f"Problem sending to SQS queue: {queue}")
-                raise e
-        else:
-            print(f"Problem finding queue for SQS_Endpoing: {self.id}")
+                print(f"Problem sending batch to SQS queue: {self.url}")
+                errors.update({index: f"{e}" for index, msg, key in batch})
+                continue
+            for failed in response.get('Failed', []):
+                errors[int(failed['Id'])] = \
+                    f"{failed.get('Code')}: {failed.get('Message')}"
+        return errors
 
 
 class DeviceCommandMessage(ReportingMixin, db.Model):
@@ -382,6 +430,11 @@ class DeviceCommandMessage(ReportingMixin, db.Model):
     #: Integer, ID of device which sent the message which triggered
     #: this command
     source_device_id = db.Column(db.Integer, nullable=False)
+    #: String(16), set when commands to a buoy are coalesced: superseded by
+    #: a later command of its type, or merged into another's MT payload
+    coalesce_status = db.Column(db.String(16))
+    #: Integer, ID of the command superseding this one or carrying it
+    coalesced_into = db.Column(db.Integer)
 
 
 class EndpointRoute(ReportingMixin, db.Model):
@@ -393,6 +446,14 @@ class EndpointRoute(ReportingMixin, db.Model):
     formatting.
 
     '''
+    #: Routes are looked up by source, and by endpoint when a device is
+    #: relinked
+    __table_args__ = (
+        db.Index('ix_endpoint_route_source', 'source_device',
+                 'source_device_type', 'msg_type'),
+        db.Index('ix_endpoint_route_endpoint', 'endpoint_id',
+                 'endpoint_type'), )
+
     #: Integer, Primary Key for route
     id = db.Column(db.Integer, primary_key=True)
     #: String(64) Type of message source, ie buoy, handset, rockstar, etc
@@ -437,6 +498,11 @@ class DeviceFirmwareUpgrade(ReportingMixin, db.Model):
     are persisted in this record.  The status is updated through the lifecycle
     of the device upgrade.
     '''
+    #: Upgrades in progress are looked up by device
+    __table_args__ = (
+        db.Index('ix_device_firmware_upgrade_device', 'device_type',
+                 'device_id', 'status'), )
+
     #: Integer, primary Key
     id = db.Column(db.Integer, primary_key=True)
     #: String(16), device type i.e. buoy, handset, etc.
@@ -453,3 +519,80 @@ class DeviceFirmwareUpgrade(ReportingMixin, db.Model):
     def full_path(self):
         ''' Full path to the upgrade files'''
         return f"{self.root_dir}/{self.file_path_suffix}"
+
+
+class CacheVersion(db.Model):
+    ''' Version of data held in per process caches, such as the modem cache.
+    A change to the cached data increments the version in the same
+    transaction, and processes drop their cache once they see a new version.
+    '''
+    #: String(32), Primary Key, name of the cache, e.g. modems
+    name = db.Column(db.String(32), primary_key=True)
+    #: Integer, incremented on each change
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+class DeliveryAttempt(ReportingMixin, db.Model):
+    ''' Outbox record of a message to be delivered over an EndpointRoute.
+
+    Written in the same transaction as the message, and drained by the
+    dispatch_outbox task, which retries failed deliveries with exponential
+    backoff until the delivery is dead-lettered.
+    '''
+    __table_args__ = (
+        db.Index('ix_delivery_attempt_status_next_attempt_at',
+                 'status', 'next_attempt_at'), )
+
+    #: Integer, Primary Key
+    id = db.Column(db.Integer, primary_key=True)
+    #: Integer, Foreign Key to the EndpointRoute delivered over
+    route_id = db.Column(db.Integer, db.ForeignKey('endpoint_route.id'))
+    #: String(64), Type of endpoint, as in EndpointRoute
+    endpoint_type = db.Column(db.String(64), nullable=False)
+    #: Integer, id of endpoint, as in EndpointRoute
+    endpoint_id = db.Column(db.Integer, nullable=False)
+    #: String(64), message type, e.g. pk001 or command
+    msg_type = db.Column(db.String(64), nullable=False)
+    #: Integer, id of the message in the table for msg_type
+    msg_id = db.Column(db.Integer, nullable=False)
+    #: String(128), identifies the delivery of this message over this route,
+    #: passed to endpoints which can discard redelivered messages
+    idempotency_key = db.Column(db.String(128), nullable=False, unique=True)
+    #: String(16), pending, sending, delivered or dead
+    status = db.Column(db.String(16), nullable=False, default='pending')
+    #: Integer, number of failed sends
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    #: DateTime, earliest time of the next send
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+    #: String(64), token of the dispatcher sending this delivery
+    claimed_by = db.Column(db.String(64))
+    #: DateTime, when the dispatcher claimed this delivery
+    claimed_at = db.Column(db.DateTime)
+    #: DateTime, when the delivery succeeded
+    delivered_at = db.Column(db.DateTime)
+    #: String(512), error of the last failed send
+    last_error = db.Column(db.String(512))
+
+    def get_endpoint(self):
+        ''' Retrieve the endpoint object this delivery is sent to '''
+        model = EndpointRoute.endpoint_types[self.endpoint_type]
+        return db.session.query(model).filter_by(id=self.endpoint_id).one()
+
+
+class MessageStage(db.Model):
+    ''' Time a RockBlockMessage reached a stage of the pipeline, one of
+    paikea.stages.STAGES.  Rows are only written with STAGE_TIMING_ENABLED.
+    '''
+    __table_args__ = (
+        db.Index('ix_message_stage_stage_at', 'stage', 'at'), )
+
+    #: Integer, Primary Key
+    id = db.Column(db.Integer, primary_key=True)
+    #: Integer, RockBlockMessage id
+    rbm_id = db.Column(db.Integer, nullable=False, index=True)
+    #: String(16), stage name, e.g. received or sent
+    stage = db.Column(db.String(16), nullable=False)
+    #: String(80), for a sent stage the endpoint, as endpoint_type:id
+    endpoint = db.Column(db.String(80))
+    #: Float, seconds since the epoch
+    at = db.Column(db.Float, nullable=False)
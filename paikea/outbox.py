@@ -0,0 +1,334 @@
+"""
+Transactional outbox for endpoint deliveries.
+
+With OUTBOX_ENABLED, a PK record or command is not sent to its endpoints by
+the task creating it.  Instead enqueue adds a DeliveryAttempt per enabled
+route in the same transaction, so the deliveries are committed if and only
+if the message is.  The dispatch_outbox task claims due deliveries in
+batches, sends them and records the outcome: a failed send is retried with
+exponential backoff, and dead-lettered after OUTBOX_MAX_ATTEMPTS.
+
+Delivery is at-least-once.  A send still running at ENDPOINT_SEND_TIMEOUT
+keeps its claim, so the delivery is not sent again while it is in flight,
+and its outcome is recorded by record_late once it finishes.  A dispatcher
+which dies mid send leaves its claim to expire after OUTBOX_LEASE_SECONDS,
+when the delivery is sent again, so each delivery carries an idempotency
+key for endpoints able to discard a redelivered message.
+
+The results of deliveries sent directly, without OUTBOX_ENABLED, are
+recorded too by record_sends, so a failed one is retried from here.
+
+Commands to buoys cost an Iridium credit per MT message.  With
+COMMAND_COALESCE_SECONDS set, their deliveries are held for that window,
+then the pending commands to each buoy are merged: the latest command of
+each type supersedes the earlier ones, and the survivors go out as one MT
+payload.  Commands are queued here even without OUTBOX_ENABLED.
+"""
+from collections import defaultdict
+from datetime import datetime, timedelta
+from flask import current_app as app
+from sqlalchemy import and_, or_
+from paikea.extensions import db
+import paikea.models as md
+from paikea.cache import get_route_table
+
+
+#: Command names by the packet type they set; a later command of a packet
+#: type supersedes the earlier ones
+COMMAND_TYPES = {
+    'beacon': 'PK005',
+    'PK005': 'PK005',
+    'update': 'PK006',
+    'PK006': 'PK006',
+}
+
+
+def coalesce_commands():
+    ''' Commands to buoys are merged over COMMAND_COALESCE_SECONDS '''
+    return bool(app.config['COMMAND_COALESCE_SECONDS'])
+
+
+def is_coalesced(msg_type, endpoint_type):
+    return coalesce_commands() and msg_type == 'command' and \
+        endpoint_type == 'buoy'
+
+
+def delivery_key(route_id, msg_type, msg_id):
+    ''' Idempotency key of the delivery of a message over a route '''
+    return f"{route_id}:{msg_type}:{msg_id}"
+
+
+def enqueue(source, source_type, msg_id, message_type):
+    ''' Add a pending DeliveryAttempt for each enabled route of a message,
+    to be committed by the caller along with the message.
+
+    :param int source: id of the source device of the message
+    :param str source_type: source device type
+    :param int msg_id: id of the message, flushed
+    :param str message_type: the type of the message
+    :return: the DeliveryAttempts
+    :rtype: list
+    '''
+    now = datetime.utcnow()
+    window = timedelta(seconds=app.config['COMMAND_COALESCE_SECONDS'])
+    routes = get_route_table().lookup(source_type, source, message_type)
+
+    attempts = [md.DeliveryAttempt(
+        route_id=route.id,
+        endpoint_type=route.endpoint_type,
+        endpoint_id=route.endpoint_id,
+        msg_type=message_type,
+        msg_id=msg_id,
+        idempotency_key=delivery_key(route.id, message_type, msg_id),
+        status='pending',
+        attempts=0,
+        next_attempt_at=now + window
+        if is_coalesced(message_type, route.endpoint_type) else now)
+        for route in routes]
+    db.session.add_all(attempts)
+    return attempts
+
+
+def backoff(attempts):
+    ''' Seconds to wait before retrying a delivery which failed attempts
+    times, doubling from OUTBOX_BACKOFF_BASE up to OUTBOX_BACKOFF_MAX
+    '''
+    return min(app.config['OUTBOX_BACKOFF_MAX'],
+               app.config['OUTBOX_BACKOFF_BASE'] * 2 ** (attempts - 1))
+
+
+def claim_due(limit, token):
+    ''' Claim up to limit deliveries which are due, or whose claim expired.
+    As for messages, the update only matches deliveries still unclaimed, so
+    concurrent dispatchers never claim the same delivery.  When commands are
+    coalesced, every pending command to a buoy with a due command is claimed
+    too, to be merged with it.  Committed.
+
+    :param int limit: maximum number of deliveries
+    :param str token: identifies the claiming dispatcher
+    :return: the claimed DeliveryAttempts, oldest due first
+    :rtype: list
+    '''
+    now = datetime.utcnow()
+    expired = now - timedelta(seconds=app.config['OUTBOX_LEASE_SECONDS'])
+    due = or_(
+        and_(md.DeliveryAttempt.status == 'pending',
+             md.DeliveryAttempt.next_attempt_at <= now),
+        and_(md.DeliveryAttempt.status == 'sending',
+             md.DeliveryAttempt.claimed_at < expired))
+
+    ids = [attempt_id for attempt_id, in db.session.query(
+        md.DeliveryAttempt.id).filter(due).
+        order_by(md.DeliveryAttempt.next_attempt_at).limit(limit)]
+    if not ids:
+        return []
+
+    db.session.query(md.DeliveryAttempt).filter(
+        md.DeliveryAttempt.id.in_(ids), due).update(
+            {'status': 'sending', 'claimed_by': token, 'claimed_at': now},
+            synchronize_session=False)
+
+    if coalesce_commands():
+        buoys = [buoy_id for buoy_id, in db.session.query(
+            md.DeliveryAttempt.endpoint_id).filter_by(
+                claimed_by=token, msg_type='command', endpoint_type='buoy').
+            distinct()]
+        if buoys:
+            db.session.query(md.DeliveryAttempt).filter(
+                md.DeliveryAttempt.status == 'pending',
+                md.DeliveryAttempt.msg_type == 'command',
+                md.DeliveryAttempt.endpoint_type == 'buoy',
+                md.DeliveryAttempt.endpoint_id.in_(buoys)).update(
+                    {'status': 'sending', 'claimed_by': token,
+                     'claimed_at': now},
+                    synchronize_session=False)
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        raise e
+
+    return db.session.query(md.DeliveryAttempt).\
+        filter_by(claimed_by=token, status='sending').\
+        order_by(md.DeliveryAttempt.next_attempt_at).all()
+
+
+def coalesce(attempts):
+    ''' Group claimed deliveries into sends.  When commands are coalesced
+    the command deliveries to each buoy are merged by merge_commands, every
+    other delivery is sent on its own.
+
+    :param list attempts: claimed DeliveryAttempts
+    :return: (DeliveryAttempt sent, DeliveryAttempts its send delivers)
+    :rtype: list
+    '''
+    sends = []
+    commands = defaultdict(list)
+    for attempt in attempts:
+        if is_coalesced(attempt.msg_type, attempt.endpoint_type):
+            commands[attempt.endpoint_id].append(attempt)
+        else:
+            sends.append((attempt, [attempt]))
+
+    for group in commands.values():
+        survivors = merge_commands(group)
+        sends.append((survivors[-1], survivors))
+    return sends
+
+
+def merge_commands(attempts):
+    ''' Merge claimed command deliveries to one buoy.  The latest command of
+    each packet type survives, and the earlier ones are superseded.  The
+    last survivor carries the others in its MT payload.  The decisions are
+    recorded on the DeviceCommandMessages.  Not committed.
+
+    :param list attempts: DeliveryAttempts of commands to a buoy
+    :return: the surviving DeliveryAttempts, oldest command first
+    :rtype: list
+    '''
+    commands = {cmd.id: cmd for cmd in db.session.query(
+        md.DeviceCommandMessage).filter(md.DeviceCommandMessage.id.in_(
+            {attempt.msg_id for attempt in attempts}))}
+
+    latest = {}
+    for attempt in sorted(attempts, key=lambda a: (a.msg_id, a.id)):
+        cmd = commands[attempt.msg_id]
+        kind = COMMAND_TYPES.get(cmd.command, cmd.command)
+        earlier = latest.get(kind)
+        if earlier is not None:
+            earlier.status = 'superseded'
+            earlier.claimed_by = None
+            earlier.claimed_at = None
+            if earlier.msg_id != attempt.msg_id:
+                superseded = commands[earlier.msg_id]
+                superseded.coalesce_status = 'superseded'
+                superseded.coalesced_into = attempt.msg_id
+        latest[kind] = attempt
+
+    survivors = sorted(latest.values(), key=lambda a: a.msg_id)
+    carrier = survivors[-1]
+    for attempt in survivors[:-1]:
+        merged = commands[attempt.msg_id]
+        merged.coalesce_status = 'merged'
+        merged.coalesced_into = carrier.msg_id
+    return survivors
+
+
+def result_key(result):
+    ''' Idempotency key of the delivery a send result is for '''
+    return result.get('idempotency_key') or \
+        delivery_key(result['route'], result['msg_type'], result['msg_id'])
+
+
+def record_result(attempt, result):
+    ''' Update a claimed DeliveryAttempt from its send result, scheduling a
+    retry or dead-lettering it on failure.  A send which timed out may still
+    succeed, so the delivery stays claimed until record_late.  Not
+    committed.
+
+    :param DeliveryAttempt attempt: the delivery
+    :param dict result: result from tasks.send_concurrently
+    '''
+    now = datetime.utcnow()
+    if result.get('status') == 'timeout':
+        attempt.last_error = f"{result.get('error')}"[:512]
+        return
+
+    attempt.claimed_by = None
+    attempt.claimed_at = None
+
+    if result.get('status') == 'sent':
+        attempt.status = 'delivered'
+        attempt.delivered_at = now
+        attempt.last_error = None
+        return
+
+    attempt.attempts += 1
+    attempt.last_error = f"{result.get('error')}"[:512]
+    if attempt.attempts >= app.config['OUTBOX_MAX_ATTEMPTS']:
+        attempt.status = 'dead'
+        app.logger.error(f"Delivery {attempt.idempotency_key} dead-lettered "
+                         f"after {attempt.attempts} attempts")
+    else:
+        attempt.status = 'pending'
+        attempt.next_attempt_at = now + timedelta(
+            seconds=backoff(attempt.attempts))
+
+
+def record_sends(results, token):
+    ''' Record the results of deliveries sent without the outbox as
+    DeliveryAttempts: delivered, pending a retry on failure, or claimed by
+    token while a timed out send is in flight.  Not committed.
+
+    :param list results: results from tasks.send_concurrently
+    :param str token: claims the deliveries still being sent
+    '''
+    if not results:
+        return
+    now = datetime.utcnow()
+    by_key = {result_key(result): result for result in results}
+    attempts = {attempt.idempotency_key: attempt for attempt in
+                db.session.query(md.DeliveryAttempt).filter(
+                    md.DeliveryAttempt.idempotency_key.in_(by_key))}
+    for key, result in by_key.items():
+        attempt = attempts.get(key)
+        if attempt is None:
+            attempt = md.DeliveryAttempt(
+                route_id=result['route'],
+                endpoint_type=result['endpoint_type'],
+                endpoint_id=result['endpoint_id'],
+                msg_type=result['msg_type'],
+                msg_id=result['msg_id'],
+                idempotency_key=key,
+                attempts=0)
+            db.session.add(attempt)
+        attempt.status = 'sending'
+        attempt.claimed_by = token
+        attempt.claimed_at = now
+        record_result(attempt, result)
+
+
+def record_late(results, token, carried=None):
+    ''' Record the results of sends which finished after timing out, for
+    the deliveries still claimed by token.  Committed.
+
+    :param list results: completed results of the timed out sends
+    :param str token: claimed_by of the deliveries
+    :param dict carried: idempotency keys of the deliveries each send
+        delivered, by the key of the delivery sent, for merged commands
+    '''
+    carried = carried or {}
+    by_key = {}
+    for result in results:
+        for key in carried.get(result_key(result), [result_key(result)]):
+            by_key[key] = result
+    attempts = db.session.query(md.DeliveryAttempt).filter(
+        md.DeliveryAttempt.idempotency_key.in_(by_key),
+        md.DeliveryAttempt.claimed_by == token,
+        md.DeliveryAttempt.status == 'sending')
+    for attempt in attempts:
+        record_result(attempt, by_key[attempt.idempotency_key])
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        raise e
+
+
+def retry_dead():
+    ''' Make every dead-lettered delivery due again.  Committed.
+
+    :return: number of deliveries requeued
+    :rtype: int
+    '''
+    requeued = db.session.query(md.DeliveryAttempt).\
+        filter_by(status='dead').update(
+            {'status': 'pending', 'attempts': 0,
+             'next_attempt_at': datetime.utcnow()},
+            synchronize_session=False)
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        raise e
+    return requeued
@@ -7,6 +7,23 @@ from urllib.parse import unquote
 import re
 
 
+#: hex encoded "PKnnn;" packet type prefix of an Iridium payload
+PACKET_TYPE_HEX = re.compile(r"^(?:504[bB](?:3[0-9]){3}3[bB])")
+
+
+def payload_msg_type(raw_data):
+    ''' Packet type of the hex encoded payload of an Iridium RockBlock API
+        message, read from the prefix alone so the payload is not decoded.
+
+        :param str raw_data: The data field of an iridium message
+        :return: the packet type, e.g. "PK001", or None if there is none
+        :rtype: str
+    '''
+    if not raw_data or PACKET_TYPE_HEX.match(raw_data) is None:
+        return None
+    return binascii.unhexlify(raw_data[:10]).decode('ascii')
+
+
 def parse_iridium_payload(raw_data):
     ''' Parse the hex encoded payload of an Iridium RockBlock API message.
 
@@ -141,10 +158,10 @@ def buoy_time_to_datetime(timecode, transmit_date):
 def transmit_time_to_datetime(transmit):
     ''' Iridium transit is not iso format, so we add the century.
         If this is still running in in 2099, well, we might have a problem.
-        The double call to unquote is required to fully decode the url encoded
-        data, but needs to be investigated why a single call isn't sufficient.
-        Unclear if iridium is double encoding or occuring on parsing the
-        request.
+        Messages stored before utils.parse_push kept the transmit time
+        percent-encoded, which is what the double call to unquote decodes.
+        Messages parsed by parse_push are already decoded and pass through
+        unchanged.
 
         :param str transmit: Iridium timecode from received API call
         :return: UTC timestamp of Iridium transmit time
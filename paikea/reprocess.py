@@ -0,0 +1,318 @@
+"""
+Bulk reprocessing of stored RockBlock messages, such as after a parser fix.
+
+Unlike the celery pipeline, which handles one message per task, messages are
+read in batches in id order, their payloads parsed in a process pool, and
+their PK001 and PK004 records upserted with one insert and one update per
+batch: a message's existing record is updated in place, a message without
+one gets a new record.  Commands are not reprocessed, as that would send
+them again.
+
+Optionally the records are sent on to their endpoints, at most a given
+number per second, without going through the broker.
+
+Progress is saved to a checkpoint file after every batch, so an interrupted
+run started again with the same filters resumes after the last committed
+batch.  See the ``flask messages reprocess`` command.
+"""
+import os
+import json
+import time
+from datetime import datetime
+from types import SimpleNamespace
+from concurrent.futures import ProcessPoolExecutor
+from flask import current_app as app
+from sqlalchemy import func, or_
+from paikea.extensions import db
+from paikea.paikea_protocol import (
+    parse_iridium_payload,
+    payload_msg_type,
+)
+from paikea.utils import insert_rows
+import paikea.models as md
+import paikea.tasks as tasks
+
+
+#: Packet type -> (record model, builder), the types reprocessed
+BUILDERS = {
+    'PK001': (md.PK001, tasks.build_pk001),
+    'PK004': (md.PK004, tasks.build_pk004),
+}
+
+#: RockBlockMessage columns passed to the parsing processes
+COLUMNS = ['id', 'msg_type', 'data', 'transmit_time', 'iridium_latitude',
+           'iridium_longitude', 'iridium_cep', 'rb_id']
+
+
+def parse_message(row):
+    ''' Build the record of a message.  Run in the parsing processes, so
+    it only uses the message's columns and returns plain values.
+
+    :param dict row: RockBlockMessage COLUMNS
+    :return: (rbm id, packet type, record columns, error).  The type is None
+        for a message which is not reprocessed.
+    :rtype: tuple
+    '''
+    msg_type = row['msg_type'] or payload_msg_type(row['data'])
+    if msg_type not in BUILDERS:
+        return row['id'], None, None, None
+
+    model, build = BUILDERS[msg_type]
+    try:
+        record = build(SimpleNamespace(**row),
+                       parse_iridium_payload(row['data']))
+    except Exception as e:
+        return row['id'], msg_type, None, f"{e}"
+
+    values = {}
+    for column in model.__table__.columns:
+        value = getattr(record, column.key)
+        if column.key != 'id' and value is not None:
+            values[column.key] = value
+    return row['id'], msg_type, values, None
+
+
+def transmit_time_column():
+    ''' RockBlockMessage.transmit_time in the yy-mm-dd HH:MM:SS form which
+    parse_push stores, decoding the percent-encoded times of older messages
+    as transmit_time_to_datetime does, so it sorts as a string.
+    '''
+    column = md.RockBlockMessage.transmit_time
+    for encoded, decoded in [('%25', '%'), ('%20', ' '), ('%3A', ':'),
+                             ('%3a', ':')]:
+        column = func.replace(column, encoded, decoded)
+    return column
+
+
+def transmit_time_bound(value):
+    ''' A since or until filter, a datetime or ISO 8601 string in UTC, in
+    the form of transmit_time_column
+    '''
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return value.strftime('%y-%m-%d %H:%M:%S')
+
+
+def select_messages(filters, after_id=0):
+    ''' Messages to reprocess, in id order.  The since and until filters
+    apply to the Iridium transmit time of the messages, as created_at was
+    not set correctly for some stored messages.
+
+    :param dict filters: optional since and until datetimes, imei, and
+        msg_types, packet types of BUILDERS
+    :param int after_id: only messages with a greater id
+    :rtype: Query
+    '''
+    msg_types = filters.get('msg_types') or list(BUILDERS)
+    query = db.session.query(
+        *[getattr(md.RockBlockMessage, column) for column in COLUMNS],
+        md.RockBlockModem.device_type).\
+        outerjoin(md.RockBlockModem,
+                  md.RockBlockModem.id == md.RockBlockMessage.rb_id).\
+        filter(md.RockBlockMessage.id > after_id,
+               or_(md.RockBlockMessage.msg_type.in_(msg_types),
+                   md.RockBlockMessage.msg_type.is_(None)))
+
+    if filters.get('since'):
+        query = query.filter(
+            transmit_time_column() >= transmit_time_bound(filters['since']))
+    if filters.get('until'):
+        query = query.filter(
+            transmit_time_column() < transmit_time_bound(filters['until']))
+    if filters.get('imei'):
+        query = query.filter(md.RockBlockMessage.imei == filters['imei'])
+    return query.order_by(md.RockBlockMessage.id)
+
+
+def upsert_records(msg_type, records):
+    ''' Insert or update the records of messages of one type.  Not
+    committed.
+
+    :param str msg_type: packet type, of BUILDERS
+    :param dict records: {rbm id: record columns}
+    :return: {rbm id: record id}
+    :rtype: dict
+    '''
+    model = BUILDERS[msg_type][0]
+    existing = {}
+    for record_id, rbm_id in db.session.query(model.id, model.rbm_id).\
+            filter(model.rbm_id.in_(records)).order_by(model.id.desc()):
+        existing[rbm_id] = record_id
+
+    updates = [dict(values, id=existing[rbm_id])
+               for rbm_id, values in records.items() if rbm_id in existing]
+    inserts = [values for rbm_id, values in records.items()
+               if rbm_id not in existing]
+    db.session.bulk_update_mappings(model, updates)
+    insert_rows(model, inserts, ('rbm_id',))
+
+    ids = dict(existing)
+    ids.update({values['rbm_id']: values['id'] for values in inserts})
+    return ids
+
+
+class RateLimiter:
+    ''' Spaces out work to at most rate items a second
+
+    :param float rate: items per second, None for no limit
+    '''
+
+    def __init__(self, rate=None):
+        self.interval = 1 / rate if rate else 0
+        self.next_at = time.monotonic()
+
+    def wait(self, items=1):
+        now = time.monotonic()
+        if self.next_at > now:
+            time.sleep(self.next_at - now)
+        self.next_at = max(self.next_at, now) + items * self.interval
+
+
+def dispatch_records(sends, rate_limiter, chunk_size):
+    ''' Send records to their endpoints, chunk_size at a time
+
+    :param list sends: (source, source_type, msg_id, message_type) as for
+        tasks.dispatch_grouped
+    :param RateLimiter rate_limiter: limits the records sent a second
+    :param int chunk_size: records per dispatch
+    :return: number of failed deliveries
+    :rtype: int
+    '''
+    failed = 0
+    for start in range(0, len(sends), chunk_size):
+        chunk = sends[start:start + chunk_size]
+        rate_limiter.wait(len(chunk))
+        results = tasks.dispatch_grouped(chunk)
+        failed += sum(result['status'] != 'sent' for result in results)
+    return failed
+
+
+class Checkpoint:
+    ''' Progress of a run, saved as JSON after each batch.
+
+    :param str path: checkpoint file, None to keep no checkpoint
+    :param dict filters: the run's filters, JSON serializable
+    '''
+
+    def __init__(self, path, filters):
+        self.path = path
+        self.filters = filters
+        self.state = {'filters': filters, 'last_id': 0, 'parsed': 0,
+                      'upserted': 0, 'errors': 0, 'skipped': 0,
+                      'failed_sends': 0}
+
+    def load(self):
+        ''' Resume from the checkpoint file, if there is one.
+
+        :raises ValueError: if it was saved by a run with other filters
+        '''
+        if not self.path or not os.path.exists(self.path):
+            return
+        with open(self.path) as f:
+            state = json.load(f)
+        if state.get('filters') != self.filters:
+            raise ValueError(f"Checkpoint {self.path} is for another run: "
+                             f"{state.get('filters')}")
+        self.state.update(state)
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = f"{self.path}.tmp"
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+
+def reprocess(filters, batch_size=1000, workers=None, dispatch=False,
+              rate=None, checkpoint=None, progress=None):
+    ''' Reparse stored messages and upsert their records, see the module.
+
+    :param dict filters: see select_messages, since and until as ISO 8601
+        strings
+    :param int batch_size: messages per batch and database transaction
+    :param int workers: parsing processes, the number of CPUs by default,
+        1 to parse in this process
+    :param bool dispatch: send the records on to their endpoints
+    :param float rate: most records dispatched a second, None for no limit
+    :param str checkpoint: checkpoint file path
+    :param progress: called with the state after each batch
+    :return: counts of the run, and of any run it resumed
+    :rtype: dict
+    '''
+    saved = Checkpoint(checkpoint, filters)
+    saved.load()
+    state = saved.state
+    query_filters = dict(filters)
+    for name in ['since', 'until']:
+        if filters.get(name):
+            query_filters[name] = datetime.fromisoformat(filters[name])
+
+    msg_types = filters.get('msg_types') or list(BUILDERS)
+    rate_limiter = RateLimiter(rate)
+    pool = ProcessPoolExecutor(workers) if workers != 1 else None
+    try:
+        while True:
+            rows = [row._asdict() for row in select_messages(
+                query_filters, state['last_id']).limit(batch_size)]
+            if not rows:
+                return state
+
+            messages = [{column: row[column] for column in COLUMNS}
+                        for row in rows]
+            if pool is None:
+                parsed = map(parse_message, messages)
+            else:
+                parsed = pool.map(parse_message, messages,
+                                  chunksize=max(1, batch_size // 64))
+
+            by_type = {}
+            for rbm_id, msg_type, values, error in parsed:
+                if msg_type is None or msg_type not in msg_types:
+                    state['skipped'] += 1
+                elif error:
+                    state['errors'] += 1
+                    app.logger.warning(f"Reprocessing {rbm_id} failed: "
+                                       f"{error}")
+                else:
+                    by_type.setdefault(msg_type, {})[rbm_id] = values
+
+            record_ids = {}
+            try:
+                for msg_type, records in by_type.items():
+                    record_ids[msg_type] = upsert_records(msg_type, records)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                raise e
+
+            if dispatch:
+                state['failed_sends'] += dispatch_records(
+                    dispatch_list(rows, record_ids), rate_limiter,
+                    batch_size if rate is None else max(1, int(rate)))
+
+            state['parsed'] += len(rows)
+            state['upserted'] += sum(len(r) for r in record_ids.values())
+            state['last_id'] = rows[-1]['id']
+            saved.save()
+            if progress:
+                progress(state)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+
+def dispatch_list(rows, record_ids):
+    ''' Records to send for a batch, from messages with a known modem '''
+    sends = []
+    for row in rows:
+        msg_type = row['msg_type'] or payload_msg_type(row['data'])
+        record_id = record_ids.get(msg_type, {}).get(row['id'])
+        if record_id is None or row['rb_id'] is None:
+            continue
+        source_type = tasks.fused_router[msg_type][1] or row['device_type']
+        sends.append((row['rb_id'], source_type, record_id,
+                      tasks.fused_router[msg_type][2]))
+    return sends
@@ -1,6 +1,7 @@
 """
 Helper functions for route validation
 """
+from collections import defaultdict
 from sqlalchemy import (
     or_,
     and_,
@@ -69,6 +70,12 @@ def confirm_modem_device(modems_q, dev_id, dev_type, dev_label):
     if not dev:
         return errors
 
+    return errors + check_modem_device(dev, dev_id, dev_type, dev_label)
+
+
+def check_modem_device(dev, dev_id, dev_type, dev_label):
+    errors = []
+
     if dev_label != dev.serial:
         errors.append(f"Wrong label for modem ID: {dev_id} -> {dev_label}")
 
@@ -94,6 +101,12 @@ def confirm_queue(queues_q, queue_id, queue_type, queue_label):
     if not queue:
         return errors
 
+    return errors + check_queue(queue, queue_id, queue_label)
+
+
+def check_queue(queue, queue_id, queue_label):
+    errors = []
+
     if queue_label != queue.queue_name:
         errors.append(f"Wrong label for Queue ID: {queue_id} -> {queue_label}")
 
@@ -138,6 +151,123 @@ def check_duplicate_route(route_q, src_dev_type, src_dev_id, src_msg_type, tgt_d
     return errors
 
 
+#: Fields of the source and target of a route
+ROUTE_FIELDS = {
+    'source': ['type', 'id', 'label', 'msg'],
+    'target': ['type', 'id', 'label'],
+}
+
+
+def route_key(data):
+    ''' (source type, source id, msg type, target type, target id) of route
+    data, the columns which make a route a duplicate
+    '''
+    return (data['source']['type'], int(data['source']['id']),
+            data['source']['msg'], data['target']['type'],
+            int(data['target']['id']))
+
+
+def check_route_fields(data):
+    errors = []
+    if not isinstance(data, dict):
+        return ["Route is not an object"]
+    for part, fields in ROUTE_FIELDS.items():
+        if not isinstance(data.get(part), dict):
+            errors.append(f"No {part} given")
+            continue
+        for field in fields:
+            if data[part].get(field) is None:
+                errors.append(f"No {part} {field} given")
+    if errors:
+        return errors
+    try:
+        route_key(data)
+    except (TypeError, ValueError):
+        errors.append("Source and target id must be integers")
+    return errors
+
+
+def check_routes(routes):
+    ''' Validate many routes as check_route does, with one query for each of
+    modems, queues and existing routes, whatever the number of routes.  A
+    route is also a duplicate of an earlier one in routes.
+
+    :param list routes: route data, as given to check_route
+    :return: errors of each route, in order
+    :rtype: list
+    '''
+    errors = [check_route_fields(data) for data in routes]
+    valid = [(data, errs) for data, errs in zip(routes, errors) if not errs]
+
+    ids = defaultdict(set)
+    for data, errs in valid:
+        source_type, source_id, msg, target_type, target_id = route_key(data)
+        ids[source_type].add(source_id)
+        ids[target_type].add(target_id)
+
+    modem_ids = ids['buoy'] | ids['handset']
+    modems = {}
+    if modem_ids:
+        modems = {m.id: m for m in db.session.query(md.RockBlockModem).
+                  filter(md.RockBlockModem.id.in_(modem_ids))}
+    queues = {}
+    if ids['sqs']:
+        queues = {q.id: q for q in db.session.query(md.SQS_Endpoint).
+                  filter(md.SQS_Endpoint.id.in_(ids['sqs']))}
+
+    existing = defaultdict(list)
+    sources = {route_key(data)[1] for data, errs in valid}
+    if sources:
+        rt = md.EndpointRoute
+        query = db.session.query(rt).filter(rt.source_device.in_(sources))
+        for route in query:
+            existing[(route.source_device_type, route.source_device,
+                      route.msg_type, route.endpoint_type,
+                      route.endpoint_id)].append(route.id)
+
+    seen = {}
+    for index, (data, errs) in enumerate(zip(routes, errors)):
+        if errs:
+            continue
+        source_type, source_id, msg, target_type, target_id = key = \
+            route_key(data)
+
+        if source_type in ['handset', 'buoy']:
+            if source_id in modems:
+                errs.extend(check_modem_device(
+                    modems[source_id], source_id, source_type,
+                    data['source']['label']))
+            else:
+                errs.append(f"No Source ID: {source_id}")
+
+        if target_type in ['handset', 'buoy']:
+            if target_id in modems:
+                errs.extend(check_modem_device(
+                    modems[target_id], target_id, target_type,
+                    data['target']['label']))
+            else:
+                errs.append(f"No Source ID: {target_id}")
+
+        if target_type == 'sqs':
+            if target_id in queues:
+                errs.extend(check_queue(queues[target_id], target_id,
+                                        data['target']['label']))
+            else:
+                errs.append(f"No Queue ID: {target_id}")
+
+        errs.extend(confirm_pairing(source_type, msg, target_type))
+
+        if existing[key]:
+            found = ", ".join(f"{rid}" for rid in existing[key])
+            errs.append(f"Duplicate routes found: {found}")
+        if key in seen:
+            errs.append(f"Duplicate of route {seen[key]}")
+        else:
+            seen[key] = index
+
+    return errors
+
+
 def check_route_for_participant(route_q, p_type, p_id):
     ''' When modifying the system links, they should not exist in a route.
     The route should be removed first
@@ -150,7 +280,7 @@ def check_route_for_participant(route_q, p_type, p_id):
             and_(
                 md.EndpointRoute.endpoint_type == p_type,
                 md.EndpointRoute.endpoint_id == p_id)
-        )).all()
+        )).order_by(md.EndpointRoute.id).all()
 
     if routes:
         rids = ", ".join(f"{r.id}" for r in routes)
@@ -21,6 +21,51 @@ class Config:
     CELERY_BROKER_URL = 'amqp://localhost:5672/'
     FIRMWARE_BASE = os.path.join(PROJECT_ROOT, "../firmware")
     FIRMWARE_REPO = ""
+    SPOOL_ENABLED = False
+    SPOOL_DIR = None
+    SPOOL_SEGMENT_BYTES = 4 * 1024 * 1024
+    SPOOL_SEGMENT_SECONDS = 60
+    SPOOL_GROUP_COMMIT_WAIT = 0.002
+    SPOOL_DRAIN_BATCH = 500
+    SPOOL_DRAIN_INTERVAL = 0.5
+    DEDUP_BLOOM_CAPACITY = 100000
+    DEDUP_BLOOM_ERROR_RATE = 0.001
+    RAW_MESSAGES_PAGE_SIZE = 100
+    PIPELINE_MODE = 'staged'
+    MODEM_CACHE_SIZE = 1024
+    CACHE_CHECK_SECONDS = 5
+    RBM_BATCH_SIZE = 500
+    ENDPOINT_SEND_WORKERS = 16
+    ENDPOINT_SEND_TIMEOUT = 10
+    RAW_MESSAGES_MAX_PAGE = 1000
+    INGEST_ASYNC_DATABASE_URI = None
+    INGEST_DB_POOL_SIZE = 20
+    INGEST_DB_MAX_OVERFLOW = 80
+    INGEST_BROKER_THREADS = 16
+    INGEST_MAX_BODY = 64 * 1024
+    OUTBOX_ENABLED = False
+    OUTBOX_BATCH_SIZE = 200
+    OUTBOX_MAX_ATTEMPTS = 8
+    OUTBOX_BACKOFF_BASE = 30
+    OUTBOX_BACKOFF_MAX = 3600
+    OUTBOX_LEASE_SECONDS = 300
+    OUTBOX_KICK_DELAY = 1.0
+    SQS_BATCH_SEND = True
+    HTTP_POOL_SIZE = 10
+    HTTP_MAX_PER_HOST = 8
+    HTTP_CONNECT_TIMEOUT = 5
+    HTTP_READ_TIMEOUT = 30
+    COMMAND_COALESCE_SECONDS = 0
+    LANE_LATENCY_WARN_SECONDS = {
+        'commands': 5,
+        'telemetry': 60,
+        'delivery': 60,
+    }
+    STAGE_TIMING_ENABLED = False
+    STAGE_LATENCY_MAX_MESSAGES = 10000
+    ERROR_RETRY_BATCH_SIZE = 100
+    ERROR_RETRY_MAX = 1000
+    ROUTE_BULK_MAX = 1000
 
 
 class TestConfig(Config):
@@ -33,3 +78,11 @@ class ProdConfig(Config):
     SQLALCHEMY_DATABASE_URI = os.environ.get('PAIKEA_DB_URI')
     FIRMWARE_REPO = os.environ.get('PAIKEA_FIRMWARE_REPO')
     FIRMWARE_BASE = os.environ.get('PAIKEA_FIRMWARE_BASE')
+    SPOOL_ENABLED = os.environ.get('PAIKEA_SPOOL_ENABLED') == '1'
+    SPOOL_DIR = os.environ.get('PAIKEA_SPOOL_DIR')
+    INGEST_ASYNC_DATABASE_URI = os.environ.get('PAIKEA_ASYNC_DB_URI')
+    PIPELINE_MODE = os.environ.get('PAIKEA_PIPELINE_MODE', 'staged')
+    OUTBOX_ENABLED = os.environ.get('PAIKEA_OUTBOX_ENABLED') == '1'
+    COMMAND_COALESCE_SECONDS = float(
+        os.environ.get('PAIKEA_COMMAND_COALESCE_SECONDS', 0))
+    STAGE_TIMING_ENABLED = os.environ.get('PAIKEA_STAGE_TIMING') == '1'
@@ -0,0 +1,164 @@
+"""
+Dry runs of the routing of a message.
+
+simulate takes a stored RockBlockMessage, or a raw hex payload as if it had
+been pushed by a modem, and runs it through parsing, the route table and the
+formatters as process_rbm would, but sends nothing.  The records built along
+the way are flushed so the formatters can load them, and the session is
+rolled back at the end, so a simulation leaves no trace in the database.
+
+The time spent in each stage is returned in milliseconds, along with each
+formatted payload and its size.  Payloads to a RockBlock modem are hex
+encoded, and cost one Iridium credit per IRIDIUM_CREDIT_BYTES bytes sent.
+"""
+import math
+import time
+import binascii
+from datetime import datetime, timezone
+from paikea.extensions import db
+import paikea.models as md
+from paikea.cache import (
+    lookup_modem,
+    get_route_table,
+)
+from paikea.formatters import (
+    FormatContext,
+    formatter_router,
+)
+from paikea.paikea_protocol import payload_msg_type
+from paikea.tasks import build_record
+
+
+#: Bytes of MT payload per Iridium credit
+IRIDIUM_CREDIT_BYTES = 50
+
+#: Endpoint types reached through the RockBlock API
+ROCKBLOCK_ENDPOINTS = {'buoy', 'handset'}
+
+
+class SimulationError(Exception):
+    ''' The message could not be simulated, e.g. its modem is unknown '''
+
+
+def elapsed_ms(start):
+    return round((time.perf_counter() - start) * 1000, 3)
+
+
+def payload_size(payload, endpoint_type):
+    ''' Bytes of a formatted payload as sent to an endpoint, and the Iridium
+    credits it costs, None for endpoints other than modems
+
+    :rtype: tuple
+    '''
+    if payload is None:
+        return 0, None
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    if endpoint_type not in ROCKBLOCK_ENDPOINTS:
+        return len(payload), None
+    try:
+        size = len(binascii.unhexlify(payload))
+    except (binascii.Error, ValueError):
+        # PK004_to_Handset formats its payload without hex encoding
+        size = len(payload)
+    return size, max(1, math.ceil(size / IRIDIUM_CREDIT_BYTES))
+
+
+def payload_message(payload, imei):
+    ''' A RockBlockMessage for a hex payload from the modem with an imei,
+    received now.  Not added to the session.
+
+    :raises SimulationError: if there is no modem with the imei
+    '''
+    modem = db.session.query(md.RockBlockModem).filter_by(imei=imei).first()
+    if modem is None:
+        raise SimulationError(f"No RockBlockModem with imei: {imei}")
+    now = datetime.now(timezone.utc)
+    return md.RockBlockMessage(
+        imei=imei,
+        device_type=modem.modem_type,
+        serial=modem.serial,
+        transmit_time=now.strftime("%y-%m-%d %H:%M:%S"),
+        iridium_latitude='0',
+        iridium_longitude='0',
+        iridium_cep='0',
+        data=payload,
+        rb_id=modem.id)
+
+
+def simulate(rbm_id=None, payload=None, imei=None):
+    ''' Parse, route and format a message without sending it.  The session
+    is rolled back before returning.
+
+    :param int rbm_id: id of a stored RockBlockMessage
+    :param str payload: hex payload, instead of rbm_id
+    :param str imei: imei of the modem sending payload
+    :return: msg_type, the source, timings of the parse, route and format
+        stages in ms, and per endpoint the route, payload, bytes, credits and
+        format time
+    :rtype: dict
+    :raises SimulationError: if the message can not be simulated
+    '''
+    try:
+        if rbm_id is not None:
+            rbm = db.session.query(md.RockBlockMessage).\
+                filter_by(id=rbm_id).first()
+            if rbm is None:
+                raise SimulationError(f"No RockBlockMessage: {rbm_id}")
+        elif payload and imei:
+            rbm = payload_message(payload, imei)
+            db.session.add(rbm)
+            db.session.flush()
+        else:
+            raise SimulationError("Give an rbm_id, or a payload and imei")
+
+        modem = lookup_modem(rbm.imei)
+        if modem is None:
+            raise SimulationError(f"No RockBlockModem with imei: {rbm.imei}")
+
+        start = time.perf_counter()
+        record, source_type, message_type, error = build_record(rbm)
+        timings = {'parse': elapsed_ms(start)}
+        if error:
+            raise SimulationError(error)
+        source_type = source_type or modem.device_type
+        db.session.add(record)
+        db.session.flush()
+
+        start = time.perf_counter()
+        routes = get_route_table().lookup(source_type, modem.id,
+                                          message_type)
+        timings['route'] = elapsed_ms(start)
+
+        endpoints = []
+        context = FormatContext(record, rbm)
+        format_start = time.perf_counter()
+        for route in routes:
+            start = time.perf_counter()
+            formatter = formatter_router(message_type, route.endpoint_type)
+            if formatter is None:
+                endpoints.append({'route': route.id,
+                                  'endpoint_type': route.endpoint_type,
+                                  'endpoint_id': route.endpoint_id,
+                                  'error': "No formatter"})
+                continue
+            f_msg = formatter(context)
+            size, credits = payload_size(f_msg, route.endpoint_type)
+            if isinstance(f_msg, bytes):
+                f_msg = f_msg.decode('ascii', errors='replace')
+            endpoints.append({'route': route.id,
+                              'endpoint_type': route.endpoint_type,
+                              'endpoint_id': route.endpoint_id,
+                              'payload': f_msg,
+                              'bytes': size,
+                              'credits': credits,
+                              'format_ms': elapsed_ms(start)})
+        timings['format'] = elapsed_ms(format_start)
+
+        return {'msg_type': rbm.msg_type or payload_msg_type(rbm.data),
+                'message_type': message_type,
+                'source': {'type': source_type, 'id': modem.id},
+                'timings': timings,
+                'endpoints': endpoints}
+    finally:
+        db.session.rollback()
@@ -0,0 +1,371 @@
+"""
+Write-ahead spool for incoming RockBlock pushes.
+
+RockBlock re-pushes a message until it receives a 200, so the incoming view
+should acknowledge as soon as the message is durable rather than after the
+database and broker have caught up.  When SPOOL_ENABLED is set, the view
+appends the raw request body to a segment log under SPOOL_DIR and returns.
+The spool drainer (``flask spool drain``) group-commits the spooled messages
+into RockBlockMessage/RBMessageStatus and queues them for processing.
+
+Each web process appends to its own segment, ``<ns>-<pid>.open``, which is
+sealed by renaming to ``.seg`` once it grows past SPOOL_SEGMENT_BYTES or
+SPOOL_SEGMENT_SECONDS.  A record is a 4 byte length, 4 byte crc32 and the raw
+body.  Appenders wait for an fsync, but a single fsync covers every record
+written while the previous one was in flight.  The spool directory is fsynced
+whenever a segment is created, renamed or removed, so the entry of an
+acknowledged record survives a power loss along with its data.
+
+A writer holds an exclusive flock on its open segment until sealing it.  The
+kernel releases the lock when the writer dies, so the drainer seals an open
+segment only once it can take the lock itself.  Unlike probing pids, this
+holds when the drainer runs in another pid namespace or container.
+
+The drainer keeps the offset of the last committed record for a segment in a
+``.ack`` file, so unacknowledged records are replayed after a restart.  Fully
+acknowledged sealed segments are deleted.
+"""
+import os
+import time
+import fcntl
+import struct
+import zlib
+import atexit
+import threading
+from flask import current_app as app
+from paikea.ingest import ingest_rockblock_batch
+from paikea.utils import parse_push
+import paikea.tasks as tasks
+
+
+HEADER = struct.Struct(">II")
+OPEN_SUFFIX = ".open"
+SEALED_SUFFIX = ".seg"
+ACK_SUFFIX = ".ack"
+#: A segment being created, renamed to .open once its writer holds the lock
+NEW_SUFFIX = ".new"
+
+
+def fsync_dir(directory):
+    ''' Fsync a directory, making the creation, renaming or removal of its
+    entries durable
+    '''
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _ack_path(path):
+    stem = path
+    for suffix in (OPEN_SUFFIX, SEALED_SUFFIX):
+        if stem.endswith(suffix):
+            stem = stem[:-len(suffix)]
+    return stem + ACK_SUFFIX
+
+
+def encode_record(body):
+    ''' Frame a raw request body as a spool record '''
+    return HEADER.pack(len(body), zlib.crc32(body)) + body
+
+
+def read_records(path, offset=0):
+    ''' Read complete records from a segment.  A torn or corrupt record ends
+    the read, as it was never acknowledged to the sender.
+
+    :param str path: path to the segment
+    :param int offset: byte offset to start reading from
+    :return: list of (body, offset after the record)
+    :rtype: list
+    '''
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        buf = f.read()
+
+    records = []
+    pos = 0
+    while pos + HEADER.size <= len(buf):
+        size, crc = HEADER.unpack_from(buf, pos)
+        start = pos + HEADER.size
+        body = buf[start:start + size]
+        if len(body) < size or zlib.crc32(body) != crc:
+            break
+        pos = start + size
+        records.append((body, offset + pos))
+
+    return records
+
+
+class Spool:
+    ''' Append-only segment log for one process.
+
+    :param str directory: directory holding the segments
+    :param int segment_bytes: seal a segment once it reaches this size
+    :param float segment_seconds: seal a segment once it is this old
+    :param float group_commit_wait: seconds an fsync waits for more records
+    '''
+
+    def __init__(self, directory, segment_bytes=4 * 1024 * 1024,
+                 segment_seconds=60, group_commit_wait=0.002):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.group_commit_wait = group_commit_wait
+        self.pid = os.getpid()
+        os.makedirs(directory, exist_ok=True)
+
+        self._cond = threading.Condition()
+        self._fd = None
+        self._path = None
+        self._opened_at = 0
+        self._size = 0
+        self._written = 0
+        self._synced = 0
+        self._syncing = False
+
+    def append(self, body):
+        ''' Append a raw request body and return once it has been fsynced.
+
+        :param bytes body: raw request body
+        '''
+        record = encode_record(body)
+        with self._cond:
+            self._roll_if_needed()
+            os.write(self._fd, record)
+            self._size += len(record)
+            self._written += 1
+            ticket = self._written
+
+            while self._synced < ticket:
+                if self._syncing:
+                    self._cond.wait()
+                    continue
+
+                self._syncing = True
+                try:
+                    self._cond.release()
+                    try:
+                        time.sleep(self.group_commit_wait)
+                    finally:
+                        self._cond.acquire()
+                    fd, target = self._fd, self._written
+                    self._cond.release()
+                    try:
+                        os.fsync(fd)
+                    finally:
+                        self._cond.acquire()
+                    self._synced = max(self._synced, target)
+                finally:
+                    self._syncing = False
+                    self._cond.notify_all()
+
+    def seal(self):
+        ''' Fsync, close and seal the current segment, if any '''
+        with self._cond:
+            while self._syncing:
+                self._cond.wait()
+            self._seal()
+
+    def _seal(self):
+        if self._fd is None:
+            return
+        os.fsync(self._fd)
+        # renamed while still locked, so the drainer never seals it too
+        os.rename(self._path,
+                  self._path[:-len(OPEN_SUFFIX)] + SEALED_SUFFIX)
+        fsync_dir(self.directory)
+        os.close(self._fd)
+        self._synced = self._written
+        self._fd = None
+        self._path = None
+
+    def _roll_if_needed(self):
+        if self._fd is not None:
+            age = time.monotonic() - self._opened_at
+            if self._size < self.segment_bytes and \
+                    age < self.segment_seconds:
+                return
+            while self._syncing:
+                self._cond.wait()
+            self._seal()
+
+        while True:
+            stem = os.path.join(self.directory,
+                                f"{time.time_ns():020d}-{os.getpid()}")
+            fd = os.open(stem + NEW_SUFFIX,
+                         os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                os.rename(stem + NEW_SUFFIX, stem + OPEN_SUFFIX)
+            except FileNotFoundError:
+                # removed by a drainer before it was locked, try another
+                os.close(fd)
+                continue
+            except Exception:
+                os.close(fd)
+                raise
+            break
+        fsync_dir(self.directory)
+        self._fd = fd
+        self._path = stem + OPEN_SUFFIX
+        self._opened_at = time.monotonic()
+        self._size = 0
+
+
+def spool_dir():
+    ''' Spool directory from the app config, defaulting to the instance dir'''
+    return app.config.get('SPOOL_DIR') or \
+        os.path.join(app.instance_path, 'spool')
+
+
+def get_spool():
+    ''' The Spool for this process, created on first use '''
+    spool = app.extensions.get('paikea_spool')
+    if spool is None or spool.pid != os.getpid():
+        spool = Spool(spool_dir(),
+                      segment_bytes=app.config['SPOOL_SEGMENT_BYTES'],
+                      segment_seconds=app.config['SPOOL_SEGMENT_SECONDS'],
+                      group_commit_wait=app.config['SPOOL_GROUP_COMMIT_WAIT'])
+        atexit.register(spool.seal)
+        app.extensions['paikea_spool'] = spool
+    return spool
+
+
+def seal_abandoned(path):
+    ''' Seal an open segment if its writer no longer holds its lock.  A new
+    segment left by a writer which died before locking it holds no records,
+    and is removed.
+
+    :param str path: path to an open or new segment
+    :return: path of the sealed segment, None if it is still being written
+        or was removed
+    :rtype: str
+    '''
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        # renamed by its writer since the listing
+        return None
+    try:
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        if path.endswith(NEW_SUFFIX):
+            os.remove(path)
+            sealed = None
+        else:
+            sealed = path[:-len(OPEN_SUFFIX)] + SEALED_SUFFIX
+            os.rename(path, sealed)
+        fsync_dir(os.path.dirname(path))
+        return sealed
+    finally:
+        os.close(fd)
+
+
+def read_ack(path):
+    ''' Offset of the last committed record of a segment '''
+    try:
+        with open(_ack_path(path)) as f:
+            return int(f.read() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def write_ack(path, offset):
+    ''' Durably record the offset of the last committed record '''
+    ack = _ack_path(path)
+    with open(ack + ".tmp", 'w') as f:
+        f.write(str(offset))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(ack + ".tmp", ack)
+    fsync_dir(os.path.dirname(ack))
+
+
+def segments(directory):
+    ''' Segments in write order.  Open segments whose writer has died, and
+    released its lock, are sealed as nothing will append to them again.
+
+    :return: list of (path, sealed)
+    :rtype: list
+    '''
+    out = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if name.endswith(SEALED_SUFFIX):
+            out.append((path, True))
+        elif name.endswith(OPEN_SUFFIX):
+            sealed = seal_abandoned(path)
+            if sealed:
+                out.append((sealed, True))
+            else:
+                out.append((path, False))
+        elif name.endswith(NEW_SUFFIX):
+            seal_abandoned(path)
+    return out
+
+
+def drain_segment(path, sealed, batch_size):
+    ''' Commit the unacknowledged records of one segment in batches.
+
+    :param str path: segment path
+    :param bool sealed: the segment will not be appended to again
+    :param int batch_size: records per database transaction
+    :return: number of records drained
+    :rtype: int
+    '''
+    offset = read_ack(path)
+    try:
+        records = read_records(path, offset)
+    except FileNotFoundError:
+        # sealed by its writer since the listing, drained on the next pass
+        return 0
+    drained = 0
+
+    for start in range(0, len(records), batch_size):
+        batch = records[start:start + batch_size]
+        data = []
+        for body, end in batch:
+            try:
+                msg = parse_push(body)
+            except Exception as e:
+                app.logger.error(f"Spooled message unreadable: {body}")
+                tasks.on_parsing_error(
+                    "Spool", f"{os.path.basename(path)}:{end}", f"{e}")
+                continue
+            data.append(msg)
+
+        if data:
+            ingest_rockblock_batch(data)
+        write_ack(path, batch[-1][1])
+        drained += len(batch)
+
+    # anything past the last complete record of a sealed segment is a torn
+    # write which was never acknowledged
+    if sealed:
+        os.remove(path)
+        if os.path.exists(_ack_path(path)):
+            os.remove(_ack_path(path))
+        fsync_dir(os.path.dirname(path))
+
+    return drained
+
+
+def drain(directory, batch_size=500):
+    ''' Drain every segment in the spool, oldest first.  Run at drainer
+    startup this replays anything left unacknowledged by a previous run.
+
+    :param str directory: spool directory
+    :param int batch_size: records per database transaction
+    :return: number of records drained
+    :rtype: int
+    '''
+    if not os.path.isdir(directory):
+        return 0
+
+    drained = 0
+    for path, sealed in segments(directory):
+        drained += drain_segment(path, sealed, batch_size)
+    return drained
@@ -0,0 +1,94 @@
+"""
+Helpers for AWS SQS endpoints.
+
+Sends go through one boto3 SQS client per process, created on first use and
+shared by the threads of the process, with each call naming its queue by
+QueueUrl.  Credentials are read and an HTTP pool is made once rather than
+for every send, and as nothing is kept per queue, a changed or deleted
+SQS_Endpoint row needs no invalidation.  boto3 clients are thread safe,
+unlike resources and their Queue objects, so the thread pool of
+send_concurrently can share the client.
+
+send_message_batch takes up to SQS_BATCH_MAX_ENTRIES messages totalling
+SQS_BATCH_MAX_BYTES, so a batch of deliveries to one queue costs a tenth of
+the requests of sending each message on its own.
+"""
+import os
+import threading
+import boto3
+
+
+_sqs_client = None
+_sqs_client_pid = None
+_sqs_client_lock = threading.Lock()
+
+
+def get_sqs_client():
+    ''' The boto3 SQS client of this process, created on first use.  A
+    forked worker makes its own, so no HTTP connection is shared with its
+    parent.
+    '''
+    global _sqs_client, _sqs_client_pid
+    client = _sqs_client
+    if client is None or _sqs_client_pid != os.getpid():
+        with _sqs_client_lock:
+            if _sqs_client is None or _sqs_client_pid != os.getpid():
+                _sqs_client = boto3.session.Session().client('sqs')
+                _sqs_client_pid = os.getpid()
+            client = _sqs_client
+    return client
+
+
+def clear_sqs_client():
+    ''' Drop the client of this process, the next send creates a new one '''
+    global _sqs_client, _sqs_client_pid
+    with _sqs_client_lock:
+        _sqs_client = None
+        _sqs_client_pid = None
+
+
+#: send_message_batch limits
+SQS_BATCH_MAX_ENTRIES = 10
+SQS_BATCH_MAX_BYTES = 256 * 1024
+
+
+def sqs_message(msg, idempotency_key=None):
+    ''' Arguments of an SQS send_message call, or batch entry, for a
+    formatted message
+    '''
+    message = {'MessageBody': msg}
+    if idempotency_key:
+        message['MessageAttributes'] = {
+            'IdempotencyKey': {'DataType': 'String',
+                               'StringValue': idempotency_key}}
+    return message
+
+
+def _sqs_size(msg, idempotency_key):
+    size = len(msg.encode('utf-8'))
+    if idempotency_key:
+        size += len('IdempotencyKey') + len('String') + \
+            len(idempotency_key.encode('utf-8'))
+    return size
+
+
+def sqs_batches(msgs):
+    ''' Split messages into send_message_batch sized batches.
+
+    :param list msgs: (formatted message, idempotency key or None)
+    :return: lists of (index in msgs, message, idempotency key)
+    :rtype: generator
+    '''
+    batch = []
+    batch_bytes = 0
+    for index, (msg, key) in enumerate(msgs):
+        size = _sqs_size(msg, key)
+        if batch and (len(batch) == SQS_BATCH_MAX_ENTRIES or
+                      batch_bytes + size > SQS_BATCH_MAX_BYTES):
+            yield batch
+            batch = []
+            batch_bytes = 0
+        batch.append((index, msg, key))
+        batch_bytes += size
+    if batch:
+        yield batch
@@ -0,0 +1,203 @@
+"""
+Per-message pipeline stage timing.
+
+With STAGE_TIMING_ENABLED, each RockBlockMessage gets a MessageStage row as
+it reaches each stage of the pipeline:
+
+    received    the push arrived at the ingest view
+    committed   the message was about to be committed
+    started     a task claimed it for processing
+    parsed      its payload was parsed into a PK record or command
+    formatted   the record was formatted for its endpoints
+    sent        an endpoint accepted it, one row per endpoint
+
+so slow delivery can be put down to ingest, broker wait, parsing or the
+outbound API.  Stage times are seconds since the epoch rather than a
+monotonic clock, as the stages of a message are timed by different
+processes, and often different hosts.
+
+Rows are added to the caller's transaction, and the latency percentiles of
+each stage over a window come from latency.
+"""
+import time
+from collections import defaultdict
+from datetime import timezone
+from flask import current_app as app
+from paikea.extensions import db
+import paikea.models as md
+
+
+STAGES = ('received', 'committed', 'started', 'parsed', 'formatted', 'sent')
+
+
+def enabled():
+    return app.config['STAGE_TIMING_ENABLED']
+
+
+def stage_rows(rbm_ids, stage, at=None, endpoint=None):
+    ''' MessageStage mappings of messages reaching a stage
+
+    :param list rbm_ids: RockBlockMessage ids
+    :param str stage: one of STAGES
+    :param float at: epoch seconds, now by default
+    :param str endpoint: for a sent stage, endpoint_type:id
+    :rtype: list
+    '''
+    if stage not in STAGES:
+        raise ValueError(f"Unknown stage: {stage}")
+    at = at or time.time()
+    return [{'rbm_id': rbm_id, 'stage': stage, 'endpoint': endpoint,
+             'at': at} for rbm_id in rbm_ids]
+
+
+def add_stages(rbm_ids, stage, at=None, endpoint=None):
+    ''' With STAGE_TIMING_ENABLED, insert stage rows in the current
+    transaction.  Not committed.  See stage_rows for the parameters.
+    '''
+    if not rbm_ids or not enabled():
+        return
+    db.session.bulk_insert_mappings(
+        md.MessageStage, stage_rows(rbm_ids, stage, at, endpoint))
+
+
+def source_rbm_ids(msg_type, msg_ids):
+    ''' RockBlockMessage ids of the records sent to endpoints
+
+    :param str msg_type: pk001, pk004 or command
+    :param list msg_ids: ids of the records
+    :return: {msg_id: rbm_id}
+    :rtype: dict
+    '''
+    if msg_type == 'pk001':
+        query = db.session.query(md.PK001.id, md.PK001.rbm_id).\
+            filter(md.PK001.id.in_(msg_ids))
+    elif msg_type == 'pk004':
+        query = db.session.query(md.PK004.id, md.PK004.rbm_id).\
+            filter(md.PK004.id.in_(msg_ids))
+    elif msg_type == 'command':
+        query = db.session.query(
+            md.DeviceCommandMessage.id,
+            md.DeviceCommandMessage.source_msg_id).filter(
+                md.DeviceCommandMessage.id.in_(msg_ids),
+                md.DeviceCommandMessage.source_msg_type == 'handset')
+    else:
+        return {}
+    return {msg_id: rbm_id for msg_id, rbm_id in query if rbm_id}
+
+
+def record_deliveries(results, formatted_at, sent_at):
+    ''' With STAGE_TIMING_ENABLED, record the formatted stage of delivered
+    messages and a sent stage per endpoint which accepted them, in the
+    current transaction.  Not committed, the callers commit them with the
+    results of the sends.
+
+    :param list results: delivery results, see tasks.send_concurrently
+    :param float formatted_at: epoch seconds the messages were formatted
+    :param list sent_at: epoch seconds each send finished, in the order of
+        results, None if it did not
+    '''
+    if not results or not enabled():
+        return
+
+    msg_ids = defaultdict(set)
+    for result in results:
+        msg_ids[result['msg_type']].update(
+            [result['msg_id']] + result.get('merged', []))
+    rbm_ids = {}
+    for msg_type, ids in msg_ids.items():
+        for msg_id, rbm_id in source_rbm_ids(msg_type, ids).items():
+            rbm_ids[(msg_type, msg_id)] = rbm_id
+
+    sent = []
+    formatted = set()
+    for result, at in zip(results, sent_at):
+        sources = [rbm_ids.get((result['msg_type'], msg_id)) for msg_id in
+                   [result['msg_id']] + result.get('merged', [])]
+        sources = [rbm_id for rbm_id in sources if rbm_id]
+        formatted.update(sources)
+        if result['status'] == 'sent' and at:
+            sent.extend(stage_rows(
+                sources, 'sent', at,
+                f"{result['endpoint_type']}:{result['endpoint_id']}"))
+    rows = stage_rows(sorted(formatted), 'formatted', formatted_at) + sent
+
+    db.session.bulk_insert_mappings(md.MessageStage, rows)
+
+
+def epoch(dt):
+    ''' Epoch seconds of a datetime, naive datetimes being UTC '''
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
+
+
+def percentile(values, p):
+    ''' Nearest rank percentile of sorted values '''
+    return values[int(round(p * (len(values) - 1)))]
+
+
+def summary(seconds):
+    ''' Count and p50/p95/p99 in milliseconds of stage latencies '''
+    seconds = sorted(seconds)
+    result = {'count': len(seconds)}
+    if seconds:
+        result.update({f"p{p}_ms": round(percentile(seconds, p / 100) * 1000,
+                                         1)
+                       for p in (50, 95, 99)})
+    return result
+
+
+def latency(since, until=None, limit=None):
+    ''' Latency percentiles of each stage, of messages received in a window.
+
+    The latency of a stage is the time from the message's previous recorded
+    stage, so 'started' is the broker wait and 'sent' the time from
+    formatting to the endpoint accepting it.  'total' is from received to
+    the last endpoint accepting the message.
+
+    :param datetime since: start of the window
+    :param datetime until: end of the window, now by default
+    :param int limit: most messages to include, the latest received,
+        STAGE_LATENCY_MAX_MESSAGES by default
+    :rtype: dict
+    '''
+    limit = limit or app.config['STAGE_LATENCY_MAX_MESSAGES']
+    received = db.session.query(md.MessageStage.rbm_id).filter(
+        md.MessageStage.stage == 'received',
+        md.MessageStage.at >= epoch(since),
+        md.MessageStage.at < (epoch(until) if until else time.time())).\
+        order_by(md.MessageStage.at.desc()).limit(limit).subquery()
+
+    journeys = defaultdict(lambda: defaultdict(list))
+    rows = db.session.query(md.MessageStage.rbm_id, md.MessageStage.stage,
+                            md.MessageStage.endpoint, md.MessageStage.at).\
+        filter(md.MessageStage.rbm_id.in_(db.session.query(received)))
+    for rbm_id, stage, endpoint, at in rows:
+        journeys[rbm_id][stage].append((at, endpoint))
+
+    deltas = defaultdict(list)
+    endpoints = defaultdict(list)
+    totals = []
+    for journey in journeys.values():
+        previous = None
+        for stage in STAGES:
+            if stage not in journey:
+                continue
+            times = sorted(journey[stage], key=lambda t: t[0])
+            if previous is not None:
+                if stage == 'sent':
+                    for at, endpoint in times:
+                        deltas[stage].append(at - previous)
+                        endpoints[endpoint].append(at - previous)
+                else:
+                    deltas[stage].append(times[0][0] - previous)
+            previous = times[0][0]
+        if 'received' in journey and 'sent' in journey:
+            totals.append(max(at for at, e in journey['sent']) -
+                          min(at for at, e in journey['received']))
+
+    return {'messages': len(journeys),
+            'stages': {stage: summary(deltas[stage]) for stage in STAGES[1:]},
+            'endpoints': {endpoint: summary(seconds)
+                          for endpoint, seconds in endpoints.items()},
+            'total': summary(totals)}
@@ -1,5 +1,17 @@
 import os
+import time
+import uuid
 import shutil
+from collections import defaultdict
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, wait
+from celery.signals import (
+    before_task_publish,
+    task_prerun,
+    worker_process_init,
+)
+from sqlalchemy import inspect
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm.exc import NoResultFound
 from flask import current_app as app
 import git
@@ -14,36 +26,109 @@ from paikea.paikea_protocol import (
     convert_degdm,
     parse_iridium_payload,
     parse_rockcore_payload,
+    payload_msg_type,
+)
+from paikea.formatters import (
+    FormatContext,
+    formatter_router,
+    message_id,
+    Commands_to_Buoy,
+)
+from paikea.cache import (
+    ModemInfo,
+    lookup_modem,
+    invalidate_modems,
+    get_route_table,
+    detached_copy,
 )
-from paikea.formatters import formatter_router
 from paikea.firmware_utils import UpgradeStatus
+from paikea.utils import insert_rows
+import paikea.outbox as outbox
+import paikea.stages as stages
+from paikea.sqs import get_sqs_client
 
 
 ce_app = make_celery(app)
 
+#: Task priorities within a lane, higher first, see celeryconfig
+PRIORITY_COMMAND = 9
+PRIORITY_MESSAGE = 5
+PRIORITY_BULK = 3
+PRIORITY_FIRMWARE = 1
 
-@ce_app.task
-def create_pk001(rbm_id, data):
-    """ Transforms an incoming RockBlock message into a default
-    location message, which is packet type PK001.  This task is
-    run by the router after an incoming message message has been
-    serialized to the database and routed by packet type.
+#: Packet types of commands from a handset, handled in the commands lane
+COMMAND_PACKETS = {'PK005', 'PK006'}
 
-    If the PK001 message is successfully created, this task triggers the
-    send_to_endpoints task, which will forward the message on to any endpoint
-    defined in the EndpointRoute table.
 
-    :param int rbm_id: source RockBlockMessage id
+def queue_in_lane(task, msg_type, *args):
+    ''' Queue a task for a RockBlockMessage, in the commands lane with
+    command priority if the message is a command, as a person on a handset
+    is waiting on it.
+
+    :param task: celery task
+    :param str msg_type: packet type of the message
+    :param args: task arguments
+    '''
+    if msg_type in COMMAND_PACKETS:
+        return task.apply_async(args, queue='commands',
+                                priority=PRIORITY_COMMAND)
+    return task.delay(*args)
+
+
+@before_task_publish.connect
+def stamp_published_at(headers=None, **kwargs):
+    ''' Record when a task was queued, for its lane latency '''
+    if headers is not None:
+        headers['published_at'] = time.time()
+
+
+@task_prerun.connect
+def log_lane_latency(task=None, **kwargs):
+    ''' Log how long a task waited in its lane, warning past the lane's
+    LANE_LATENCY_WARN_SECONDS
+    '''
+    request = task.request
+    published_at = getattr(request, 'published_at', None) or \
+        (getattr(request, 'headers', None) or {}).get('published_at')
+    if not published_at:
+        return None
+
+    lane = (request.delivery_info or {}).get('routing_key') or 'telemetry'
+    wait = max(0.0, time.time() - published_at)
+    message = f"Lane {lane}: {task.name} waited {wait * 1000:.0f}ms"
+    limit = app.config['LANE_LATENCY_WARN_SECONDS'].get(lane)
+    if limit is not None and wait > limit:
+        app.logger.warning(message)
+    else:
+        app.logger.info(message)
+    return wait
+
+
+@worker_process_init.connect
+def warm_worker_caches(**kwargs):
+    ''' Create the SQS client of each worker process as it starts, rather
+    than on its first send
+    '''
+    try:
+        with app.app_context():
+            get_sqs_client()
+    except Exception:
+        app.logger.warning("Creating the SQS client failed", exc_info=True)
+
+
+def build_pk001(rbm, data):
+    """ Transforms a RockBlock message into a default location message, which
+    is packet type PK001.  The record is not added to the session.
+
+    :param RockBlockMessage rbm: source message
     :param dict data: Output from parse_iridium_payload
+    :rtype: PK001
     """
     ddata = {}
     for item in data['fields']:
         k, v = item.split(":")
         ddata[k] = v
 
-    rbm = db.session.query(md.RockBlockMessage).filter_by(id=rbm_id).one()
-    modem_id = rbm.rb.id
-
     ird_transmit_time = transmit_time_to_datetime(rbm.transmit_time)
     ird_lat = float(rbm.iridium_latitude)
     ird_lon = float(rbm.iridium_longitude)
@@ -77,8 +162,8 @@ def create_pk001(rbm_id, data):
     except ValueError:
         device_sog = 0
 
-    pm = md.PK001(
-        rbm_id=rbm_id,
+    return md.PK001(
+        rbm_id=rbm.id,
         ird_transmit_time=ird_transmit_time,
         ird_latitude=ird_lat,
         ird_longitude=ird_lon,
@@ -94,7 +179,114 @@ def create_pk001(rbm_id, data):
         device_status=device_status,
     )
 
+
+def build_pk004(rbm, data):
+    """ Transforms a RockBlock message into a location and velocity message,
+    which is packet type PK004.  The record is not added to the session.
+
+    :param RockBlockMessage rbm: source message
+    :param dict data: Output from parse_iridium_payload
+    :rtype: PK004
+    """
+    ird_transmit_time = transmit_time_to_datetime(rbm.transmit_time)
+    fields = data['fields']
+    msg_time = None
+
+    try:
+        utc = fields[6]
+        msg_time = buoy_time_to_datetime(fields[6], ird_transmit_time)
+    except Exception:
+        print(f"Error parsing PK004 time: {rbm.id} {fields}")
+
+    try:
+        lat = convert_degdm(fields[0])
+        ns = fields[1]
+        lon = convert_degdm(fields[2])
+        ew = fields[3]
+        sog = float(fields[4])
+        cog = float(fields[5])
+        if msg_time:
+            utc = msg_time
+        else:
+            utc = ird_transmit_time
+        return md.PK004(rbm_id=rbm.id, lat=lat, ns=ns,
+                        lon=lon, ew=ew, sog=sog, cog=cog,
+                        utc=utc)
+    except Exception as e:
+        print(f"Error parsing PK004 fields: {fields}")
+        raise e
+
+
+def build_command(command, rbm, data):
+    """ A command from a handset to its buoy, such as PK005 to toggle the
+    beacon or PK006 to set the beacon interval.  The record is not added to
+    the session.
+
+    :param str command: command packet type
+    :param RockBlockMessage rbm: source message, from a handset
+    :param dict data: payload data indicating command value
+    :rtype: DeviceCommandMessage
+    """
+    return md.DeviceCommandMessage(
+        command=command,
+        value=data['fields'][0],
+        source_msg_type='handset',
+        source_msg_id=rbm.id,
+        source_device_type='handset',
+        source_device_id=rbm.rb_id)
+
+
+def resolve_modem(rbm):
+    """ Find the RockBlockModem which sent a message, creating it if there is
+    none, and link the message to it.  Known modems come from the modem
+    cache.  Nothing is committed.
+
+    :param RockBlockMessage rbm: message
+    :rtype: ModemInfo
+    """
+    modem = lookup_modem(rbm.imei)
+
+    if modem is None:
+        print("No RockBlockModem imei: {} found, creating".format(rbm.imei))
+        new_modem = md.RockBlockModem(
+            imei=rbm.imei,
+            modem_type=rbm.device_type,
+            serial=rbm.serial)
+        db.session.add(new_modem)
+        db.session.flush()
+        invalidate_modems()
+        modem = ModemInfo(new_modem.id, new_modem.device_type, None)
+
+    if rbm.rb_id is None:
+        rbm.rb_id = modem.id
+        db.session.add(rbm)
+
+    return modem
+
+
+@ce_app.task(priority=PRIORITY_MESSAGE)
+def create_pk001(rbm_id, data):
+    """ Transforms an incoming RockBlock message into a default
+    location message, which is packet type PK001.  This task is
+    run by the router after an incoming message message has been
+    serialized to the database and routed by packet type.
+
+    If the PK001 message is successfully created, this task triggers the
+    send_to_endpoints task, which will forward the message on to any endpoint
+    defined in the EndpointRoute table, or with OUTBOX_ENABLED commits its
+    deliveries along with it.
+
+    :param int rbm_id: source RockBlockMessage id
+    :param dict data: Output from parse_iridium_payload
+    """
+    rbm = db.session.query(md.RockBlockMessage).filter_by(id=rbm_id).one()
+    modem = lookup_modem(rbm.imei)
+
+    pm = build_pk001(rbm, data)
     db.session.add(pm)
+    outboxed = modem is not None and \
+        enqueue_deliveries(modem.id, modem.device_type, pm, 'pk001')
+    context = FormatContext(pm, detached_copy(rbm))
 
     try:
         db.session.commit()
@@ -103,21 +295,25 @@ def create_pk001(rbm_id, data):
         db.session.rollback()
         raise e
 
-    try:
-        modem = db.session.query(md.RockBlockModem).filter_by(id=modem_id).one()
-    except Exception as e:
-        print("problem finding modem {}, cannot send".format(modem_id))
-        print(e)
+    if outboxed:
+        kick_outbox()
+        return
+
+    if modem is None:
+        print("problem finding modem {}, cannot send".format(rbm.imei))
+        return
 
     if modem.device_type not in ['buoy', 'handset']:
         print("Ambiguous device type for modem {}: {}".format(modem.id,
                                                               modem.device_type))
 
     if pm.id:
-        send_to_endpoints(modem_id, modem.device_type, pm.id, 'pk001')
+        db.session.refresh(pm)
+        send_to_endpoints(modem.id, modem.device_type, pm.id, 'pk001',
+                          context=context)
 
 
-@ce_app.task
+@ce_app.task(priority=PRIORITY_MESSAGE)
 def create_pk004(rbm_id, data):
     """ Transforms an incoming RockBlock message into a location and
     velocity message, which is packet type PK004.
@@ -135,39 +331,16 @@ def create_pk004(rbm_id, data):
 
     # session = db.create_scoped_session()
     rbm = db.session.query(md.RockBlockMessage).filter_by(id=rbm_id).one()
-    modem_id = rbm.rb.id
+    modem_id = rbm.rb_id
 
-    ird_transmit_time = transmit_time_to_datetime(rbm.transmit_time)
+    msg = build_pk004(rbm, data)
     fields = data['fields']
-    msg_time = None
-    msg = None
-
-    try:
-        utc = fields[6]
-        msg_time = buoy_time_to_datetime(fields[6], ird_transmit_time)
-    except Exception:
-        print(f"Error parsing PK004 time: {rbm_id} {fields}")
-
-    try:
-        lat = convert_degdm(fields[0])
-        ns = fields[1]
-        lon = convert_degdm(fields[2])
-        ew = fields[3]
-        sog = float(fields[4])
-        cog = float(fields[5])
-        if msg_time:
-            utc = msg_time
-        else:
-            utc = ird_transmit_time
-        msg = md.PK004(rbm_id=rbm_id, lat=lat, ns=ns,
-                       lon=lon, ew=ew, sog=sog, cog=cog,
-                       utc=utc)
-    except Exception as e:
-        print(f"Error parsing PK004 fields: {fields}")
-        raise e
 
+    outboxed = False
     if msg:
         db.session.add(msg)
+        outboxed = enqueue_deliveries(modem_id, 'buoy', msg, 'pk004')
+        context = FormatContext(msg, detached_copy(rbm))
         try:
             db.session.commit()
         except Exception as e:
@@ -175,11 +348,15 @@ def create_pk004(rbm_id, data):
             db.session.rollback()
             raise e
 
-    if msg.id:
-        send_to_endpoints(modem_id, 'buoy', msg.id, 'pk004')
+    if outboxed:
+        kick_outbox()
+    elif msg.id:
+        db.session.refresh(msg)
+        send_to_endpoints(modem_id, 'buoy', msg.id, 'pk004',
+                          context=context)
 
 
-@ce_app.task
+@ce_app.task(priority=PRIORITY_MESSAGE)
 def on_new_rbm(rbm_id):
     ''' Process a new RockBlockMessage object
 
@@ -187,17 +364,115 @@ def on_new_rbm(rbm_id):
     the modem associated witih the message.  If successful, triggers the
     create_message task.
 
+    With PIPELINE_MODE 'fused', the message is processed by process_rbm in
+    this task instead.
 
     :param int rbm_id: RockBlockMessage id
     '''
+    if app.config.get('PIPELINE_MODE') == 'fused':
+        process_rbm(rbm_id)
+        return
+
+    if not claim_messages([rbm_id]):
+        return
+    stages.add_stages([rbm_id], 'started')
+
     # session = db.create_scoped_session()
     rbm = db.session.query(md.RockBlockMessage).filter_by(id=rbm_id).one()
 
-    if rbm.status.status != 'new':
+    resolve_modem(rbm)
+    try:
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        msg = "Failed creating new RockBlockModem: {}"
+        raise ValueError(msg.format(rbm.imei))
+
+    queue_in_lane(create_message, rbm.msg_type, rbm_id)
+
+
+def claim_messages(rbm_ids, claimed_by=None):
+    ''' Move messages from 'new' to 'processing'.  Only statuses which are
+    still 'new' are updated, so of several tasks racing for a message exactly
+    one claims it.  Committed.
+
+    :param list rbm_ids: RockBlockMessage ids
+    :param str claimed_by: token identifying the claiming task
+    :return: number of messages claimed
+    :rtype: int
+    '''
+    if not rbm_ids:
+        return 0
+
+    claimed = db.session.query(md.RBMessageStatus).filter(
+        md.RBMessageStatus.rbm_id.in_(rbm_ids),
+        md.RBMessageStatus.status == 'new').update(
+            {'status': 'processing', 'claimed_by': claimed_by},
+            synchronize_session=False)
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        raise e
+    return claimed
+
+
+def build_record(rbm):
+    ''' Parse the payload of a message and build its PK record or command
+    with the fused_router.  The record is not added to the session.
+
+    :param RockBlockMessage rbm: message, linked to its modem
+    :return: (record, source device type for send_to_endpoints or None for
+        the modem's, endpoint message type, error).  On error only the error
+        is set.
+    :rtype: tuple
+    '''
+    msg_type = rbm.msg_type or payload_msg_type(rbm.data)
+    if msg_type is None:
+        return None, None, None, 'No msg_type!'
+    if msg_type not in fused_router:
+        return None, None, None, f'No router for {msg_type}'
+
+    build, source_type, message_type = fused_router[msg_type]
+    try:
+        data = parse_iridium_payload(rbm.data)
+        record = build(rbm, data)
+    except Exception as e:
+        app.logger.error("Create message failed", exc_info=True)
+        return None, None, None, f"{e}"
+
+    return record, source_type, message_type, None
+
+
+@ce_app.task(priority=PRIORITY_MESSAGE)
+def process_rbm(rbm_id):
+    ''' Process a new RockBlockMessage in one task: resolve its modem, parse
+    the payload, create the PK record and send it to the endpoints, with a
+    single commit which includes its deliveries with OUTBOX_ENABLED.  This
+    is the 'fused' PIPELINE_MODE, the staged chain of on_new_rbm,
+    create_message and the msg_router tasks does the same over several
+    tasks.
+
+    :param int rbm_id: RockBlockMessage id
+    '''
+    source = "Iridium"
+    msg_id = str(rbm_id)
+    if not claim_messages([rbm_id]):
         return
+    stages.add_stages([rbm_id], 'started')
 
-    rbm.status.status = 'processing'
-    db.session.add(rbm)
+    rbm = db.session.query(md.RockBlockMessage).filter_by(id=rbm_id).one()
+    modem = resolve_modem(rbm)
+    record, source_type, message_type, error = build_record(rbm)
+    if record is not None:
+        stages.add_stages([rbm_id], 'parsed')
+
+    outboxed = False
+    if record is not None:
+        db.session.add(record)
+        outboxed = enqueue_deliveries(
+            modem.id, source_type or modem.device_type, record, message_type)
+    rbm = detached_copy(rbm)
 
     try:
         db.session.commit()
@@ -205,41 +480,201 @@ def on_new_rbm(rbm_id):
         db.session.rollback()
         raise e
 
-    modems = db.session.query(md.RockBlockModem).filter_by(imei=rbm.imei).all()
+    if error:
+        on_parsing_error(source, msg_id, error)
+        return
 
-    if len(modems) == 0:
-        print("No RockBlockModem imei: {} found, creating".format(rbm.imei))
-        modem = md.RockBlockModem(
-            imei=rbm.imei,
-            modem_type=rbm.device_type,
-            serial=rbm.serial)
+    if outboxed:
+        kick_outbox(commands=message_type == 'command')
+        return
 
-        db.session.add(modem)
-        try:
-            db.session.commit()
-        except Exception:
-            db.session.rollback()
-            msg = "Failed creating new RockBlockModem: {}"
-            raise ValueError(msg.format(rbm.imei))
+    try:
+        db.session.refresh(record)
+        send_to_endpoints(modem.id, source_type or modem.device_type,
+                          record.id, message_type,
+                          context=FormatContext(record, rbm))
+    except Exception as e:
+        on_parsing_error(source, msg_id, f"{e}")
 
-    elif len(modems) == 1:
-        print("Found RockBlockModem for imei: {}".format(rbm.imei))
-        modem = modems[0]
 
-    elif len(modems) > 1:
-        msg = "Multiple RockBlockModems with imei: {}"
-        print(msg.format(rbm.imei))
-        raise ValueError(msg.format(rbm.imei))
+@ce_app.task(priority=PRIORITY_BULK)
+def process_new_rbms(batch_size=None):
+    ''' Periodic task processing 'new' messages in bulk, such as a backlog
+    left by a broker outage.  Claims up to batch_size messages, builds all
+    their records, inserts them with a single commit and sends them on with
+    one route lookup for the batch.
 
-    if not rbm.rb:
-        rbm.rb = modem
-        db.session.add(rbm)
+    :param int batch_size: messages to claim, RBM_BATCH_SIZE by default
+    :return: number of messages claimed
+    :rtype: int
+    '''
+    batch_size = batch_size or app.config['RBM_BATCH_SIZE']
+    token = uuid.uuid4().hex
+
+    new_ids = [rbm_id for rbm_id, in db.session.query(
+        md.RBMessageStatus.rbm_id).filter_by(status='new').
+        order_by(md.RBMessageStatus.id).limit(batch_size)]
+    if not claim_messages(new_ids, token):
+        return 0
+    return process_claimed(token)
+
+
+#: Columns identifying the record built from a message, see insert_records
+RECORD_KEYS = {
+    md.PK001: ('rbm_id',),
+    md.PK004: ('rbm_id',),
+    md.DeviceCommandMessage: ('source_msg_type', 'source_msg_id'),
+}
+
+
+def insert_records(records):
+    ''' Insert records built from messages with one statement per model,
+    see utils.insert_rows, and set their ids.  The records are not added to
+    the session.  Not committed.
+
+    :param list records: new PK001, PK004 and DeviceCommandMessage objects
+    '''
+    by_model = defaultdict(list)
+    for record in records:
+        by_model[type(record)].append(record)
+    for model, group in by_model.items():
+        columns = [prop.key for prop in inspect(model).column_attrs]
+        rows = [{key: getattr(record, key) for key in columns
+                 if getattr(record, key) is not None} for record in group]
+        insert_rows(model, rows, RECORD_KEYS[model])
+        for record, row in zip(group, rows):
+            record.id = row['id']
+
+
+def load_records(records):
+    ''' Load records inserted by insert_records once committed, with one
+    query per model, so they are formatted with their values as stored.
+
+    :param list records: records with their ids set
+    :return: {(model, id): loaded record}
+    :rtype: dict
+    '''
+    ids = defaultdict(list)
+    for record in records:
+        ids[type(record)].append(record.id)
+    return {(model, row.id): row for model, model_ids in ids.items()
+            for row in db.session.query(model).filter(model.id.in_(model_ids))}
+
+
+def process_claimed(token):
+    ''' Process the messages claimed with a token: build all their records,
+    insert them with a single commit and send them on with one route lookup
+    for the batch.
+
+    :param str token: claimed_by of the messages, see claim_messages
+    :return: number of messages processed
+    :rtype: int
+    '''
+    source = "Iridium"
+    started_at = time.time()
+
+    rbms = db.session.query(md.RockBlockMessage).\
+        join(md.RBMessageStatus).\
+        filter(md.RBMessageStatus.claimed_by == token).\
+        order_by(md.RockBlockMessage.id).all()
+
+    records = []
+    built = []
+    parsed = []
+    for rbm in rbms:
         try:
-            db.session.commit()
-        except Exception:
-            db.session.rollback()
+            modem = resolve_modem(rbm)
+            record, source_type, message_type, error = build_record(rbm)
+        except Exception as e:
+            error = f"{e}"
+        if error:
+            db.session.add(md.MessageParsingError(
+                msg_source=source, msg_id=str(rbm.id), error=error,
+                error_status="new"))
+            continue
+        records.append(record)
+        parsed.append(rbm.id)
+        built.append((modem.id, source_type or modem.device_type, record,
+                      message_type, rbm))
+
+    insert_records(records)
+    stages.add_stages([rbm.id for rbm in rbms], 'started', started_at)
+    stages.add_stages(parsed, 'parsed')
+    direct = []
+    outboxed = set()
+    for source_id, source_type, record, message_type, rbm in built:
+        if enqueue_deliveries(source_id, source_type, record, message_type):
+            outboxed.add(message_type)
+        else:
+            direct.append((source_id, source_type, record, message_type,
+                           detached_copy(rbm)))
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        raise e
+
+    if outboxed:
+        kick_outbox(commands='command' in outboxed)
+
+    loaded = load_records([record for _, _, record, _, _ in direct])
+    dispatch_grouped([
+        (source_id, source_type,
+         FormatContext(loaded[(type(record), record.id)], rbm), message_type)
+        for source_id, source_type, record, message_type, rbm in direct])
+    return len(rbms)
+
 
-    create_message.delay(rbm_id)
+def dispatch_grouped(messages):
+    ''' Send many messages to the endpoints of their routes, from the
+    compiled route table.
+
+    :param list messages: (source, source_type, msg, message_type) as
+        passed to send_to_endpoints, msg the message id or its FormatContext
+    :return: delivery results, see send_concurrently
+    :rtype: list
+    '''
+    by_source = defaultdict(list)
+    for source, source_type, msg, message_type in messages:
+        by_source[(source_type, source, message_type)].append(msg)
+    if not by_source:
+        return []
+
+    table = get_route_table()
+    deliveries = []
+    for key, msgs in by_source.items():
+        for ept in table.lookup(*key):
+            lm = f"{ept.source_device_type} {ept.source_device} " \
+                f"{ept.msg_type}: {len(msgs)} messages -> " \
+                f"{ept.endpoint_type} {ept.id}"
+            app.logger.warning(lm)
+            formatter = formatter_router(ept.msg_type, ept.endpoint_type)
+            for msg in msgs:
+                try:
+                    deliveries.append((delivery_result(ept, message_id(msg)),
+                                       ept.get_endpoint(), formatter(msg)))
+                except Exception:
+                    app.logger.error(f"Formatting {ept.msg_type} "
+                                     f"{message_id(msg)} for route {ept.id} "
+                                     f"failed", exc_info=True)
+
+    return send_direct(deliveries)
+
+
+@ce_app.task(priority=PRIORITY_BULK)
+def on_new_rbm_batch(rbm_ids):
+    ''' Process a batch of new RockBlockMessage objects, as stored by a batch
+    push, with a single task rather than one task per message.  The messages
+    still 'new' are claimed together and processed as process_new_rbms does.
+
+    :param list rbm_ids: RockBlockMessage ids
+    :return: number of messages claimed
+    :rtype: int
+    '''
+    token = uuid.uuid4().hex
+    if not claim_messages(rbm_ids, token):
+        return 0
+    return process_claimed(token)
 
 # def get_mo_queue():
 #     """ Finds the PAIKEA_MO SQS queue url using boto3
@@ -297,7 +732,7 @@ def on_new_rbm(rbm_id):
 #             print("Error commiting messages!")
 
 
-@ce_app.task
+@ce_app.task(priority=PRIORITY_COMMAND)
 def send_beacon(rbm_id, data):
     """ Send a command to a buoy to toggle the beacon function.
 
@@ -305,29 +740,27 @@ def send_beacon(rbm_id, data):
     :param dict data: payload data indicating command value
     """
     rbm = db.session.query(md.RockBlockMessage).filter_by(id=rbm_id).one()
-    modem_id = rbm.rb.id
-    kwargs = {
-        'command': "PK005",
-        'value': data['fields'][0],  # This needs to be 1 or 0 for PK005
-        'source_msg_type': "handset",
-        'source_msg_id': rbm.id,
-        'source_device_type': "handset",
-        'source_device_id': modem_id
-    }
-    cmd = md.DeviceCommandMessage(**kwargs)
+    modem_id = rbm.rb_id
+    cmd = build_command("PK005", rbm, data)
     db.session.add(cmd)
+    outboxed = enqueue_deliveries(modem_id, 'handset', cmd, 'command')
     try:
         db.session.commit()
     except Exception as e:
         db.session.rollback()
-        app.logger.error("Problem committing command: {}".format(kwargs),
+        app.logger.error("Problem committing command: {}".format(cmd),
                          exc_info=True)
         print(e)
-    if cmd.id:
-        send_to_endpoints(modem_id, 'handset', cmd.id, 'command')
+        outboxed = False
+    if outboxed:
+        kick_outbox(commands=True)
+    elif cmd.id:
+        db.session.refresh(cmd)
+        send_to_endpoints(modem_id, 'handset', cmd.id, 'command',
+                          context=FormatContext(cmd))
 
 
-@ce_app.task
+@ce_app.task(priority=PRIORITY_COMMAND)
 def update_beacon_interval(rbm_id, data):
     """ Send a command to a buoy to change the frequency of it's update period.
 
@@ -336,27 +769,25 @@ def update_beacon_interval(rbm_id, data):
     """
 
     rbm = db.session.query(md.RockBlockMessage).filter_by(id=rbm_id).one()
-    modem_id = rbm.rb.id
-    kwargs = {
-        'command': 'PK006',
-        'value': data['fields'][0],  # should be 0-9999 int
-        'source_msg_type': 'handset',
-        'source_msg_id': rbm.id,
-        'source_device_type': 'handset',
-        'source_device_id': modem_id
-    }
-    cmd = md.DeviceCommandMessage(**kwargs)
+    modem_id = rbm.rb_id
+    cmd = build_command("PK006", rbm, data)  # value should be 0-9999 int
     db.session.add(cmd)
+    outboxed = enqueue_deliveries(modem_id, 'handset', cmd, 'command')
     try:
         db.session.commit()
     except Exception as e:
         db.session.rollback()
-        app.logger.error("Problem committing command: {}".format(kwargs),
+        app.logger.error("Problem committing command: {}".format(cmd),
                          exc_info=True)
         print(e)
+        outboxed = False
 
-    if cmd.id:
-        send_to_endpoints(modem_id, 'handset', cmd.id, 'command')
+    if outboxed:
+        kick_outbox(commands=True)
+    elif cmd.id:
+        db.session.refresh(cmd)
+        send_to_endpoints(modem_id, 'handset', cmd.id, 'command',
+                          context=FormatContext(cmd))
 
 
 msg_router = {
@@ -366,6 +797,15 @@ msg_router = {
     "PK006": update_beacon_interval,  # Beacon interval
 }
 
+#: Builders used by process_rbm: packet type -> (builder, source device type
+#: for send_to_endpoints or None for the modem's, endpoint message type)
+fused_router = {
+    "PK001": (build_pk001, None, 'pk001'),
+    "PK004": (build_pk004, 'buoy', 'pk004'),
+    "PK005": (partial(build_command, "PK005"), 'handset', 'command'),
+    "PK006": (partial(build_command, "PK006"), 'handset', 'command'),
+}
+
 
 def on_parsing_error(src, mid, error):
     """When a message produces an error during processing, create an
@@ -390,10 +830,11 @@ def on_parsing_error(src, mid, error):
         db.session.rollback()
 
 
-@ce_app.task
+@ce_app.task(priority=PRIORITY_MESSAGE)
 def create_message(rbm_id):
     """ Parses iridium payload from a RockBlockMessage and processes
-        the message via the router.
+        the message via the router.  The router is chosen by the msg_type
+        stored at ingest, so a message without a router is not decoded.
 
         :param int rbm_id: Source RockBlockMessage id
     """
@@ -402,61 +843,395 @@ def create_message(rbm_id):
     # session = db.create_scoped_session()
     rbm = db.session.query(md.RockBlockMessage).filter_by(id=rbm_id).one()
 
+    msg_type = rbm.msg_type or payload_msg_type(rbm.data)
+    if msg_type is None:
+        on_parsing_error(source, msg_id, f'No msg_type!')
+        return
+
+    if msg_type not in msg_router:
+        on_parsing_error(source, msg_id, f'No router for {msg_type}')
+        return
+
     try:
         data = parse_iridium_payload(rbm.data)
     except Exception:
         app.logger.error("Create message failed", exc_info=True)
         on_parsing_error(source, msg_id, "Payload parsing failed")
         return
-
-    if 'msg_type' not in data:
-        on_parsing_error(source, msg_id, f'No msg_type!')
-
-    if data['msg_type'] not in msg_router:
-        on_parsing_error(source, msg_id, f'No router for {data["msg_type"]}')
+    stages.add_stages([rbm_id], 'parsed')
 
     try:
-        msg_router[data['msg_type']](rbm_id, data)
+        msg_router[msg_type](rbm_id, data)
     except Exception as e:
         on_parsing_error(source, msg_id, f"{e}")
 
 
-@ce_app.task
-def send_to_endpoints(source, source_type, msg_id, message_type):
+@ce_app.task(priority=PRIORITY_MESSAGE)
+def send_to_endpoints(source, source_type, msg_id, message_type,
+                      context=None):
     """ Based on message source and type, routes the contents of a message to
         an endpoint based on the routed defined in the EndpointRoute table.
 
         This is the final step in processing incoming messages, which is to
         format the outgoing data for the destination, and call the
-        destination's send method on the formatted data.
+        destination's send method on the formatted data.  Routes come from
+        the compiled route table, so routing makes no query, and with a
+        context formatting for any number of endpoints makes none either.
 
         :param int source: id of the source of the message
         :param str source_type: Device type which sent the source message
         :param int msg_id: the id of the messate in the table referred to by message_type
         :param str message_type: the type of the message
+        :param FormatContext context: the message already loaded, for the
+            formatters.  Not serializable, so only for direct calls.
+        :return: delivery results, see send_concurrently
+        :rtype: list
     """
     if source_type not in md.EndpointRoute.source_device_types:
         msg = f"Invalid source type: {source_type}"
         raise ValueError(msg)
 
-    filter = {'source_device_type': source_type,
-              'source_device': source,
-              'msg_type': message_type,
-              'enabled': True, }
-
-    epts = db.session.query(md.EndpointRoute).filter_by(**filter).all()
+    epts = get_route_table().lookup(source_type, source, message_type)
 
     n_epts = len(epts)
     lm = f"{source_type} {source} {message_type}: {n_epts} Endpoints"
     app.logger.warning(lm)
 
+    deliveries = []
     for ept in epts:
-        f_msg = formatter_router(message_type, ept.endpoint_type)(msg_id)
+        f_msg = formatter_router(message_type, ept.endpoint_type)(
+            context or msg_id)
         app.logger.warning(f"sending {message_type} {msg_id} {f_msg} -> {ept.endpoint_type} {ept.id}")  # NOQA
-        ept.get_endpoint().send(f_msg)
+        deliveries.append((delivery_result(ept, msg_id), ept.get_endpoint(),
+                           f_msg))
+
+    return send_direct(deliveries)
+
+
+def delivery_result(ept, msg_id):
+    ''' Record of the delivery of a message over a route, completed by
+    send_concurrently
+    '''
+    return {'route': ept.id,
+            'endpoint_type': ept.endpoint_type,
+            'endpoint_id': ept.endpoint_id,
+            'msg_type': ept.msg_type,
+            'msg_id': msg_id}
+
+
+def get_send_pool():
+    ''' Thread pool for endpoint sends in this process, created on first
+    use so each forked worker has its own
+    '''
+    pool = app.extensions.get('paikea_send_pool')
+    if pool is None:
+        pool = ThreadPoolExecutor(
+            max_workers=app.config['ENDPOINT_SEND_WORKERS'],
+            thread_name_prefix='endpoint-send')
+        app.extensions['paikea_send_pool'] = pool
+    return pool
+
+
+def _send(flask_app, endpoint, f_msg, idempotency_key=None):
+    start = time.monotonic()
+    with flask_app.app_context():
+        if idempotency_key:
+            endpoint.send(f_msg, idempotency_key=idempotency_key)
+        else:
+            endpoint.send(f_msg)
+    return time.monotonic() - start, {}
+
+
+def _send_batch(flask_app, endpoint, batch):
+    start = time.monotonic()
+    with flask_app.app_context():
+        errors = endpoint.send_batch(
+            [(f_msg, result.get('idempotency_key'))
+             for result, endpoint, f_msg in batch])
+    return time.monotonic() - start, errors
+
+
+def send_jobs(deliveries):
+    ''' Group deliveries into sends.  With SQS_BATCH_SEND, the deliveries
+    to an endpoint with a send_batch method, i.e. an SQS queue, are sent
+    together, the rest one at a time.
+
+    :param list deliveries: as for send_concurrently
+    :return: lists of deliveries
+    :rtype: list
+    '''
+    if not app.config['SQS_BATCH_SEND']:
+        return [[delivery] for delivery in deliveries]
+
+    jobs = []
+    batches = defaultdict(list)
+    for delivery in deliveries:
+        endpoint = delivery[1]
+        if hasattr(endpoint, 'send_batch'):
+            batches[(type(endpoint), endpoint.id)].append(delivery)
+        else:
+            jobs.append([delivery])
+    return jobs + list(batches.values())
+
+
+def complete_results(future, job, timed_out=False):
+    ''' Complete the results of the deliveries of a send from its future,
+    and log them.
+
+    :param Future future: the send, of _send or _send_batch
+    :param list job: its deliveries
+    :param bool timed_out: the send was still running at the timeout
+    '''
+    for index, (result, endpoint, f_msg) in enumerate(job):
+        if timed_out:
+            result['status'] = 'timeout'
+            result['error'] = "Send timed out after " \
+                f"{app.config['ENDPOINT_SEND_TIMEOUT']}s"
+        elif future.cancelled():
+            result['status'] = 'failed'
+            result['error'] = "Send not started within " \
+                f"{app.config['ENDPOINT_SEND_TIMEOUT']}s"
+        elif future.exception() is not None:
+            result['status'] = 'failed'
+            result['error'] = f"{future.exception()}"
+        elif index in future.result()[1]:
+            result['status'] = 'failed'
+            result['error'] = future.result()[1][index]
+        else:
+            result['status'] = 'sent'
+            result.pop('error', None)
+            result['seconds'] = round(future.result()[0], 3)
+
+        if result['status'] == 'sent':
+            app.logger.info(f"Delivered: {result}")
+        else:
+            app.logger.error(f"Delivery failed: {result}")
+
+
+def send_concurrently(deliveries, late=None):
+    ''' Send formatted messages to their endpoints at the same time from the
+    send pool, so a slow endpoint delays neither the others nor the task
+    beyond ENDPOINT_SEND_TIMEOUT.  A send still running at the timeout is
+    reported as timed out and left to finish on its own, see when_finished,
+    and one not yet started is cancelled and reported as failed.  Several
+    messages to one SQS queue go in a single batched send, see send_jobs.
+    With STAGE_TIMING_ENABLED the formatted and sent stages of the messages
+    are recorded.
+
+    Each result is completed with 'status', one of sent, failed or timeout,
+    the 'seconds' a finished send took and any 'error', and logged.
+
+    :param list deliveries: (result, endpoint, formatted message), with
+        result from delivery_result.  A result's 'idempotency_key', if any,
+        is passed to the endpoint's send.
+    :param list late: extended with (future, deliveries) of the sends which
+        timed out
+    :return: the results
+    :rtype: list
+    '''
+    if not deliveries:
+        return []
+
+    formatted_at = time.time()
+    finished = {}
+    pool = get_send_pool()
+    flask_app = app._get_current_object()
+    futures = []
+    for job in send_jobs(deliveries):
+        if len(job) == 1:
+            result, endpoint, f_msg = job[0]
+            future = pool.submit(_send, flask_app, endpoint, f_msg,
+                                 result.get('idempotency_key'))
+        else:
+            future = pool.submit(_send_batch, flask_app, job[0][1], job)
+        future.add_done_callback(
+            lambda f: finished.setdefault(f, time.time()))
+        futures.append((future, job))
+    done, not_done = wait([future for future, job in futures],
+                          timeout=app.config['ENDPOINT_SEND_TIMEOUT'])
+
+    sent_at = {}
+    for future, job in futures:
+        timed_out = future in not_done and not future.cancel()
+        complete_results(future, job, timed_out)
+        if timed_out and late is not None:
+            late.append((future, job))
+        for result, endpoint, f_msg in job:
+            sent_at[id(result)] = None if timed_out else finished.get(future)
+
+    results = [result for result, endpoint, f_msg in deliveries]
+    stages.record_deliveries(results, formatted_at,
+                             [sent_at[id(result)] for result in results])
+    return results
+
+
+def when_finished(late, record):
+    ''' Once each timed out send finishes, complete copies of its results
+    and pass them to record, in an app context of its own.
+
+    :param list late: (future, deliveries), see send_concurrently
+    :param record: called with the list of completed results
+    '''
+    flask_app = app._get_current_object()
+    for future, job in late:
+        job = [(dict(result), endpoint, f_msg)
+               for result, endpoint, f_msg in job]
+        future.add_done_callback(
+            partial(_record_late, flask_app, job, record))
+
+
+def _record_late(flask_app, job, record, future):
+    with flask_app.app_context():
+        try:
+            complete_results(future, job)
+            record([result for result, endpoint, f_msg in job])
+        except Exception:
+            app.logger.error("Recording a late send failed", exc_info=True)
+
+
+def send_direct(deliveries):
+    ''' Send deliveries made without the outbox with send_concurrently, and
+    record their results as DeliveryAttempts, see outbox.record_sends.  A
+    failed delivery is then retried by dispatch_outbox, and one still being
+    sent at the timeout is recorded once its send finishes rather than sent
+    again.
+
+    :param list deliveries: as for send_concurrently
+    :return: delivery results
+    :rtype: list
+    '''
+    token = uuid.uuid4().hex
+    late = []
+    results = send_concurrently(deliveries, late)
+    if not results:
+        return results
+    outbox.record_sends(results, token)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # recorded by a concurrent send of the same delivery
+        db.session.rollback()
+        app.logger.warning("Recording deliveries failed", exc_info=True)
+        return results
+    except Exception as e:
+        db.session.rollback()
+        raise e
+    when_finished(late, partial(outbox.record_late, token=token))
+    return results
+
+
+def enqueue_deliveries(source, source_type, record, message_type):
+    ''' With OUTBOX_ENABLED, or for a command when commands are coalesced,
+    add the deliveries of a new record to the session, flushing it for its
+    id, so they are committed along with it.
+
+    :param int source: id of the source of the message
+    :param str source_type: Device type which sent the source message
+    :param record: new PK record or DeviceCommandMessage, in the session
+    :param str message_type: the type of the message
+    :return: True if deliveries were added, so the outbox is to be kicked,
+        False if the record has no routes or the caller sends it itself once
+        committed
+    :rtype: bool
+    '''
+    if not app.config['OUTBOX_ENABLED'] and not \
+            (message_type == 'command' and outbox.coalesce_commands()):
+        return False
+    db.session.flush()
+    return bool(outbox.enqueue(source, source_type, record.id, message_type))
+
+
+def kick_outbox(commands=False):
+    ''' Queue dispatch_outbox for deliveries just committed.  It runs after
+    OUTBOX_KICK_DELAY, so the deliveries of messages arriving together are
+    dispatched, and batched per SQS queue, together.  If queueing fails they
+    are sent by the periodic dispatch instead.
+
+    :param bool commands: the deliveries include commands, so dispatch after
+        COMMAND_COALESCE_SECONDS
+    '''
+    countdown = app.config['OUTBOX_KICK_DELAY']
+    if commands:
+        countdown = max(countdown, app.config['COMMAND_COALESCE_SECONDS'])
+    try:
+        dispatch_outbox.apply_async(countdown=countdown)
+    except Exception:
+        app.logger.warning("Queueing dispatch_outbox failed", exc_info=True)
+
+
+def format_delivery(attempt, carried):
+    ''' Format a delivery, merging coalesced commands into one payload '''
+    if len(carried) > 1:
+        return Commands_to_Buoy([a.msg_id for a in carried])
+    return formatter_router(attempt.msg_type,
+                            attempt.endpoint_type)(attempt.msg_id)
+
+
+@ce_app.task(priority=PRIORITY_MESSAGE)
+def dispatch_outbox(batch_size=None):
+    ''' Send due deliveries from the outbox.  Claims up to batch_size
+    DeliveryAttempts, merges coalesced commands, sends them concurrently and
+    records each outcome, see paikea.outbox.
+
+    :param int batch_size: deliveries to claim, OUTBOX_BATCH_SIZE by default
+    :return: delivery results, see send_concurrently
+    :rtype: list
+    '''
+    batch_size = batch_size or app.config['OUTBOX_BATCH_SIZE']
+    token = uuid.uuid4().hex
+    attempts = outbox.claim_due(batch_size, token)
+
+    results = []
+    deliveries = []
+    endpoints = {}
+    sends = outbox.coalesce(attempts)
+    for attempt, carried in sends:
+        result = {'route': attempt.route_id,
+                  'endpoint_type': attempt.endpoint_type,
+                  'endpoint_id': attempt.endpoint_id,
+                  'msg_type': attempt.msg_type,
+                  'msg_id': attempt.msg_id,
+                  'idempotency_key': attempt.idempotency_key}
+        if len(carried) > 1:
+            result['merged'] = [a.msg_id for a in carried[:-1]]
+        key = (attempt.endpoint_type, attempt.endpoint_id)
+        try:
+            if key not in endpoints:
+                endpoints[key] = get_route_table().endpoint(*key) or \
+                    detached_copy(attempt.get_endpoint())
+            f_msg = format_delivery(attempt, carried)
+        except Exception as e:
+            app.logger.error(f"Preparing delivery {attempt.idempotency_key} "
+                             "failed", exc_info=True)
+            result['status'] = 'failed'
+            result['error'] = f"{e}"
+            results.append(result)
+            continue
+        deliveries.append((result, endpoints[key], f_msg))
+
+    late = []
+    results.extend(send_concurrently(deliveries, late))
+
+    by_key = {attempt.idempotency_key: carried
+              for attempt, carried in sends}
+    carried_keys = {key: [attempt.idempotency_key for attempt in carried]
+                    for key, carried in by_key.items()}
+    for result in results:
+        for attempt in by_key[result['idempotency_key']]:
+            outbox.record_result(attempt, result)
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        raise e
+
+    # timed out sends keep their claim until they finish
+    when_finished(late, partial(outbox.record_late, token=token,
+                                carried=carried_keys))
+    return results
 
 
-@ce_app.task
+@ce_app.task(priority=PRIORITY_COMMAND)
 def on_new_rockcore(rcm_id):
     """When a new message is received via the RockCorePushAPI, the
         corresponding RockStar is found or created.
@@ -506,18 +1281,24 @@ def on_new_rockcore(rcm_id):
                 source_device_type='rockstar',
                 source_device_id=rs_id)
             db.session.add(cmd)
+            outboxed = enqueue_deliveries(rs_id, 'rockstar', cmd, 'command')
             try:
                 db.session.commit()
             except Exception as e:
                 print("Problem adding DeviceCommand: {}".format(cmd))
                 db.session.rollback()
                 print(e)
+                outboxed = False
 
-            if cmd.id:
-                send_to_endpoints(rs_id, 'rockstar', cmd.id, 'command')
+            if outboxed:
+                kick_outbox(commands=True)
+            elif cmd.id:
+                db.session.refresh(cmd)
+                send_to_endpoints(rs_id, 'rockstar', cmd.id, 'command',
+                                  context=FormatContext(cmd))
 
 
-@ce_app.task
+@ce_app.task(priority=PRIORITY_FIRMWARE)
 def prepare_update_directory(upgrade_id):
     """ A Device Firmware Upgrade creates a directory to hold the firmware to
         be deployed and pulls hte firmware from git.
@@ -584,7 +1365,7 @@ def prepare_update_directory(upgrade_id):
     # notify db that upgrade is ready
 
 
-@ce_app.task
+@ce_app.task(priority=PRIORITY_FIRMWARE)
 def clear_upgrade_directory(job_id):
     """ Cleans up the created files and directory from a firmware upgrade.
 
@@ -0,0 +1,192 @@
+"""
+Pooled HTTP transport for the RockBLOCK and RockCore APIs.
+
+Each process keeps a requests.Session per host, whose keep-alive connection
+pool lets an MT message reuse an open TLS connection to core.rock7.com
+instead of paying a new handshake.  Every request gets connect and read
+timeouts, HTTP_CONNECT_TIMEOUT and HTTP_READ_TIMEOUT, so a hung connection
+fails the send rather than blocking the worker.  At most HTTP_MAX_PER_HOST
+requests to a host are in flight per process; the rest wait for a slot.
+
+The latency of each request is logged and kept per host, see
+Transport.stats.
+"""
+import os
+import time
+import logging
+import threading
+from collections import deque
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from flask import current_app as app, has_app_context
+
+
+logger = logging.getLogger('paikea.transport')
+
+#: Defaults for use outside an app, e.g. from scripts
+DEFAULTS = {
+    'HTTP_POOL_SIZE': 10,
+    'HTTP_MAX_PER_HOST': 8,
+    'HTTP_CONNECT_TIMEOUT': 5,
+    'HTTP_READ_TIMEOUT': 30,
+}
+
+
+class TransportBusy(Exception):
+    ''' No request slot for a host became free in time '''
+
+
+class HostStats:
+    ''' Request counts and latencies for one host.
+
+    :param int window: number of recent latencies kept for percentiles
+    '''
+
+    def __init__(self, window=1000):
+        self.requests = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds, error=False):
+        with self._lock:
+            self.requests += 1
+            if error:
+                self.errors += 1
+            self.latencies.append(seconds)
+
+    def summary(self):
+        ''' Counts and latency percentiles, in milliseconds '''
+        with self._lock:
+            latencies = sorted(self.latencies)
+            summary = {'requests': self.requests, 'errors': self.errors}
+        if latencies:
+            def pct(p):
+                return round(latencies[int(p * (len(latencies) - 1))] * 1000,
+                             1)
+            summary.update(p50_ms=pct(0.5), p95_ms=pct(0.95),
+                           max_ms=pct(1.0))
+        return summary
+
+
+class Transport:
+    ''' Keep-alive sessions, request slots and latency stats per host.
+
+    :param int pool_size: connections kept open per host
+    :param int max_per_host: requests in flight per host
+    :param float connect_timeout: seconds to establish a connection
+    :param float read_timeout: seconds to wait for the response
+    '''
+
+    def __init__(self, pool_size=10, max_per_host=8, connect_timeout=5,
+                 read_timeout=30):
+        self.pid = os.getpid()
+        self.pool_size = pool_size
+        self.max_per_host = max_per_host
+        self.timeout = (connect_timeout, read_timeout)
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def _host(self, host):
+        entry = self._hosts.get(host)
+        if entry is None:
+            with self._lock:
+                entry = self._hosts.get(host)
+                if entry is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1,
+                                          pool_maxsize=self.pool_size)
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    entry = (session,
+                             threading.BoundedSemaphore(self.max_per_host),
+                             HostStats())
+                    self._hosts[host] = entry
+        return entry
+
+    def request(self, method, url, **kwargs):
+        ''' Send a request over the host's pooled session.
+
+        :param str method: HTTP method
+        :param str url: URL
+        :param kwargs: passed to requests, timeout defaults to the
+            transport's
+        :rtype: requests.Response
+        :raises TransportBusy: if no slot for the host frees up within the
+            read timeout
+        '''
+        host = urlsplit(url).netloc
+        session, slots, stats = self._host(host)
+        kwargs.setdefault('timeout', self.timeout)
+
+        if not slots.acquire(timeout=self.timeout[1]):
+            stats.record(0, error=True)
+            raise TransportBusy(f"No request slot free for {host}")
+        start = time.monotonic()
+        try:
+            resp = session.request(method, url, **kwargs)
+        except Exception:
+            elapsed = time.monotonic() - start
+            stats.record(elapsed, error=True)
+            logger.warning(f"{method} {host} failed after "
+                           f"{elapsed * 1000:.0f}ms")
+            raise
+        finally:
+            slots.release()
+
+        elapsed = time.monotonic() - start
+        stats.record(elapsed, error=resp.status_code >= 400)
+        logger.info(f"{method} {host} {resp.status_code} "
+                    f"{elapsed * 1000:.0f}ms")
+        return resp
+
+    def post(self, url, data=None, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def stats(self):
+        ''' Request counts and latency percentiles by host
+
+        :rtype: dict
+        '''
+        return {host: stats.summary()
+                for host, (session, slots, stats) in self._hosts.items()}
+
+    def close(self):
+        with self._lock:
+            for session, slots, stats in self._hosts.values():
+                session.close()
+            self._hosts.clear()
+
+
+_transport = None
+_transport_lock = threading.Lock()
+
+
+def get_transport():
+    ''' The Transport of this process, configured from the app if there is
+    one.  A forked worker makes its own, so no connection is shared with its
+    parent.
+    '''
+    global _transport
+    transport = _transport
+    if transport is None or transport.pid != os.getpid():
+        config = app.config if has_app_context() else {}
+
+        def setting(key):
+            return config.get(key, DEFAULTS[key])
+
+        with _transport_lock:
+            if _transport is None or _transport.pid != os.getpid():
+                _transport = Transport(
+                    pool_size=setting('HTTP_POOL_SIZE'),
+                    max_per_host=setting('HTTP_MAX_PER_HOST'),
+                    connect_timeout=setting('HTTP_CONNECT_TIMEOUT'),
+                    read_timeout=setting('HTTP_READ_TIMEOUT'))
+            transport = _transport
+    return transport
+
+
+def post(url, data=None, **kwargs):
+    ''' POST through this process's Transport, see Transport.request '''
+    return get_transport().post(url, data, **kwargs)
@@ -0,0 +1,152 @@
+"""
+Triage of MessageParsingErrors.
+
+Errors are grouped by their error text and msg_source, so the failures a
+protocol fix should cure can be picked out, and the messages of a group are
+re-run through tasks.create_message in batches.  The outcome of each retried
+error is set with a single UPDATE per batch, moving its error_status from
+'new' to one of:
+
+    resolved    the message was processed
+    superseded  it failed again, and the new failure has its own error
+    failed      the retry raised, e.g. the message no longer exists
+
+Only errors of RockBlock messages, msg_source 'Iridium', can be retried.
+"""
+from collections import defaultdict
+from sqlalchemy import case, func
+from flask import current_app as app
+from paikea.extensions import db
+import paikea.models as md
+import paikea.tasks as tasks
+
+
+#: msg_source of errors whose msg_id is a RockBlockMessage id
+RETRYABLE_SOURCES = {'Iridium'}
+
+
+def error_groups(status='new'):
+    ''' Errors with a status, counted by error text and source
+
+    :param str status: error_status, None for all
+    :return: dicts of msg_source, error, count, first and last, the times
+        of the first and last error, most frequent first
+    :rtype: list
+    '''
+    mpe = md.MessageParsingError
+    query = db.session.query(
+        mpe.msg_source, mpe.error, func.count(mpe.id),
+        func.min(mpe.created_at), func.max(mpe.created_at))
+    if status is not None:
+        query = query.filter(mpe.error_status == status)
+    query = query.group_by(mpe.msg_source, mpe.error).\
+        order_by(func.count(mpe.id).desc())
+    return [{'msg_source': source, 'error': error, 'count': count,
+             'first': first, 'last': last,
+             'retryable': source in RETRYABLE_SOURCES}
+            for source, error, count, first, last in query]
+
+
+def retry_batch(errors, status, retried=None):
+    ''' Re-run the messages of a batch of errors and record the outcomes.
+    Each message is run once, however many of its errors are in the batch.
+
+    :param list errors: (error id, msg_id) of errors with status
+    :param str status: the errors' error_status, only errors still in it are
+        updated
+    :param dict retried: {msg_id: outcome} of messages already retried by
+        this run, which are not run again, updated with the batch's
+    :return: number of errors moved to each outcome
+    :rtype: dict
+    '''
+    mpe = md.MessageParsingError
+    retried = {} if retried is None else retried
+    watermark = db.session.query(func.max(mpe.id)).scalar() or 0
+
+    run = []
+    for error_id, msg_id in errors:
+        if msg_id in retried or msg_id in run:
+            continue
+        run.append(msg_id)
+        try:
+            tasks.create_message(int(msg_id))
+            retried[msg_id] = 'resolved'
+        except Exception:
+            db.session.rollback()
+            app.logger.error(f"Retrying error {error_id} failed",
+                             exc_info=True)
+            retried[msg_id] = 'failed'
+
+    for msg_id, in db.session.query(mpe.msg_id).filter(
+            mpe.id > watermark,
+            mpe.msg_source.in_(RETRYABLE_SOURCES),
+            mpe.msg_id.in_(run)):
+        if retried[msg_id] == 'resolved':
+            retried[msg_id] = 'superseded'
+
+    ids = defaultdict(list)
+    for error_id, msg_id in errors:
+        ids[retried[msg_id]].append(error_id)
+
+    db.session.query(mpe).filter(
+        mpe.id.in_([error_id for error_id, msg_id in errors]),
+        mpe.error_status == status).update(
+            {'error_status': case(
+                (mpe.id.in_(ids['failed']), 'failed'),
+                (mpe.id.in_(ids['superseded']), 'superseded'),
+                else_='resolved')},
+            synchronize_session=False)
+    try:
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        raise e
+    return {outcome: len(ids[outcome])
+            for outcome in ['resolved', 'superseded', 'failed']}
+
+
+def retry_errors(msg_source='Iridium', error=None, status='new',
+                 batch_size=100, limit=None, progress=None):
+    ''' Re-run the messages of a group of errors through create_message, in
+    batches of batch_size, oldest error first.
+
+    :param str msg_source: source of the errors, of RETRYABLE_SOURCES
+    :param str error: error text of the group, None for any
+    :param str status: error_status of the errors retried
+    :param int batch_size: errors per batch
+    :param int limit: most errors to retry, None for all
+    :param progress: called with the totals after each batch
+    :return: errors retried and how many were resolved, superseded or failed
+    :rtype: dict
+    :raises ValueError: if msg_source can not be retried
+    '''
+    if msg_source not in RETRYABLE_SOURCES:
+        raise ValueError(f"Errors from {msg_source} can not be retried")
+
+    mpe = md.MessageParsingError
+    totals = {'retried': 0, 'resolved': 0, 'superseded': 0, 'failed': 0}
+    retried = {}
+    last_id = 0
+    # errors recorded by the retries themselves are left for another run
+    last_error = db.session.query(func.max(mpe.id)).scalar() or 0
+    while limit is None or totals['retried'] < limit:
+        size = batch_size if limit is None else \
+            min(batch_size, limit - totals['retried'])
+        query = db.session.query(mpe.id, mpe.msg_id).filter(
+            mpe.msg_source == msg_source,
+            mpe.error_status == status,
+            mpe.id > last_id,
+            mpe.id <= last_error)
+        if error is not None:
+            query = query.filter(mpe.error == error)
+        errors = query.order_by(mpe.id).limit(size).all()
+        if not errors:
+            break
+
+        last_id = errors[-1][0]
+        for outcome, count in retry_batch(errors, status, retried).items():
+            totals[outcome] += count
+        totals['retried'] += len(errors)
+        if progress:
+            progress(totals)
+    return totals
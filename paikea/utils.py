@@ -1,12 +1,85 @@
 import os
 import binascii
+import json
+from collections import defaultdict
+from urllib.parse import unquote
 import requests
 import sqlite3
+from sqlalchemy import tuple_
 import paikea.models as md
 from paikea.extensions import db
+import paikea.transport as transport
+
+
+#: Keys of a RockBlock push
+ROCKBLOCK_KEYS = ['imei', 'device_type', 'serial', 'momsn',
+                  'transmit_time', 'iridium_latitude', 'iridium_longitude',
+                  'iridium_cep', 'iridium_session_status', 'data']
+
+#: Types of the non string values of a RockBlock push
+ROCKBLOCK_TYPES = {
+    'momsn': int,
+}
+
+#: Values of a RockBlock push which must be numbers.  They are stored as
+#: sent, in String columns, so are only checked here.
+ROCKBLOCK_NUMBERS = ['iridium_latitude', 'iridium_longitude', 'iridium_cep']
+
+
+def insert_rows(model, rows, keys):
+    """ Insert rows with one statement per set of columns, rather than the
+    statement per row of bulk_insert_mappings with return_defaults, and set
+    the id of each row.  The ids come from RETURNING where the dialect has
+    it, and otherwise from one SELECT on the key columns, which must be
+    unique among the rows and not yet in the table.  Rows missing a key
+    value are inserted one at a time.  Not committed.
+
+    :param model: mapped class of the rows
+    :param list rows: dicts of column values, updated with their 'id'
+    :param tuple keys: names of the columns identifying a row
+    """
+    table = model.__table__
+    names = {column.key for column in table.columns}
+    key_columns = [table.c[key] for key in keys]
+    returning = db.engine.dialect.full_returning
+
+    groups = defaultdict(list)
+    for row in rows:
+        values = {k: v for k, v in row.items() if k in names and k != 'id'}
+        if any(row.get(key) is None for key in keys):
+            row['id'] = db.session.execute(
+                table.insert(), values).inserted_primary_key[0]
+        else:
+            groups[frozenset(values)].append((row, values))
+
+    for group in groups.values():
+        # compared as strings, as a push may give momsn as either
+        by_key = {tuple(str(row[key]) for key in keys): row
+                  for row, _ in group}
+        values = [values for _, values in group]
+        if returning:
+            found = db.session.execute(
+                table.insert().values(values).returning(
+                    table.c.id, *key_columns))
+        else:
+            db.session.execute(table.insert(), values)
+            key_values = [tuple(row[key] for key in keys) for row, _ in group]
+            if len(keys) == 1:
+                match = key_columns[0].in_([key for key, in key_values])
+            else:
+                match = tuple_(*key_columns).in_(key_values)
+            found = db.session.execute(
+                db.select(table.c.id, *key_columns).where(match).
+                order_by(table.c.id))
+        for row_id, *key in found:
+            by_key[tuple(str(value) for value in key)]['id'] = row_id
 
 
 def parse_req(raw_data):
+    """ Split a form-encoded RockBlock push, leaving values percent-encoded.
+    Superseded by parse_push, kept as the baseline for
+    scripts/bench_parse_push.py.
+    """
     data = raw_data.decode('ascii').split("&")
     ret = {}
     for item in data:
@@ -16,6 +89,116 @@ def parse_req(raw_data):
     return ret
 
 
+def convert_push(data):
+    """ Check a RockBlock push has exactly the expected keys and convert its
+    values to their types, ROCKBLOCK_NUMBERS to the strings stored.
+
+    :param dict data: push data with str values
+    :return: push data with typed values
+    :rtype: dict
+    """
+    make_request_from_dict(data)
+    for key, cast in ROCKBLOCK_TYPES.items():
+        try:
+            data[key] = cast(data[key])
+        except (TypeError, ValueError):
+            raise ValueError(f"Bad {key}: {data[key]}")
+    for key in ROCKBLOCK_NUMBERS:
+        try:
+            float(data[key])
+        except (TypeError, ValueError):
+            raise ValueError(f"Bad {key}: {data[key]}")
+        data[key] = str(data[key])
+    return data
+
+
+_PUSH_KEYS = frozenset(ROCKBLOCK_KEYS)
+
+
+def _unquote_form(value):
+    # '%' always starts an escape in form encoding, so replacing the escapes
+    # seen in a transmit time before the general unquote still decodes once
+    value = value.replace("+", " ")
+    if "%3A" in value:
+        value = value.replace("%3A", ":")
+    if "%20" in value:
+        value = value.replace("%20", " ")
+    if "%" in value:
+        value = unquote(value)
+    return value
+
+
+def parse_push(raw_data):
+    """ Parse a form-encoded RockBlock push in a single pass.
+
+    Form encoding leaves a push body ascii, so it is decoded and split as a
+    whole.  Only values holding an escape are percent-decoded, each exactly
+    once, and values are converted per ROCKBLOCK_TYPES.  ROCKBLOCK_NUMBERS
+    are checked but kept as sent.
+
+    :param bytes raw_data: request body
+    :return: push data with typed values
+    :rtype: dict
+    """
+    try:
+        text = raw_data.decode('ascii')
+        ret = dict(item.split("=", 1) for item in text.split("&"))
+    except ValueError:
+        raise ValueError(f"Malformed push: {raw_data}")
+
+    if ret.keys() != _PUSH_KEYS:
+        make_request_from_dict(ret)
+
+    if "%" in text or "+" in text:
+        for key, value in ret.items():
+            if "%" in value or "+" in value:
+                ret[key] = _unquote_form(value)
+
+    try:
+        ret['momsn'] = int(ret['momsn'])
+        for key in ROCKBLOCK_NUMBERS:
+            float(ret[key])
+    except ValueError as e:
+        raise ValueError(f"Bad push value: {e}")
+
+    return ret
+
+
+NDJSON_TYPES = [
+    'application/x-ndjson',
+    'application/ndjson',
+    'application/jsonlines',
+]
+
+
+def parse_batch_req(raw_data, content_type):
+    """ Parse a batch of RockBlock push messages, one message per line.  Lines
+    are either form-encoded like a single push, or JSON objects when the
+    content type is NDJSON.
+
+    :param bytes raw_data: request body
+    :param str content_type: mimetype of the request
+    :return: (list of message dicts, list of errors by line)
+    :rtype: tuple
+    """
+    records = []
+    errors = []
+    for line_no, line in enumerate(raw_data.splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            if content_type in NDJSON_TYPES:
+                data = convert_push(json.loads(line))
+            else:
+                data = parse_push(line.strip())
+        except Exception as e:
+            errors.append(f"Line {line_no}: {e}")
+            continue
+        records.append(data)
+
+    return records, errors
+
+
 def test_payload(payload):
     data = {
         'imei': '300434063836590',
@@ -69,7 +252,7 @@ def send_rbm(imei, msg):
             'password': bar}
     resp = None
     try:
-        resp = requests.post(url, data)
+        resp = transport.post(url, data)
     except Exception:
         print("RockBlock request failed!")
     if not resp:
@@ -80,9 +263,7 @@ def send_rbm(imei, msg):
 
 
 def make_request_from_dict(data_dict):
-    keys = ['imei', 'device_type', 'serial', 'momsn',
-            'transmit_time', 'iridium_latitude', 'iridium_longitude',
-            'iridium_cep', 'iridium_session_status', 'data']
+    keys = ROCKBLOCK_KEYS
     missing_keys = []
     extra_keys = []
     for key in keys:
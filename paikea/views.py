@@ -1,3 +1,5 @@
+import time
+from datetime import datetime, timedelta
 from flask import (
     current_app as app,
     Blueprint,
@@ -6,9 +8,12 @@ from flask import (
     make_response,
     send_from_directory,
     jsonify,
+    Response,
+    stream_with_context,
 )
 from flask_cors import CORS
 from sqlalchemy.orm import exc
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
 from sqlalchemy import(
     and_,
     or_,
@@ -16,7 +21,6 @@ from sqlalchemy import(
 from .extensions import db
 from .models import (
     RockBlockMessage,
-    RBMessageStatus,
     RockBlockModem,
     Buoy,
     PK001,
@@ -28,10 +32,27 @@ from .models import (
 )
 from .routes import (
     check_route,
+    check_routes,
     check_route_for_participant,
 )
-from .utils import parse_req
+from .utils import (
+    parse_push,
+    parse_batch_req,
+)
+from .ingest import (
+    ingest_rockblock_message,
+    ingest_rockblock_batch,
+)
+from .dedup import get_duplicate_filter
+from .cache import (
+    invalidate_modems,
+    invalidate_routes,
+)
+from .spool import get_spool
 import paikea.firmware as firmware
+import paikea.stages as stages
+import paikea.triage as triage
+import paikea.simulate as simulate
 import paikea.serializers as ser
 import paikea.tasks as tasks
 
@@ -107,38 +128,161 @@ def raw():
     """ route: /rockblock/incoming
         Endpoint for Iridium RockBlock push messages.  Persists the message
         data and triggers the on_new_rbm task to process the message.
+        Duplicate pushes are acknowledged without being stored or processed,
+        any other database failure is a 500 so the push is sent again.
+
+        With SPOOL_ENABLED, the raw message is only appended to the local
+        spool before responding, and the spool drainer persists it.
     """
     if request.method == "POST":
+        received_at = time.time()
         request_data = request.get_data()
+        if app.config['SPOOL_ENABLED']:
+            get_spool().append(request_data)
+            return make_response("OK", 200)
+
         print(request_data)
-        data = parse_req(request_data)
         app.logger.info("Request data: {}".format(request_data))
-
-        rbm = RockBlockMessage(**data)
-        db.session.add(rbm)
         try:
-            db.session.commit()
-        except Exception:
-            db.session.rollback()
-            app.logger.error("Incoming message commit failed: {}".format(rbm))
+            data = parse_push(request_data)
+        except ValueError as e:
+            app.logger.error(f"Unreadable RockBlock push: {e}")
+            return make_response(f"{e}", 400)
 
-        rbm_status = RBMessageStatus(rbm_id=rbm.id, status='new')
-        db.session.add(rbm_status)
         try:
-            db.session.commit()
-        except Exception:
-            db.session.rollback()
-            err_msg = "Incomming Message status update failed: {}"
-            app.logger.error(err_msg.format(rbm_status))
+            ingest_rockblock_message(data, received_at)
+        except IntegrityError:
+            app.logger.info("Duplicate RockBlock push: {}".format(data))
+        except SQLAlchemyError:
+            app.logger.error("Incoming message commit failed: {}".format(data),
+                             exc_info=True)
+            # not stored, so RockBLOCK must send it again
+            return make_response("Committing failed", 500)
 
-        tasks.on_new_rbm.delay(rbm.id)
         return make_response("OK", 200)
 
     if request.method == "GET":
-        messages = db.session.query(RockBlockMessage).all()
-        return render_template('raw_messages.html',
-                               title='Messages',
-                               messages=messages)
+        return raw_messages()
+
+
+def raw_messages():
+    """ A page of received messages, newest first, streamed as it is read
+    from the database.  Pages are keyed on message id, so the cost of a page
+    does not grow with the table.
+
+    Query args, all optional:
+        before: only messages with an id below this, i.e. the next page
+        limit: messages per page, from 1 to RAW_MESSAGES_MAX_PAGE
+        imei: only messages from this modem
+        since, until: only messages created in this window, ISO 8601
+    """
+    args = {}
+    try:
+        for name in ['before', 'limit']:
+            if request.args.get(name):
+                args[name] = int(request.args[name])
+        for name in ['since', 'until']:
+            if request.args.get(name):
+                args[name] = datetime.fromisoformat(request.args[name])
+    except ValueError as e:
+        return make_response(f"{e}", 400)
+    if args.get('limit', 1) < 1:
+        return make_response("limit must be at least 1", 400)
+    if request.args.get('imei'):
+        args['imei'] = request.args['imei']
+
+    limit = min(args.get('limit', app.config['RAW_MESSAGES_PAGE_SIZE']),
+                app.config['RAW_MESSAGES_MAX_PAGE'])
+
+    query = db.session.query(
+        RockBlockMessage.id,
+        RockBlockMessage.imei,
+        RockBlockMessage.msg_type,
+        RockBlockMessage.data,
+        RockBlockMessage.created_at)
+    if 'before' in args:
+        query = query.filter(RockBlockMessage.id < args['before'])
+    if 'imei' in args:
+        query = query.filter(RockBlockMessage.imei == args['imei'])
+    if 'since' in args:
+        query = query.filter(RockBlockMessage.created_at >= args['since'])
+    if 'until' in args:
+        query = query.filter(RockBlockMessage.created_at < args['until'])
+    messages = query.order_by(RockBlockMessage.id.desc()).\
+        limit(limit).yield_per(100)
+
+    filters = {k: request.args[k] for k in ['imei', 'since', 'until']
+               if k in args}
+    context = {
+        'title': 'Messages',
+        'messages': messages,
+        'limit': limit,
+        'filters': filters,
+    }
+    app.update_template_context(context)
+    template = app.jinja_env.get_template('raw_messages.html')
+    return Response(stream_with_context(template.generate(context)))
+
+
+@incoming_bp.route("/rockblock/incoming/batch", methods=['POST'])
+def raw_batch():
+    """ route: /rockblock/incoming/batch
+        Endpoint for many Iridium RockBlock messages in one request, such as
+        when replaying a backlog.  The body holds one message per line, either
+        form-encoded as in a single push or as NDJSON.  The messages are
+        stored in one transaction and processed by a single on_new_rbm_batch
+        task.  If any line is invalid, nothing is stored.  Duplicates of
+        stored messages are skipped.
+    """
+    received_at = time.time()
+    records, errors = parse_batch_req(request.get_data(), request.mimetype)
+
+    if errors:
+        return make_response(jsonify({'errors': errors}), 400)
+
+    try:
+        rbm_ids = ingest_rockblock_batch(records, received_at)
+    except Exception:
+        app.logger.error("Incoming batch commit failed", exc_info=True)
+        return make_response(
+            jsonify({'errors': ["Incoming batch commit failed"]}), 500)
+
+    return jsonify({'received': len(records), 'stored': len(rbm_ids)})
+
+
+@json_endpoints_bp.route("/v1/ingest/duplicates", methods=['GET'])
+def ingest_duplicates():
+    """ route: /v1/ingest/duplicates
+
+        Number of duplicate RockBlock pushes suppressed by this process
+    """
+    return jsonify({'duplicates': get_duplicate_filter().duplicates})
+
+
+@json_endpoints_bp.route("/v1/stages/latency", methods=['GET'])
+def stage_latency():
+    """ route: /v1/stages/latency
+
+        p50/p95/p99 latency of each pipeline stage, in milliseconds, of the
+        messages received in a window, see paikea.stages.latency.  Recorded
+        with STAGE_TIMING_ENABLED.
+
+        Query args, all optional:
+            since, until: the window, ISO 8601, by default the last hour
+            limit: most messages to include
+    """
+    try:
+        since = datetime.fromisoformat(request.args['since']) \
+            if request.args.get('since') \
+            else datetime.utcnow() - timedelta(hours=1)
+        until = datetime.fromisoformat(request.args['until']) \
+            if request.args.get('until') else None
+        limit = int(request.args['limit']) \
+            if request.args.get('limit') else None
+    except ValueError as e:
+        return make_response(f"{e}", 400)
+
+    return jsonify(stages.latency(since, until, limit))
 
 
 @json_endpoints_bp.route("/json/messages", methods=['GET', ])
@@ -230,6 +374,7 @@ def add_new_buoy():
 
         db.session.add(buoy)
         db.session.add(rb)
+        invalidate_modems()
 
         try:
             db.session.commit()
@@ -289,6 +434,7 @@ def add_new_handset():
 
         db.session.add(handset)
         db.session.add(rb)
+        invalidate_modems()
 
         try:
             db.session.commit()
@@ -354,6 +500,7 @@ def link_device(link_type):
 
         db.session.add(device)
         db.session.add(rb)
+        invalidate_modems()
 
         try:
             db.session.commit()
@@ -434,6 +581,7 @@ def unlink_device(link_type):
     device.rb = None
     db.session.add(modem)
     db.session.add(device)
+    invalidate_modems()
 
     try:
         db.session.flush()
@@ -471,6 +619,48 @@ def errors():
     return schema.jsonify(errors)
 
 
+@json_endpoints_bp.route("/v1/errors/groups", methods=["GET", ])
+def error_groups():
+    """ route: /v1/errors/groups
+
+        Parsing errors counted by error text and source, most frequent
+        first, see paikea.triage.error_groups
+
+        Query args, optional:
+            status: error_status of the errors counted, 'new' by default,
+                'all' for every error
+    """
+    status = request.args.get('status', 'new')
+    return jsonify(triage.error_groups(None if status == 'all' else status))
+
+
+@json_endpoints_bp.route("/v1/errors/retry", methods=["POST", ])
+def retry_errors():
+    """ route: /v1/errors/retry
+
+        Re-run the messages of a group of 'new' parsing errors through
+        create_message, see paikea.triage.retry_errors.  At most
+        ERROR_RETRY_MAX errors are retried per request, post again for more.
+
+        JSON body:
+            msg_source: source of the errors, 'Iridium' by default
+            error: error text of the group, every error by default
+            limit: most errors to retry
+    """
+    data = request.json or {}
+    try:
+        limit = min(int(data.get('limit') or app.config['ERROR_RETRY_MAX']),
+                    app.config['ERROR_RETRY_MAX'])
+        totals = triage.retry_errors(
+            msg_source=data.get('msg_source', 'Iridium'),
+            error=data.get('error'),
+            batch_size=app.config['ERROR_RETRY_BATCH_SIZE'],
+            limit=limit)
+    except ValueError as e:
+        return make_response(jsonify({'errors': [f"{e}"]}), 400)
+    return jsonify(totals)
+
+
 @json_endpoints_bp.route("/v1/rockstars", methods=["GET", ])
 def rockstars():
     """ route: /v1/rockstars
@@ -684,6 +874,7 @@ def add_new_route():
         return make_response(jsonify(errors), 500)
 
     db.session.add(new_route)
+    invalidate_routes()
     try:
         db.session.commit()
     except Exception:
@@ -692,6 +883,81 @@ def add_new_route():
     return make_response("OK", 200)
 
 
+@json_endpoints_bp.route("/v1/routing/bulk", methods=["POST"])
+def add_routes():
+    """ route: /v1/routing/bulk
+
+        Create many routes at once.  Every route is validated as for
+        /v1/routing/create, with one query per table, and they are all
+        created, or none are.  At most ROUTE_BULK_MAX routes per request.
+
+        JSON body:
+            routes: list of routes as posted to /v1/routing/create, enabled
+                by default
+
+        Returns the ids of the new routes, in order, or with status 400 the
+        errors of each route by its index.
+    """
+    data = request.json or {}
+    routes = data.get('routes')
+    if not isinstance(routes, list) or not routes:
+        return make_response(jsonify({'errors': ["No routes given"]}), 400)
+    if len(routes) > app.config['ROUTE_BULK_MAX']:
+        return make_response(jsonify({'errors': [
+            f"At most {app.config['ROUTE_BULK_MAX']} routes per request"]}),
+            400)
+
+    errors = check_routes(routes)
+    if any(errors):
+        return make_response(jsonify({'errors': [
+            {'index': index, 'errors': errs}
+            for index, errs in enumerate(errors) if errs]}), 400)
+
+    new_routes = [
+        EndpointRoute(
+            source_device_type=route['source']['type'],
+            source_device=int(route['source']['id']),
+            msg_type=route['source']['msg'],
+            endpoint_type=route['target']['type'],
+            endpoint_id=int(route['target']['id']),
+            enabled=bool(route.get('enabled', True)))
+        for route in routes]
+    db.session.add_all(new_routes)
+    invalidate_routes()
+    try:
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        return make_response(
+            jsonify({'errors': ['Failed to insert new Routes']}), 500)
+    return jsonify({'ids': [route.id for route in new_routes]})
+
+
+@json_endpoints_bp.route("/v1/routing/simulate", methods=["POST"])
+def simulate_routing():
+    """ route: /v1/routing/simulate
+
+        Parse, route and format a message as if it had just arrived, without
+        sending it or storing anything, see paikea.simulate.simulate.
+
+        JSON body, one of:
+            rbm_id: id of a stored RockBlockMessage
+            payload, imei: hex payload and the imei of the modem sending it
+
+        Returns the formatted payload, its size in bytes and Iridium credits
+        for each endpoint, and the time taken by each stage in ms.
+    """
+    data = request.json or {}
+    try:
+        rbm_id = int(data['rbm_id']) if data.get('rbm_id') is not None \
+            else None
+        result = simulate.simulate(rbm_id=rbm_id, payload=data.get('payload'),
+                                   imei=data.get('imei'))
+    except (ValueError, simulate.SimulationError) as e:
+        return make_response(jsonify({'errors': [f"{e}"]}), 400)
+    return jsonify(result)
+
+
 @json_endpoints_bp.route("/v1/routing/delete", methods=["POST"])
 def delete_route():
     data = request.json
@@ -713,6 +979,7 @@ def delete_route():
         return make_response(jsonify({'errors': errors}), 500)
 
     db.session.delete(route)
+    invalidate_routes()
     try:
         db.session.commit()
     except Exception:
@@ -749,6 +1016,7 @@ def disenable_route():
 
     route.enabled = enable
     db.session.add(route)
+    invalidate_routes()
 
     try:
         db.session.commit()
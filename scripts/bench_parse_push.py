@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+""" Micro-benchmark of utils.parse_push against utils.parse_req.
+
+parse_req only splits the body, the percent-decoding and type conversion
+happen later in create_pk001, so the comparison includes that work too.
+
+$ python scripts/bench_parse_push.py
+"""
+import sys
+import timeit
+import binascii
+from urllib.parse import urlencode, unquote
+from paikea.utils import parse_req, parse_push
+
+
+PAYLOADS = [
+    "PK001;lat:3749.5074,NS:N,lon:12216.6021,EW:W,utc:030501.086,batt:4.7,"
+    "sog:2.5,cog:167.3,sta:4",
+    "PK004;3745.6588,N,12243.8766,W,3.4,33.4,220000.000",
+    "PK005;1",
+]
+
+
+def push_body(payload, momsn):
+    return urlencode({
+        'imei': '300434063836590',
+        'device_type': 'ROCKBLOCK',
+        'serial': '13760',
+        'momsn': str(momsn),
+        'transmit_time': '20-10-02 21:07:37',
+        'iridium_latitude': '37.7740',
+        'iridium_longitude': '-122.4050',
+        'iridium_cep': '4.0',
+        'iridium_session_status': '0',
+        'data': binascii.hexlify(payload.encode('ascii')).decode('ascii'),
+    }).encode('ascii')
+
+
+def parse_req_typed(body):
+    data = parse_req(body)
+    data['transmit_time'] = unquote(unquote(data['transmit_time']))
+    data['momsn'] = int(data['momsn'])
+    for key in ('iridium_latitude', 'iridium_longitude', 'iridium_cep'):
+        data[key] = float(data[key])
+    return data
+
+
+def main(number=20000):
+    bodies = [push_body(payload, 441 + x)
+              for x, payload in enumerate(PAYLOADS)]
+
+    for name, func in [('parse_req', parse_req),
+                       ('parse_req + decode/convert', parse_req_typed),
+                       ('parse_push', parse_push)]:
+        for body in bodies:
+            secs = min(timeit.repeat(lambda: func(body), number=number,
+                                     repeat=5))
+            print(f"{name:28} {len(body):4} bytes "
+                  f"{secs / number * 1e6:7.2f} us/msg")
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:2]])
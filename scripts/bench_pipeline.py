@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+""" End-to-end latency of the staged and fused incoming message pipelines.
+
+Runs on_new_rbm for new PK001 messages in each PIPELINE_MODE against a
+scratch sqlite database, with celery tasks executed eagerly.  A broker round
+trip is simulated by sleeping HOP_MS before each queued task, as a real
+broker would add that between stages.  Reports mean latency per message,
+queued tasks and SQL statements per message.
+
+$ python scripts/bench_pipeline.py [N_MESSAGES] [HOP_MS]
+"""
+import os
+import sys
+import time
+import tempfile
+import binascii
+from unittest.mock import patch
+from flask import Flask
+from sqlalchemy import event
+from celery.app.task import Task
+from paikea.extensions import db
+from paikea.settings import TestConfig
+import paikea.models as md
+import paikea.tasks as tasks
+
+
+PAYLOAD = "PK001;lat:3749.5074,NS:N,lon:12216.6021,EW:W,utc:030501.086," \
+    "batt:4.7,sog:2.5,cog:167.3,sta:4"
+
+
+def create_app(db_filename):
+    app = Flask('bench')
+    config = TestConfig()
+    config.SQLALCHEMY_DATABASE_URI = f"sqlite:///{db_filename}"
+    app.config.from_object(config)
+    db.init_app(app)
+    return app
+
+
+def add_messages(n, start):
+    data = binascii.hexlify(PAYLOAD.encode('ascii')).decode('ascii')
+    ids = []
+    for x in range(start, start + n):
+        rbm = md.RockBlockMessage(
+            imei='300434063836590', device_type='ROCKBLOCK', serial='13760',
+            momsn=x, transmit_time='20-10-02 21:07:37',
+            iridium_latitude='37.7740', iridium_longitude='-122.4050',
+            iridium_cep='4.0', iridium_session_status='0', data=data,
+            msg_type='PK001')
+        rbm.status = md.RBMessageStatus(status='new')
+        db.session.add(rbm)
+        db.session.commit()
+        ids.append(rbm.id)
+    return ids
+
+
+def run(app, mode, rbm_ids, hop_ms):
+    app.config['PIPELINE_MODE'] = mode
+    counts = {'tasks': 0, 'statements': 0}
+    apply_async = Task.apply_async
+
+    def delayed(self, *args, **kwargs):
+        counts['tasks'] += 1
+        time.sleep(hop_ms / 1000)
+        return apply_async(self, *args, **kwargs)
+
+    def count(*args):
+        counts['statements'] += 1
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    start = time.perf_counter()
+    with patch.object(Task, 'apply_async', delayed):
+        for rbm_id in rbm_ids:
+            tasks.on_new_rbm.delay(rbm_id)
+    secs = time.perf_counter() - start
+    event.remove(db.engine, 'before_cursor_execute', count)
+
+    n = len(rbm_ids)
+    assert db.session.query(md.PK001).\
+        filter(md.PK001.rbm_id.in_(rbm_ids)).count() == n
+    print(f"{mode:7} {secs / n * 1000:8.2f} ms/msg "
+          f"{counts['tasks'] / n:5.1f} tasks/msg "
+          f"{counts['statements'] / n:6.1f} statements/msg")
+
+
+def main(n=200, hop_ms=2):
+    tasks.ce_app.conf.task_always_eager = True
+    db_fd, db_filename = tempfile.mkstemp()
+    app = create_app(db_filename)
+    try:
+        with app.app_context():
+            db.create_all()
+            db.session.add(md.RockBlockModem(imei='300434063836590',
+                                             serial='13760',
+                                             device_type='buoy'))
+            db.session.commit()
+            for n_run, mode in enumerate(['staged', 'fused']):
+                rbm_ids = add_messages(n, n_run * n)
+                run(app, mode, rbm_ids, hop_ms)
+    finally:
+        os.close(db_fd)
+        os.unlink(db_filename)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:3]])
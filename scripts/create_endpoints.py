@@ -4,6 +4,7 @@ import os
 import sys
 import paikea.models as md
 from paikea.extensions import db
+from paikea.cache import invalidate_routes
 
 
 if os.environ.get("FLASK_APP") != 'autoapp':
@@ -87,6 +88,7 @@ def build_table():
             print(f"Adding route: {route}")
             epr = md.EndpointRoute(**route_data)
             db.session.add(epr)
+            invalidate_routes()
             db.session.commit()
 
 
@@ -123,6 +125,7 @@ def prune_table():
         rt = to_prune.pop()
         print(f"Pruning {rt}")
         db.session.delete(rt)
+        invalidate_routes()
 
     try:
         db.session.commit()
@@ -148,6 +151,7 @@ def add_endpoints():
         elif len(q) > 1:
             print("Error, multiple SQS found for {} {}".format(ep[0], ep[1]))
 
+    invalidate_routes()
     try:
         db.session.commit()
     except Exception:
@@ -1,4 +1,5 @@
 from paikea import models as md
+from paikea.cache import cache_version
 
 
 def test_add_bad_buoy(client):
@@ -177,6 +178,39 @@ def test_bad_link(create_modems, flask_app):
             assert err in errors
 
 
+def test_add_routes_bulk(create_routes, flask_app, database):
+    db = database
+    routes = [
+        {'source': {'type': 'buoy', 'id': 2, 'label': '12301', 'msg': 'pk001'},
+         'target': {'type': 'sqs', 'id': 2, 'label': 'queue2'}},
+        {'source': {'type': 'buoy', 'id': 2, 'label': '12301', 'msg': 'pk001'},
+         'target': {'type': 'handset', 'id': 3, 'label': '12302'},
+         'enabled': False},
+    ]
+    bad = {'source': {'type': 'buoy', 'id': 2, 'label': '12301',
+                      'msg': 'pk001'},
+           'target': {'type': 'sqs', 'id': 99, 'label': 'queue9'}}
+
+    with flask_app.test_client() as client:
+        r = client.post('/v1/routing/bulk', json={'routes': routes + [bad]})
+        assert r.status_code == 400
+        assert r.json == {'errors': [{'index': 2,
+                                      'errors': ["No Queue ID: 99"]}]}
+        # nothing is created unless every route is valid
+        assert db.session.query(md.EndpointRoute).count() == 3
+
+        r = client.post('/v1/routing/bulk', json={'routes': routes})
+        assert r.status_code == 200
+        assert r.json == {'ids': [4, 5]}
+
+        r = client.post('/v1/routing/bulk', json={'routes': []})
+        assert r.status_code == 400
+
+    assert [route.enabled for route in db.session.query(md.EndpointRoute).
+            filter(md.EndpointRoute.id > 3)] == [True, False]
+    assert cache_version('routes') == 1
+
+
 def test_add_route(create_routes, flask_app):
     routes = create_routes
 
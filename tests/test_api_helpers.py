@@ -1,4 +1,6 @@
+from sqlalchemy import event
 from paikea.routes import (
+    check_routes,
     confirm_modem_device,
     confirm_queue,
     confirm_pairing,
@@ -177,3 +179,42 @@ def test_route_participant(database, create_routes):
                                         'sqs',
                                         9999)
     assert not check
+
+
+def bulk_route(source, msg, target):
+    return {'source': dict(zip(['type', 'id', 'label'], source), msg=msg),
+            'target': dict(zip(['type', 'id', 'label'], target))}
+
+
+def test_check_routes(database, create_routes):
+    db = database
+    routes = [
+        bulk_route(('buoy', 2, '12301'), 'pk001', ('sqs', 2, 'queue2')),
+        bulk_route(('buoy', 1, '12300'), 'pk001', ('handset', 3, '12302')),
+        bulk_route(('buoy', 2, '12301'), 'pk001', ('sqs', 2, 'queue2')),
+        bulk_route(('buoy', 2, 'wrong'), 'pk001', ('sqs', 99, 'queue9')),
+        {'source': {'type': 'buoy', 'id': 2, 'label': '12301'}},
+        bulk_route(('buoy', 2, '12301'), 'pk004', ('sqs', 1, 'queue1')),
+    ]
+
+    statements = []
+
+    def count(*args):
+        statements.append(args[2])
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        errors = check_routes(routes)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+
+    # modems, queues and routes, whatever the number of routes
+    assert len(statements) == 3
+    assert errors == [
+        [],
+        ["Duplicate routes found: 1"],
+        ["Duplicate of route 0"],
+        ["Wrong label for modem ID: 2 -> wrong", "No Queue ID: 99"],
+        ["No source msg given", "No target given"],
+        ["Buoy message type must be pk001"],
+    ]
@@ -0,0 +1,87 @@
+from sqlalchemy import event
+import paikea.models as md
+from paikea.cache import (
+    LRUCache,
+    VersionedCache,
+    ModemInfo,
+    cache_version,
+    get_modem_cache,
+    lookup_modem,
+)
+
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=2)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    assert cache.get('a') == 1
+    cache.put('c', 3)
+    # b was least recently used
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert cache.get('c') == 3
+    assert len(cache) == 2
+
+
+def test_versioned_cache(database):
+    db = database
+    worker = VersionedCache('modems', check_seconds=0)
+    web = VersionedCache('modems', check_seconds=0)
+
+    worker.put('imei', 1)
+    assert worker.get('imei') == 1
+
+    web.invalidate()
+    db.session.commit()
+    assert cache_version('modems') == 1
+    assert worker.get('imei') is None
+
+    worker.put('imei', 2)
+    assert worker.get('imei') == 2
+
+
+def test_lookup_modem(create_modems, database):
+    db = database
+    modem = create_modems[0]
+    buoy = md.Buoy(iam='TEST001', rb=modem)
+    modem.device_type = 'buoy'
+    db.session.add(buoy)
+    db.session.commit()
+
+    assert lookup_modem(modem.imei) == \
+        ModemInfo(modem.id, 'buoy', buoy.id)
+    assert lookup_modem('no such imei') is None
+
+    statements = []
+
+    def count(*args):
+        statements.append(args[2])
+
+    get_modem_cache().check_seconds = 60
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        for x in range(10):
+            assert lookup_modem(modem.imei).id == modem.id
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+    assert statements == []
+
+
+def test_link_device_invalidates_modems(create_modems, flask_app, database):
+    db = database
+    modem = create_modems[0]
+    handset = md.Handset(iam='HS001')
+    db.session.add(handset)
+    db.session.commit()
+
+    assert lookup_modem(modem.imei).device_type is None
+
+    with flask_app.test_client() as client:
+        response = client.post('/v1/handsets/link',
+                               json={'id': handset.id, 'modem': modem.id})
+    assert response.status_code == 200
+    assert cache_version('modems') == 1
+
+    get_modem_cache().check_seconds = 0
+    assert lookup_modem(modem.imei) == \
+        ModemInfo(modem.id, 'handset', handset.id)
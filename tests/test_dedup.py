@@ -0,0 +1,83 @@
+from unittest.mock import patch
+import pytest
+from sqlalchemy.exc import IntegrityError
+from utils import ROCKBLOCK_BATCH
+import paikea.models as md
+from paikea.dedup import (
+    BloomFilter,
+    DuplicateFilter,
+    message_key,
+    get_duplicate_filter,
+)
+from paikea.ingest import store_rockblock_messages
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000, 0.01)
+    for x in range(1000):
+        bloom.add(f"imei:{x}")
+
+    for x in range(1000):
+        assert f"imei:{x}" in bloom
+
+    false_positives = sum(f"other:{x}" in bloom for x in range(10000))
+    assert false_positives < 300
+
+
+def test_message_key():
+    assert message_key("1234", "441") == ("1234", 441)
+    assert message_key("1234", 441) == ("1234", 441)
+    assert message_key("1234", None) is None
+    assert message_key("1234", "") is None
+
+
+def test_unique_imei_momsn(database):
+    db = database
+    for x in range(2):
+        db.session.add(md.RockBlockMessage(**ROCKBLOCK_BATCH[0]))
+    with pytest.raises(IntegrityError):
+        db.session.commit()
+    db.session.rollback()
+
+    for x in range(2):
+        db.session.add(md.RockBlockMessage(imei="1234", momsn=None))
+    db.session.commit()
+
+
+def test_filter_seeded_from_recent_rows(database):
+    store_rockblock_messages(ROCKBLOCK_BATCH[:2])
+
+    dedup = DuplicateFilter(capacity=100)
+    key = message_key(ROCKBLOCK_BATCH[0]['imei'], ROCKBLOCK_BATCH[0]['momsn'])
+    assert dedup.is_duplicate(key)
+    new_key = message_key(ROCKBLOCK_BATCH[3]['imei'],
+                          ROCKBLOCK_BATCH[3]['momsn'])
+    assert not dedup.might_contain(new_key)
+    assert not dedup.is_duplicate(new_key)
+
+
+def test_no_query_for_new_messages(database):
+    dedup = get_duplicate_filter()
+    store_rockblock_messages(ROCKBLOCK_BATCH[:1])
+
+    with patch('paikea.dedup.existing_keys') as existing_keys:
+        ids = store_rockblock_messages(ROCKBLOCK_BATCH[1:])
+    assert len(ids) == len(ROCKBLOCK_BATCH) - 1
+    assert not existing_keys.called
+    assert dedup.duplicates == 0
+
+
+def test_duplicate_stored_elsewhere(database):
+    db = database
+    dedup = get_duplicate_filter()
+    dedup.might_contain(("seed", 0))
+
+    # stored by another process, so not in this process' filter
+    db.session.add(md.RockBlockMessage(**ROCKBLOCK_BATCH[0]))
+    db.session.commit()
+
+    ids = store_rockblock_messages(ROCKBLOCK_BATCH[:2])
+    assert len(ids) == 1
+    assert dedup.duplicates == 1
+    assert len(db.session.query(md.RockBlockMessage).all()) == 2
+    assert len(db.session.query(md.RBMessageStatus).all()) == 1
@@ -1,4 +1,5 @@
 import os
+import time
 from unittest.mock import patch
 import paikea.models as md
 import paikea.tasks as tasks
@@ -41,8 +42,8 @@ def test_eprouter_get_endpoint(create_endpoints):
         assert ep.id == epr.endpoint_id
 
 
-@patch('paikea.models.boto3')
-@patch('paikea.models.requests')
+@patch('paikea.sqs.boto3')
+@patch('paikea.models.transport')
 def test_send_endpoints(requests, boto3, with_messages):
     os.environ['ROCKBLOCK_USER'] = 'fakeuser'
     os.environ['ROCKBLOCK_PASS'] = 'rakepass'
@@ -71,3 +72,90 @@ def test_send_endpoints(requests, boto3, with_messages):
 
     errs = db.session.query(md.MessageParsingError).all()
     assert not errs
+
+
+@patch('paikea.tasks.formatter_router')
+def test_send_endpoints_concurrent(formatter_router, flask_app, database):
+    db = database
+    flask_app.config['ENDPOINT_SEND_TIMEOUT'] = 0.5
+    formatter_router.return_value = lambda msg_id: f"formatted {msg_id}"
+
+    queues = [md.SQS_Endpoint(queue_name=name, url=f"http://q.url/{name}")
+              for name in ['ok', 'slow', 'broken']]
+    db.session.add_all(queues)
+    db.session.commit()
+    for queue in queues:
+        db.session.add(md.EndpointRoute(
+            source_device_type='buoy', source_device=1, msg_type='pk001',
+            endpoint_type='sqs', endpoint_id=queue.id))
+    db.session.commit()
+    queue_ids = [queue.id for queue in queues]
+
+    sent = []
+
+    def send(queue, msg):
+        if queue.queue_name == 'slow':
+            time.sleep(1)
+        if queue.queue_name == 'broken':
+            raise ValueError("queue broken")
+        sent.append((queue.queue_name, msg))
+
+    with patch.object(md.SQS_Endpoint, 'send', autospec=True,
+                      side_effect=send):
+        start = time.monotonic()
+        results = tasks.send_to_endpoints(1, 'buoy', 7, 'pk001')
+        assert time.monotonic() - start < 1
+
+        status = {r['endpoint_id']: r['status'] for r in results}
+        assert status == {queue_ids[0]: 'sent', queue_ids[1]: 'timeout',
+                          queue_ids[2]: 'failed'}
+        assert results[2]['error'] == "queue broken"
+        assert sent == [('ok', "formatted 7")]
+
+        def attempts():
+            db.session.expire_all()
+            return {a.endpoint_id: (a.status, a.attempts) for a in
+                    db.session.query(md.DeliveryAttempt)}
+
+        # the results are recorded, a failed send to be retried and the
+        # slow one claimed while it is still being sent
+        assert attempts() == {queue_ids[0]: ('delivered', 0),
+                              queue_ids[1]: ('sending', 0),
+                              queue_ids[2]: ('pending', 1)}
+        assert tasks.dispatch_outbox() == []
+        deadline = time.monotonic() + 5
+        while attempts()[queue_ids[1]][0] == 'sending' and \
+                time.monotonic() < deadline:
+            time.sleep(0.1)
+        assert attempts()[queue_ids[1]] == ('delivered', 0)
+        assert sent == [('ok', "formatted 7"), ('slow', "formatted 7")]
+
+
+@patch('paikea.tasks.formatter_router')
+def test_send_endpoints_sqs_batch(formatter_router, flask_app, database):
+    db = database
+    formatter_router.return_value = lambda msg_id: f"formatted {msg_id}"
+    queue = md.SQS_Endpoint(queue_name='batched', url="http://q.url/batched")
+    db.session.add(queue)
+    db.session.commit()
+    db.session.add(md.EndpointRoute(
+        source_device_type='buoy', source_device=1, msg_type='pk001',
+        endpoint_type='sqs', endpoint_id=queue.id))
+    db.session.commit()
+
+    def send_batch(queue, msgs):
+        return {1: "rejected"}
+
+    with patch.object(md.SQS_Endpoint, 'send', autospec=True) as send, \
+            patch.object(md.SQS_Endpoint, 'send_batch', autospec=True,
+                         side_effect=send_batch) as batch:
+        results = tasks.dispatch_grouped(
+            [(1, 'buoy', msg_id, 'pk001') for msg_id in (4, 5, 6)])
+
+    send.assert_not_called()
+    assert batch.call_count == 1
+    assert batch.call_args[0][1] == [("formatted 4", None),
+                                     ("formatted 5", None),
+                                     ("formatted 6", None)]
+    assert [r['status'] for r in results] == ['sent', 'failed', 'sent']
+    assert results[1]['error'] == "rejected"
@@ -5,39 +5,32 @@ from unittest.mock import (
     patch,
     MagicMock
 )
+from concurrent.futures import ThreadPoolExecutor
 import paikea.models as md
+import paikea.sqs as sqs
 
 
-@patch('paikea.models.boto3')
-@patch('paikea.models.requests')
+@patch('paikea.sqs.boto3')
+@patch('paikea.models.transport')
 def test_SQS_send(requests, boto3, flask_app):
     ep_url = 'https://notarealtarget.url/PAIKEA_MO'
     ep = md.SQS_Endpoint(queue_name='test', url=ep_url)
-    queue = MagicMock()
-    queue.url = ep_url
-
-    queues = MagicMock()
-    queues.all.return_value = [queue]
-
-    sqs_resource = MagicMock()
-    sqs_resource.queues = queues
-
-    class Resource:
-        def __call__(self, x):
-            if x == 'sqs':
-                return sqs_resource
-    _resource = Resource()
-    boto3.resource = _resource
-
-    q = ep.get_queue()
-    assert q.url == ep_url
-
-    ep.send("hi there")
-    assert q.send_message.called
-    assert q.send_message.called_with(MessageBody="hi there")
-
-
-@patch('paikea.models.requests')
+    client = boto3.session.Session.return_value.client.return_value
+    sqs.clear_sqs_client()
+
+    with flask_app.app_context():
+        ep.send("hi there")
+        ep.send("hi again")
+    client.send_message.assert_any_call(QueueUrl=ep_url,
+                                        MessageBody="hi there")
+    assert client.send_message.call_count == 2
+    # the client is made once, with no queue listing or handle per send
+    boto3.session.Session.return_value.client.assert_called_once_with('sqs')
+    boto3.session.Session.return_value.resource.assert_not_called()
+    sqs.clear_sqs_client()
+
+
+@patch('paikea.models.transport')
 def test_rockblock_endpoint(requests, create_endpoints):
     db = create_endpoints
     msg = "This is a story all about how my life got flipped" \
@@ -71,7 +64,7 @@ def test_rockblock_endpoint_no_creds(create_endpoints):
         rb.send(msg)
 
 
-@patch('paikea.models.requests')
+@patch('paikea.models.transport')
 def test_rockblock_endpoint_failed(requests, create_endpoints):
     db = create_endpoints
     requests.post.side_effect = ValueError("On No!!")
@@ -80,7 +73,7 @@ def test_rockblock_endpoint_failed(requests, create_endpoints):
         rb.send("whatever")
 
 
-@patch('paikea.models.requests')
+@patch('paikea.models.transport')
 def test_rockstar_endpoint_failed(requests, create_endpoints):
     db = create_endpoints
     requests.post.side_effect = ValueError("On No!!")
@@ -89,7 +82,7 @@ def test_rockstar_endpoint_failed(requests, create_endpoints):
         rb.send("whatever")
 
 
-@patch('paikea.models.requests')
+@patch('paikea.models.transport')
 def test_rockstar_send(requests, create_endpoints):
     db = create_endpoints
     msg = "This is a story all about how my life got flipped" \
@@ -111,3 +104,75 @@ def test_rockstar_send(requests, create_endpoints):
     assert params['password'] == pwrd
     del os.environ['ROCKCORE_USER']
     del os.environ['ROCKCORE_PASS']
+
+
+class FakeClient:
+    ''' Local stand-in for a boto3 SQS client, rejecting bodies containing
+    "reject"
+    '''
+    def __init__(self):
+        self.batches = []
+
+    def send_message(self, QueueUrl, **kwargs):
+        self.batches.append((QueueUrl, [kwargs]))
+
+    def send_message_batch(self, QueueUrl, Entries):
+        assert len(Entries) <= sqs.SQS_BATCH_MAX_ENTRIES
+        assert len({e['Id'] for e in Entries}) == len(Entries)
+        self.batches.append((QueueUrl, Entries))
+        return {
+            'Successful': [{'Id': e['Id']} for e in Entries
+                           if 'reject' not in e['MessageBody']],
+            'Failed': [{'Id': e['Id'], 'Code': 'InvalidMessageContents',
+                        'Message': 'rejected', 'SenderFault': True}
+                       for e in Entries if 'reject' in e['MessageBody']],
+        }
+
+
+def test_sqs_batches():
+    msgs = [(f"msg {i}", None) for i in range(25)]
+    batches = list(sqs.sqs_batches(msgs))
+    assert [len(b) for b in batches] == [10, 10, 5]
+    assert [i for b in batches for i, msg, key in b] == list(range(25))
+
+    big = "x" * (100 * 1024)
+    batches = list(sqs.sqs_batches([(big, None)] * 5))
+    assert [len(b) for b in batches] == [2, 2, 1]
+
+
+def test_SQS_send_batch(flask_app):
+    ep = md.SQS_Endpoint(queue_name='test', url='https://q.url/test')
+    client = FakeClient()
+    msgs = [(f"msg {i}", f"key-{i}") for i in range(12)]
+    msgs[3] = ("reject me", "key-3")
+
+    with flask_app.app_context(), \
+            patch('paikea.models.get_sqs_client', return_value=client):
+        errors = ep.send_batch(msgs)
+
+    assert errors == {3: "InvalidMessageContents: rejected"}
+    assert [(url, len(b)) for url, b in client.batches] == \
+        [(ep.url, 10), (ep.url, 2)]
+    entry = client.batches[1][1][1]
+    assert entry['MessageBody'] == "msg 11"
+    assert entry['MessageAttributes']['IdempotencyKey']['StringValue'] == \
+        "key-11"
+
+
+@patch('paikea.sqs.boto3')
+def test_sqs_client(boto3):
+    sqs.clear_sqs_client()
+    session = boto3.session.Session
+    session.return_value.client.side_effect = lambda name: MagicMock()
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        clients = list(pool.map(lambda _: sqs.get_sqs_client(), range(32)))
+    # one client shared by the threads of the process
+    assert len({id(client) for client in clients}) == 1
+    assert session.call_count == 1
+
+    # a forked process makes its own
+    with patch('paikea.sqs.os.getpid', return_value=-1):
+        assert sqs.get_sqs_client() is not clients[0]
+    assert session.call_count == 2
+    sqs.clear_sqs_client()
@@ -1,7 +1,15 @@
 import pytest
+from unittest.mock import patch
+from sqlalchemy import event
+from message_fixtures import (
+    single_test_rock_block_message,
+    pk001,
+    pk004,
+)
 import paikea.formatters as formats
 import paikea.tasks as tasks
 import paikea.models as md
+import paikea.paikea_protocol as protocol
 
 
 def test_no_msg(with_messages):
@@ -38,3 +46,63 @@ def test_msg_formatting(with_messages):
     assert formats.formatter_router('pk001', 'handset')(pk001_id)
     assert formats.formatter_router('pk001', 'rockstar')(pk001_id)
     assert formats.formatter_router('pk004', 'handset')(pk004_id)
+
+
+LOCATION = {'lat': 3745.7985, 'lon': -12223.4344, 'utc': '221236.000',
+            'ns': 'N', 'ew': 'W', 'cog': '13.4', 'sog': '1.2'}
+
+
+@patch('paikea.tasks.send_concurrently')
+def test_format_context(send_concurrently, create_endpoints):
+    db = create_endpoints
+    modem = db.session.query(md.RockBlockModem).\
+        filter_by(imei='1234567890').one()
+    modem.device_type = 'buoy'
+    rbms = []
+    for momsn, pkt in enumerate([pk001(LOCATION), pk004(LOCATION)]):
+        rbm = single_test_rock_block_message(pkt)
+        rbm.imei, rbm.momsn, rbm.rb_id = modem.imei, momsn, modem.id
+        rbms.append(rbm)
+    db.session.add_all(rbms)
+    db.session.commit()
+    rbm_ids = [rbm.id for rbm in rbms]
+    data = [protocol.parse_iridium_payload(rbm.data) for rbm in rbms]
+
+    statements = []
+    formatted = []
+
+    def count(*args):
+        statements.append(args[2])
+
+    def counting_router(msg_type, endpoint_type):
+        formatter = formats.formatter_router(msg_type, endpoint_type)
+
+        def format_counted(msg):
+            before = len(statements)
+            f_msg = formatter(msg)
+            formatted.append((msg_type, endpoint_type, formats.message_id(msg),
+                              f_msg, len(statements) - before))
+            return f_msg
+        return format_counted
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        with patch('paikea.tasks.formatter_router', counting_router):
+            tasks.create_pk001(rbm_ids[0], data[0])
+            tasks.create_pk004(rbm_ids[1], data[1])
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+
+    # formatted after the tasks commit, from the objects they loaded
+    assert sorted(f[:2] for f in formatted) == [
+        ('pk001', 'handset'), ('pk001', 'rockstar'), ('pk001', 'sqs'),
+        ('pk004', 'handset')]
+    assert [f[-1] for f in formatted] == [0, 0, 0, 0]
+    for msg_type, endpoint_type, msg_id, f_msg, _ in formatted:
+        assert f_msg == formats.formatter_router(msg_type, endpoint_type)(
+            msg_id)
+
+    pk4 = db.session.query(md.PK004).one()
+    context = formats.FormatContext(pk4)
+    assert context.payload == pk004(LOCATION).encode('ascii')
+    assert formats.message_id(context) == formats.message_id(pk4.id)
@@ -0,0 +1,70 @@
+import binascii
+from unittest.mock import patch
+from sqlalchemy import event
+from utils import ROCKBLOCK_BATCH
+from paikea.ingest import (
+    ingest_rockblock_batch,
+    store_rockblock_messages,
+    classify_stored_messages,
+)
+import paikea.models as md
+
+
+def hex_payload(payload):
+    return binascii.hexlify(payload.encode('ascii')).decode('ascii')
+
+
+@patch('paikea.tasks.on_new_rbm_batch')
+def test_ingest_msg_type(on_new_rbm_batch, database):
+    db = database
+    payloads = ["PK001;lat:3745.7985", "PK004;1,2", "lat:3745.7985"]
+    records = [dict(msg, data=hex_payload(payload))
+               for msg, payload in zip(ROCKBLOCK_BATCH, payloads)]
+    rbm_ids = ingest_rockblock_batch(records)
+
+    msg_types = [db.session.query(md.RockBlockMessage).get(rbm_id).msg_type
+                 for rbm_id in rbm_ids]
+    assert msg_types == ["PK001", "PK004", None]
+
+
+def test_store_rockblock_messages_statements(database):
+    db = database
+    records = [dict(msg, momsn=x, data=hex_payload("PK001;lat:3745.7985"))
+               for x, msg in enumerate(ROCKBLOCK_BATCH * 4)]
+    statements = []
+
+    def count(*args):
+        statements.append(args[2].split()[:3])
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        rbm_ids = store_rockblock_messages(records)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+
+    # one insert of the messages, whatever the number of rows
+    inserts = [s for s in statements if s[:2] == ['INSERT', 'INTO']]
+    assert [s[2] for s in inserts].count('rock_block_message') == 1
+    assert [s[2] for s in inserts].count('rb_message_status') == 1
+    momsns = [db.session.query(md.RockBlockMessage).get(rbm_id).momsn
+              for rbm_id in rbm_ids]
+    assert momsns == list(range(len(records)))
+    statuses = db.session.query(md.RBMessageStatus.rbm_id).\
+        filter_by(status='new').all()
+    assert sorted(rbm_id for rbm_id, in statuses) == sorted(rbm_ids)
+
+
+def test_classify_stored_messages(database):
+    db = database
+    payloads = ["PK001;lat:3745.7985", "PK006;60", "lat:3745.7985",
+                "PK004;1,2"]
+    for x, payload in enumerate(payloads):
+        db.session.add(md.RockBlockMessage(imei='300434063836590', momsn=x,
+                                           data=hex_payload(payload)))
+    db.session.commit()
+
+    assert classify_stored_messages(batch_size=2) == 3
+    msgs = db.session.query(md.RockBlockMessage).\
+        order_by(md.RockBlockMessage.id).all()
+    assert [msg.msg_type for msg in msgs] == ["PK001", "PK006", None, "PK004"]
+    assert classify_stored_messages() == 0
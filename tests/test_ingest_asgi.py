@@ -0,0 +1,112 @@
+import json
+import asyncio
+from urllib.parse import urlencode
+from unittest.mock import patch
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session
+from utils import ROCKBLOCK_INCOMING
+from core_push_api_data import ird_msg
+from paikea.extensions import db
+from paikea.settings import TestConfig
+from paikea.ingest_asgi import (
+    async_database_uri,
+    create_ingest_app,
+)
+import paikea.models as md
+
+
+@pytest.fixture(scope='function')
+def ingest_app(tmp_path):
+    db_filename = tmp_path / "ingest.sql"
+    engine = create_engine(f"sqlite:///{db_filename}")
+    db.metadata.create_all(engine)
+
+    config = TestConfig()
+    config.SQLALCHEMY_DATABASE_URI = f"sqlite:///{db_filename}"
+    app = create_ingest_app(config)
+    yield app, engine
+
+    asyncio.run(app.close())
+    engine.dispose()
+
+
+def call(app, method, path, body=b''):
+    ''' Run a single request through an ASGI app '''
+    sent = []
+    messages = [{'type': 'http.request', 'body': body, 'more_body': False}]
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'method': method, 'path': path, 'headers': []}
+    asyncio.run(app(scope, receive, send))
+    return sent[0]['status'], sent[1]['body']
+
+
+def test_async_database_uri():
+    assert async_database_uri("sqlite://") == "sqlite+aiosqlite://"
+    assert async_database_uri("sqlite:///database/database.sql", "/srv") == \
+        "sqlite+aiosqlite:////srv/database/database.sql"
+    assert async_database_uri("mysql://u:p@localhost/paikea") == \
+        "mysql+aiomysql://u:p@localhost/paikea"
+    assert async_database_uri("postgresql+psycopg2://u:p@db/paikea") == \
+        "postgresql+asyncpg://u:p@db/paikea"
+    with pytest.raises(ValueError):
+        async_database_uri("oracle://u:p@db/paikea")
+
+
+@patch('paikea.tasks.on_new_rbm')
+def test_asgi_rockblock_incoming(on_new_rbm, ingest_app):
+    app, engine = ingest_app
+    body = urlencode(ROCKBLOCK_INCOMING[0]).encode('ascii')
+
+    assert call(app, 'POST', '/rockblock/incoming', body) == (200, b'OK')
+    # the re-push of the same message is acknowledged but not stored
+    assert call(app, 'POST', '/rockblock/incoming', body) == (200, b'OK')
+
+    with Session(engine) as session:
+        msg = session.query(md.RockBlockMessage).one()
+        assert msg.momsn == 441
+        assert msg.iridium_latitude == '37.7740'
+        assert msg.status.status == 'new'
+    on_new_rbm.delay.assert_called_once_with(msg.id)
+
+
+@patch('paikea.tasks.on_new_rbm')
+def test_asgi_rockblock_incoming_commit_failed(on_new_rbm, ingest_app):
+    app, engine = ingest_app
+    md.RBMessageStatus.__table__.drop(engine)
+    body = urlencode(ROCKBLOCK_INCOMING[0]).encode('ascii')
+
+    # not acknowledged, so RockBLOCK sends it again
+    assert call(app, 'POST', '/rockblock/incoming', body)[0] == 500
+    with Session(engine) as session:
+        assert session.query(md.RockBlockMessage).count() == 0
+    on_new_rbm.delay.assert_not_called()
+
+
+@patch('paikea.tasks.on_new_rbm')
+def test_asgi_rockblock_incoming_errors(on_new_rbm, ingest_app):
+    app, engine = ingest_app
+    assert call(app, 'POST', '/rockblock/incoming', b'imei=1')[0] == 400
+    assert call(app, 'GET', '/rockblock/incoming')[0] == 405
+    assert call(app, 'POST', '/v1/rockblocks')[0] == 404
+    big = b'x' * (TestConfig.INGEST_MAX_BODY + 1)
+    assert call(app, 'POST', '/rockblock/incoming', big)[0] == 413
+    on_new_rbm.delay.assert_not_called()
+
+
+@patch('paikea.tasks.on_new_rockcore')
+def test_asgi_rockstar_incoming(on_new_rockcore, ingest_app):
+    app, engine = ingest_app
+    body = json.dumps(ird_msg).encode('utf-8')
+
+    assert call(app, 'POST', '/rockstar/incoming', body) == (200, b'OK')
+
+    with Session(engine) as session:
+        msg = session.query(md.RockCorePushAPI).one()
+    on_new_rockcore.delay.assert_called_once_with(msg.id)
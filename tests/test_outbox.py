@@ -0,0 +1,261 @@
+import time
+import threading
+from datetime import datetime, timedelta
+from unittest.mock import patch
+import binascii
+import pytest
+from message_fixtures import (
+    single_test_rock_block_message,
+    pk005,
+)
+import paikea.tasks as tasks
+import paikea.outbox as outbox
+import paikea.models as md
+
+
+def add_queues(db, names):
+    queues = [md.SQS_Endpoint(queue_name=name, url=f"http://q.url/{name}")
+              for name in names]
+    db.session.add_all(queues)
+    db.session.commit()
+    routes = [md.EndpointRoute(
+        source_device_type='handset', source_device=1, msg_type='command',
+        endpoint_type='sqs', endpoint_id=queue.id) for queue in queues]
+    db.session.add_all(routes)
+    db.session.commit()
+    # ids, as running a task detaches the objects
+    return [queue.id for queue in queues], [route.id for route in routes]
+
+
+@patch('paikea.tasks.kick_outbox')
+@patch('paikea.tasks.send_to_endpoints')
+def test_process_rbm_outbox(send_to_endpoints, kick_outbox, flask_app,
+                            database):
+    db = database
+    flask_app.config['OUTBOX_ENABLED'] = True
+    db.session.add(md.RockBlockModem(imei="TESTIMEI1234", serial='13760',
+                                     device_type='handset'))
+    queues, routes = add_queues(db, ['q1', 'q2'])
+
+    msg = single_test_rock_block_message(pk005(True))
+    msg.status = md.RBMessageStatus(status='new')
+    db.session.add(msg)
+    db.session.commit()
+    msg_id = msg.id
+
+    tasks.process_rbm(msg_id)
+
+    cmd = db.session.query(md.DeviceCommandMessage).one()
+    attempts = db.session.query(md.DeliveryAttempt).\
+        order_by(md.DeliveryAttempt.id).all()
+    assert [a.route_id for a in attempts] == routes
+    assert {a.status for a in attempts} == {'pending'}
+    assert attempts[0].msg_id == cmd.id
+    assert attempts[0].idempotency_key == \
+        outbox.delivery_key(routes[0], 'command', cmd.id)
+    send_to_endpoints.assert_not_called()
+    kick_outbox.assert_called_once_with(commands=True)
+
+
+@patch('paikea.tasks.kick_outbox')
+def test_process_rbm_outbox_no_routes(kick_outbox, flask_app, database):
+    db = database
+    flask_app.config['OUTBOX_ENABLED'] = True
+    db.session.add(md.RockBlockModem(imei="TESTIMEI1234", serial='13760',
+                                     device_type='handset'))
+    msg = single_test_rock_block_message(pk005(True))
+    msg.status = md.RBMessageStatus(status='new')
+    db.session.add(msg)
+    db.session.commit()
+
+    tasks.process_rbm(msg.id)
+
+    assert db.session.query(md.DeviceCommandMessage).count() == 1
+    assert db.session.query(md.DeliveryAttempt).count() == 0
+    kick_outbox.assert_not_called()
+
+
+@patch('paikea.tasks.formatter_router')
+def test_dispatch_outbox(formatter_router, flask_app, database):
+    db = database
+    flask_app.config['OUTBOX_MAX_ATTEMPTS'] = 2
+    formatter_router.return_value = lambda msg_id: f"formatted {msg_id}"
+    queues, routes = add_queues(db, ['ok', 'broken', 'later'])
+
+    db.session.add_all([md.DeliveryAttempt(
+        route_id=route_id, endpoint_type='sqs', endpoint_id=queue_id,
+        msg_type='command', msg_id=3,
+        idempotency_key=outbox.delivery_key(route_id, 'command', 3))
+        for queue_id, route_id in zip(queues, routes)])
+    db.session.commit()
+    later = db.session.query(md.DeliveryAttempt).\
+        filter_by(endpoint_id=queues[2]).one()
+    later.next_attempt_at = datetime.utcnow() + timedelta(hours=1)
+    db.session.commit()
+
+    sent = []
+
+    def send(queue, msg, idempotency_key=None):
+        if queue.queue_name == 'broken':
+            raise ValueError("queue broken")
+        sent.append((queue.queue_name, msg, idempotency_key))
+
+    def statuses():
+        return {a.endpoint_id: (a.status, a.attempts) for a in
+                db.session.query(md.DeliveryAttempt)}
+
+    with patch.object(md.SQS_Endpoint, 'send', autospec=True,
+                      side_effect=send):
+        results = tasks.dispatch_outbox()
+        assert len(results) == 2
+        assert sent == [('ok', "formatted 3",
+                         outbox.delivery_key(routes[0], 'command', 3))]
+        assert statuses() == {queues[0]: ('delivered', 0),
+                              queues[1]: ('pending', 1),
+                              queues[2]: ('pending', 0)}
+
+        broken = db.session.query(md.DeliveryAttempt).\
+            filter_by(endpoint_id=queues[1]).one()
+        assert broken.last_error == "queue broken"
+        backoff = broken.next_attempt_at - datetime.utcnow()
+        assert timedelta(seconds=25) < backoff <= timedelta(seconds=30)
+
+        # nothing is due until the backoff has passed
+        assert tasks.dispatch_outbox() == []
+
+        db.session.query(md.DeliveryAttempt).\
+            filter_by(endpoint_id=queues[1]).\
+            update({'next_attempt_at': datetime.utcnow()})
+        db.session.commit()
+        tasks.dispatch_outbox()
+        assert statuses()[queues[1]] == ('dead', 2)
+        assert len(sent) == 1
+
+    assert outbox.retry_dead() == 1
+    assert statuses()[queues[1]] == ('pending', 0)
+
+
+def test_claim_due(flask_app, database):
+    db = database
+    queues, routes = add_queues(db, ['q1', 'q2'])
+    attempts = [md.DeliveryAttempt(
+        route_id=route_id, endpoint_type='sqs', endpoint_id=queue_id,
+        msg_type='command', msg_id=1,
+        idempotency_key=outbox.delivery_key(route_id, 'command', 1))
+        for queue_id, route_id in zip(queues, routes)]
+    db.session.add_all(attempts)
+    db.session.commit()
+
+    claimed = outbox.claim_due(10, 'first')
+    assert {a.claimed_by for a in claimed} == {'first'}
+    assert outbox.claim_due(10, 'second') == []
+
+    # a claim left by a dispatcher which died mid send expires
+    stale = claimed[0]
+    stale.claimed_at = datetime.utcnow() - timedelta(
+        seconds=flask_app.config['OUTBOX_LEASE_SECONDS'] + 1)
+    db.session.commit()
+    assert [a.id for a in outbox.claim_due(10, 'second')] == [stale.id]
+
+
+@patch('paikea.tasks.formatter_router')
+def test_dispatch_outbox_timeout(formatter_router, flask_app, database):
+    db = database
+    flask_app.config['ENDPOINT_SEND_TIMEOUT'] = 0.2
+    formatter_router.return_value = lambda msg_id: f"formatted {msg_id}"
+    queues, routes = add_queues(db, ['slow'])
+    db.session.add(md.DeliveryAttempt(
+        route_id=routes[0], endpoint_type='sqs', endpoint_id=queues[0],
+        msg_type='command', msg_id=3,
+        idempotency_key=outbox.delivery_key(routes[0], 'command', 3)))
+    db.session.commit()
+
+    sent = []
+    finish = threading.Event()
+
+    def send(queue, msg, idempotency_key=None):
+        finish.wait(5)
+        sent.append(msg)
+
+    def attempt():
+        db.session.expire_all()
+        return db.session.query(md.DeliveryAttempt).one()
+
+    with patch.object(md.SQS_Endpoint, 'send', autospec=True,
+                      side_effect=send):
+        assert tasks.dispatch_outbox()[0]['status'] == 'timeout'
+        # still in flight, so not claimed and sent again
+        assert attempt().status == 'sending'
+        assert tasks.dispatch_outbox() == []
+
+        finish.set()
+        deadline = time.monotonic() + 5
+        while attempt().status == 'sending' and time.monotonic() < deadline:
+            time.sleep(0.05)
+
+    assert (attempt().status, attempt().attempts) == ('delivered', 0)
+    assert sent == ["formatted 3"]
+
+
+@pytest.mark.parametrize('attempts, seconds', [(1, 30), (3, 120), (20, 3600)])
+def test_backoff(attempts, seconds, flask_app):
+    with flask_app.app_context():
+        assert outbox.backoff(attempts) == seconds
+
+
+def test_command_coalescing(flask_app, database):
+    db = database
+    flask_app.config['COMMAND_COALESCE_SECONDS'] = 60
+    buoy = md.RockBlockModem(imei="BUOYIMEI", device_type='buoy')
+    db.session.add(buoy)
+    db.session.commit()
+    buoy_id = buoy.id
+    db.session.add(md.EndpointRoute(
+        source_device_type='handset', source_device=1, msg_type='command',
+        endpoint_type='buoy', endpoint_id=buoy_id))
+    db.session.commit()
+
+    cmd_ids = []
+    for command, value in [("PK006", "10"), ("PK005", "1"), ("PK006", "20"),
+                           ("PK005", "0"), ("PK006", "30")]:
+        cmd = md.DeviceCommandMessage(
+            command=command, value=value, source_msg_type='handset',
+            source_msg_id=1, source_device_type='handset',
+            source_device_id=1)
+        db.session.add(cmd)
+        # commands are held for coalescing without OUTBOX_ENABLED
+        assert tasks.enqueue_deliveries(1, 'handset', cmd, 'command')
+        db.session.commit()
+        cmd_ids.append(cmd.id)
+
+    # nothing is sent within the window
+    assert tasks.dispatch_outbox() == []
+
+    # once the first is due, every pending command to the buoy is merged
+    db.session.query(md.DeliveryAttempt).\
+        filter_by(msg_id=cmd_ids[0]).\
+        update({'next_attempt_at': datetime.utcnow()})
+    db.session.commit()
+
+    with patch.object(md.RockBlockModem, 'send', autospec=True) as send:
+        results = tasks.dispatch_outbox()
+
+    assert send.call_count == 1
+    payload = binascii.unhexlify(send.call_args[0][1]).decode('ascii')
+    assert payload == "+DATA:PK005,0;PK006,30;"
+    assert results[0]['msg_id'] == cmd_ids[4]
+    assert results[0]['merged'] == [cmd_ids[3]]
+
+    status = {a.msg_id: a.status for a in
+              db.session.query(md.DeliveryAttempt)}
+    assert [status[i] for i in cmd_ids] == \
+        ['superseded'] * 3 + ['delivered'] * 2
+
+    cmds = {c.id: c for c in db.session.query(md.DeviceCommandMessage)}
+    assert [(cmds[i].coalesce_status, cmds[i].coalesced_into)
+            for i in cmd_ids] == [
+        ('superseded', cmd_ids[2]),
+        ('superseded', cmd_ids[3]),
+        ('superseded', cmd_ids[4]),
+        ('merged', cmd_ids[4]),
+        (None, None)]
@@ -6,6 +6,7 @@ from paikea.paikea_protocol import (
     convert_degdm,
     buoy_time_to_datetime,
     transmit_time_to_datetime,
+    payload_msg_type,
 )
 import datetime
 
@@ -45,6 +46,18 @@ def test_parse_iridium_payload_notype():
         parse_iridium_payload(test_case)
 
 
+def test_payload_msg_type():
+    test_case = '504b3030313b6c61743a333734392e353037342c4e533a4e'
+    assert payload_msg_type(test_case) == "PK001"
+    assert payload_msg_type(test_case.upper()) == "PK001"
+    assert payload_msg_type('504b3030343b') == "PK004"
+    # no packet type, or a malformed one
+    assert payload_msg_type('3b6c61743a3130302c6c6f6e3a323030') is None
+    assert payload_msg_type('504b30303b') is None
+    assert payload_msg_type('') is None
+    assert payload_msg_type(None) is None
+
+
 def test_convert_dd():
     d = convert_dd("30.263888889")
     assert d['deg'] == 30
@@ -0,0 +1,110 @@
+import os
+import re
+from datetime import datetime
+import pytest
+from sqlalchemy import create_engine
+import paikea.models as md
+from paikea.extensions import db
+from paikea.firmware_utils import UpgradeStatus
+
+
+#: A Postgres database the plans are also checked on, tables are created and
+#: dropped by the test
+POSTGRES_URI = os.environ.get('PAIKEA_TEST_POSTGRES_URI')
+
+
+def hot_queries():
+    ''' The lookups made for each message, and by the views, routes and
+    firmware modules, as they make them
+    '''
+    rt = md.EndpointRoute
+    return {
+        'modem by imei': db.session.query(md.RockBlockModem).
+        filter_by(imei='300434063000000'),
+        'messages by imei': db.session.query(md.RockBlockMessage).
+        filter(md.RockBlockMessage.imei == '300434063000000'),
+        'messages in window': db.session.query(md.RockBlockMessage.id).filter(
+            md.RockBlockMessage.created_at >= datetime(2026, 1, 1),
+            md.RockBlockMessage.created_at < datetime(2026, 1, 2)),
+        'buoy by modem': db.session.query(md.Buoy.id).filter_by(rb_id=1),
+        'handset by modem': db.session.query(md.Handset.id).
+        filter_by(rb_id=1),
+        'buoy by iam': db.session.query(md.Buoy).filter_by(iam='TEST001'),
+        'handset by iam': db.session.query(md.Handset).
+        filter_by(iam='HS001'),
+        'claim messages': db.session.query(md.RBMessageStatus).filter(
+            md.RBMessageStatus.rbm_id.in_([1, 2, 3]),
+            md.RBMessageStatus.status == 'new'),
+        'new messages': db.session.query(md.RBMessageStatus.rbm_id).
+        filter_by(status='new').order_by(md.RBMessageStatus.id).limit(500),
+        'claimed messages': db.session.query(md.RockBlockMessage).
+        join(md.RBMessageStatus).
+        filter(md.RBMessageStatus.claimed_by == 'token'),
+        'pk001 by message': db.session.query(md.PK001).
+        filter(md.PK001.rbm_id.in_([1, 2, 3])),
+        'pk004 by message': db.session.query(md.PK004).
+        filter(md.PK004.rbm_id.in_([1, 2, 3])),
+        'duplicate route': db.session.query(rt).filter_by(
+            source_device_type='buoy', source_device=1, msg_type='pk001',
+            endpoint_type='sqs', endpoint_id=1),
+        'routes by source': db.session.query(rt).
+        filter(rt.source_device.in_([1, 2, 3])),
+        'routes by participant': db.session.query(rt).filter(
+            ((rt.source_device_type == 'buoy') & (rt.source_device == 1)) |
+            ((rt.endpoint_type == 'buoy') & (rt.endpoint_id == 1))),
+        'upgrades in progress': db.session.query(md.DeviceFirmwareUpgrade).
+        filter_by(device_type='buoy', device_id='TEST001').filter(
+            md.DeviceFirmwareUpgrade.status.notin_([
+                UpgradeStatus["SUCCESS"], UpgradeStatus["FAIL"]])),
+    }
+
+
+def compile_sql(query, engine):
+    return str(query.statement.compile(
+        engine, compile_kwargs={'literal_binds': True}))
+
+
+def sqlite_scans(conn, sql):
+    ''' Tables read by a full scan, from EXPLAIN QUERY PLAN '''
+    details = [row[-1] for row in
+               conn.exec_driver_sql(f"EXPLAIN QUERY PLAN {sql}")]
+    return [detail for detail in details
+            if re.match(r'SCAN (TABLE )?\w+$', detail)]
+
+
+def postgres_scans(conn, sql):
+    ''' Tables read by a sequential scan, from EXPLAIN.  Sequential scans
+    are disabled so an empty table is still read by index if it can be.
+    '''
+    conn.exec_driver_sql("SET enable_seqscan = off")
+    lines = [row[0] for row in conn.exec_driver_sql(f"EXPLAIN {sql}")]
+    return [line.strip() for line in lines if 'Seq Scan' in line]
+
+
+def test_sqlite_query_plans(database):
+    engine = database.engine
+    scans = {}
+    with engine.connect() as conn:
+        for name, query in hot_queries().items():
+            found = sqlite_scans(conn, compile_sql(query, engine))
+            if found:
+                scans[name] = found
+    assert scans == {}
+
+
+@pytest.mark.skipif(not POSTGRES_URI,
+                    reason="PAIKEA_TEST_POSTGRES_URI is not set")
+def test_postgres_query_plans(database):
+    engine = create_engine(POSTGRES_URI)
+    db.metadata.create_all(engine)
+    scans = {}
+    try:
+        with engine.connect() as conn:
+            for name, query in hot_queries().items():
+                found = postgres_scans(conn, compile_sql(query, engine))
+                if found:
+                    scans[name] = found
+    finally:
+        db.metadata.drop_all(engine)
+        engine.dispose()
+    assert scans == {}
@@ -0,0 +1,168 @@
+import json
+from datetime import datetime
+from unittest.mock import patch
+import pytest
+from sqlalchemy import event
+from message_fixtures import (
+    single_test_rock_block_message,
+    pk001,
+    pk004,
+    pk005,
+)
+import paikea.models as md
+from paikea.reprocess import (
+    reprocess,
+    select_messages,
+    upsert_records,
+    RateLimiter,
+)
+
+
+LOCATION = {'lat': 3745.7985, 'lon': -12223.4344, 'utc': '221236.000',
+            'ns': 'N', 'ew': 'W', 'cog': '13.4', 'sog': '1.2'}
+
+
+@pytest.fixture
+def stored_messages(database):
+    db = database
+    modem = md.RockBlockModem(imei="TESTIMEI1234", serial='13760',
+                              device_type='buoy')
+    db.session.add(modem)
+    db.session.commit()
+
+    pkts = [pk001(LOCATION)] * 4 + \
+        [pk004(LOCATION), pk005(True), "PK001;lat:bad"]
+    for momsn, pkt in enumerate(pkts):
+        rbm = single_test_rock_block_message(pkt)
+        rbm.momsn = momsn
+        rbm.rb_id = modem.id
+        db.session.add(rbm)
+    db.session.commit()
+
+    # a record from before the parser fix
+    db.session.add(md.PK001(rbm_id=1, device_latitude=0))
+    db.session.commit()
+    yield db
+
+
+def pk001_records(db):
+    return {pk.rbm_id: pk for pk in db.session.query(md.PK001)}
+
+
+def test_reprocess(stored_messages, tmp_path):
+    db = stored_messages
+    checkpoint = tmp_path / "reprocess.json"
+
+    state = reprocess({}, batch_size=3, workers=1,
+                      checkpoint=str(checkpoint))
+    assert (state['parsed'], state['upserted'], state['errors'],
+            state['skipped']) == (7, 5, 1, 1)
+    assert json.loads(checkpoint.read_text())['last_id'] == 7
+
+    records = pk001_records(db)
+    assert sorted(records) == [1, 2, 3, 4]
+    assert [pk.id for pk in db.session.query(md.PK001).
+            filter_by(rbm_id=1)] == [1]
+    assert float(records[1].device_latitude) == pytest.approx(37.763308)
+    assert db.session.query(md.PK004).one().rbm_id == 5
+
+    # a finished run has nothing left to do
+    assert reprocess({}, workers=1,
+                     checkpoint=str(checkpoint))['parsed'] == 7
+    with pytest.raises(ValueError):
+        reprocess({'imei': "OTHER"}, checkpoint=str(checkpoint))
+
+
+def test_reprocess_resume(stored_messages, tmp_path):
+    db = stored_messages
+    checkpoint = str(tmp_path / "reprocess.json")
+    filters = {'msg_types': ['PK001']}
+
+    def interrupt(state):
+        raise KeyboardInterrupt
+
+    with pytest.raises(KeyboardInterrupt):
+        reprocess(filters, batch_size=2, workers=1, checkpoint=checkpoint,
+                  progress=interrupt)
+    assert len(pk001_records(db)) == 2
+
+    batches = []
+    state = reprocess(filters, batch_size=2, workers=1,
+                      checkpoint=checkpoint,
+                      progress=lambda s: batches.append(s['last_id']))
+    assert batches == [4, 6, 7]
+    assert (state['parsed'], state['upserted']) == (7, 4)
+    assert db.session.query(md.PK004).count() == 0
+
+
+def test_select_messages_by_transmit_time(stored_messages):
+    db = stored_messages
+    # the others keep the percent-encoded 20-10-02 21:07:37 of older rows
+    transmit_times = {2: '20-10-03 08:00:00', 3: '20-10-04 00:00:00',
+                      4: '20-10-01%2012%3A00%3A00'}
+    for rbm_id, transmit_time in transmit_times.items():
+        db.session.get(md.RockBlockMessage, rbm_id).transmit_time = \
+            transmit_time
+    db.session.commit()
+
+    filters = {'since': datetime(2020, 10, 2, 21),
+               'until': '2020-10-04T00:00:00'}
+    assert [row.id for row in select_messages(filters)] == [1, 2, 5, 6, 7]
+
+
+def test_upsert_records(stored_messages):
+    db = stored_messages
+    records = {rbm_id: {'rbm_id': rbm_id, 'device_latitude': rbm_id}
+               for rbm_id in [1, 2, 3, 4]}
+    statements = []
+
+    def count(*args):
+        statements.append(args[2].split()[0])
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        ids = upsert_records('PK001', records)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+    db.session.commit()
+
+    # one update and one insert, whatever the number of records
+    assert statements.count('UPDATE') == 1
+    assert statements.count('INSERT') == 1
+    assert ids[1] == 1
+    assert {rbm_id: float(pk.device_latitude) for rbm_id, pk in
+            pk001_records(db).items()} == {1: 1, 2: 2, 3: 3, 4: 4}
+    assert {pk.rbm_id: pk.id for pk in db.session.query(md.PK001)} == ids
+
+
+def test_reprocess_pool(stored_messages):
+    db = stored_messages
+    state = reprocess({'imei': "TESTIMEI1234"}, batch_size=10, workers=2)
+    assert (state['parsed'], state['upserted']) == (7, 5)
+    assert len(pk001_records(db)) == 4
+
+
+@patch('paikea.reprocess.RateLimiter.wait')
+@patch('paikea.tasks.dispatch_grouped')
+def test_reprocess_dispatch(dispatch_grouped, wait, stored_messages):
+    dispatch_grouped.side_effect = lambda sends: [
+        {'status': 'sent'} for send in sends]
+    reprocess({}, batch_size=10, workers=1, dispatch=True, rate=2)
+
+    sends = [send for call in dispatch_grouped.call_args_list
+             for send in call[0][0]]
+    assert [len(call[0][0]) for call in dispatch_grouped.call_args_list] == \
+        [2, 2, 1]
+    assert [wait_call[0][0] for wait_call in wait.call_args_list] == [2, 2, 1]
+    assert [(source_type, msg_type) for source, source_type, msg_id, msg_type
+            in sends] == [('buoy', 'pk001')] * 4 + [('buoy', 'pk004')]
+
+
+def test_rate_limiter():
+    with patch('paikea.reprocess.time') as clock:
+        clock.monotonic.return_value = 100.0
+        limiter = RateLimiter(rate=10)
+        limiter.wait(5)
+        clock.sleep.assert_not_called()
+        limiter.wait(5)
+        clock.sleep.assert_called_once_with(pytest.approx(0.5))
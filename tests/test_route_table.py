@@ -0,0 +1,94 @@
+from sqlalchemy import event
+import paikea.models as md
+from paikea.cache import (
+    RouteTable,
+    cache_version,
+    get_route_table,
+)
+
+
+def add_routes(db, modems, queues):
+    modems[0].device_type = 'buoy'
+    modems[1].device_type = 'handset'
+    routes = [
+        md.EndpointRoute(source_device_type='buoy', source_device=modems[0].id,
+                         msg_type='pk001', endpoint_type='sqs',
+                         endpoint_id=queues[0].id),
+        md.EndpointRoute(source_device_type='buoy', source_device=modems[0].id,
+                         msg_type='pk001', endpoint_type='handset',
+                         endpoint_id=modems[1].id),
+        md.EndpointRoute(source_device_type='handset',
+                         source_device=modems[1].id, msg_type='pk001',
+                         endpoint_type='buoy', endpoint_id=modems[0].id),
+        md.EndpointRoute(source_device_type='buoy', source_device=modems[0].id,
+                         msg_type='pk004', endpoint_type='sqs',
+                         endpoint_id=queues[1].id, enabled=False),
+        md.EndpointRoute(source_device_type='buoy', source_device=modems[0].id,
+                         msg_type='pk004', endpoint_type='sqs',
+                         endpoint_id=999),
+    ]
+    db.session.add_all(routes)
+    db.session.commit()
+    return [route.id for route in routes]
+
+
+def test_route_table(create_modems, create_queues, database):
+    db = database
+    route_ids = add_routes(db, create_modems, create_queues)
+    buoy, handset = create_modems[0].id, create_modems[1].id
+    queue = create_queues[0].id
+
+    statements = []
+
+    def count(*args):
+        statements.append(args[2])
+
+    table = RouteTable(check_seconds=60)
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        routes = table.lookup('buoy', buoy, 'pk001')
+        # versions, routes, and one query each for queues and modems
+        assert len(statements) == 4
+        for x in range(10):
+            assert table.lookup('buoy', buoy, 'pk001') == routes
+            assert table.endpoint('sqs', queue).id == queue
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+    assert len(statements) == 4
+
+    assert [r.id for r in routes] == route_ids[:2]
+    assert [type(r.get_endpoint()) for r in routes] == \
+        [md.SQS_Endpoint, md.RockBlockModem]
+    assert routes[1].get_endpoint().id == handset
+    assert table.lookup('handset', handset, 'pk001')[0].endpoint.id == buoy
+    # disabled routes, and routes to missing endpoints, are left out
+    assert table.lookup('buoy', buoy, 'pk004') == []
+    assert table.endpoint('sqs', create_queues[1].id) is None
+
+
+def test_route_table_invalidate(create_modems, create_queues, flask_app,
+                                database):
+    db = database
+    route_ids = add_routes(db, create_modems, create_queues)
+    buoy = create_modems[0].id
+
+    table = get_route_table()
+    table.check_seconds = 60
+    assert len(table.lookup('buoy', buoy, 'pk001')) == 2
+
+    with flask_app.test_client() as client:
+        response = client.post('/v1/routing/enable',
+                               json={'id': route_ids[0], 'enable': False})
+    assert response.status_code == 200
+    assert cache_version('routes') == 1
+    assert [r.id for r in table.lookup('buoy', buoy, 'pk001')] == \
+        route_ids[1:2]
+
+    # another process's change is picked up at the next check
+    other = RouteTable(check_seconds=0)
+    assert len(other.lookup('buoy', buoy, 'pk001')) == 1
+    db.session.query(md.EndpointRoute).filter_by(id=route_ids[0]).\
+        update({'enabled': True})
+    table.invalidate()
+    db.session.commit()
+    assert len(other.lookup('buoy', buoy, 'pk001')) == 2
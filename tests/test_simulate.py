@@ -0,0 +1,104 @@
+import binascii
+from unittest.mock import patch
+import pytest
+from message_fixtures import (
+    single_test_rock_block_message,
+    pk001,
+)
+import paikea.models as md
+from paikea.simulate import (
+    SimulationError,
+    payload_size,
+    simulate,
+)
+
+
+LOCATION = {'lat': 3745.7985, 'lon': -12223.4344, 'utc': '221236.000',
+            'ns': 'N', 'ew': 'W', 'cog': '13.4', 'sog': '1.2'}
+
+
+@pytest.fixture
+def routed_buoy(database):
+    db = database
+    buoy = md.RockBlockModem(imei="TESTIMEI1234", serial='13760',
+                             device_type='buoy')
+    handset = md.RockBlockModem(imei="TESTIMEI5678", serial='17458',
+                                device_type='handset')
+    queue = md.SQS_Endpoint(queue_name="queue1", url="http://notareal.url/q")
+    db.session.add_all([buoy, handset, queue])
+    db.session.commit()
+
+    db.session.add_all([
+        md.EndpointRoute(source_device_type='buoy', source_device=buoy.id,
+                         msg_type='pk001', endpoint_type='sqs',
+                         endpoint_id=queue.id),
+        md.EndpointRoute(source_device_type='buoy', source_device=buoy.id,
+                         msg_type='pk001', endpoint_type='handset',
+                         endpoint_id=handset.id),
+    ])
+    rbm = single_test_rock_block_message(pk001(LOCATION))
+    rbm.rb_id = buoy.id
+    db.session.add(rbm)
+    db.session.commit()
+    yield db
+
+
+def counts(db):
+    return [db.session.query(model).count() for model in
+            [md.RockBlockMessage, md.PK001, md.MessageParsingError]]
+
+
+@patch('paikea.models.RockBlockModem.send')
+@patch('paikea.models.SQS_Endpoint.send')
+def test_simulate(sqs_send, modem_send, routed_buoy):
+    db = routed_buoy
+    before = counts(db)
+
+    result = simulate(rbm_id=1)
+    assert (result['msg_type'], result['message_type'], result['source']) == \
+        ('PK001', 'pk001', {'type': 'buoy', 'id': 1})
+    assert set(result['timings']) == {'parse', 'route', 'format'}
+
+    sqs, handset = result['endpoints']
+    assert sqs['endpoint_type'] == 'sqs'
+    assert sqs['credits'] is None
+    assert sqs['bytes'] == len(sqs['payload'])
+    assert handset['endpoint_type'] == 'handset'
+    assert binascii.unhexlify(handset['payload']).startswith(b"+DATA:PK004")
+    assert handset['bytes'] == len(handset['payload']) // 2
+    assert handset['credits'] == 2
+
+    # a raw payload from the buoy routes the same way
+    payload = binascii.hexlify(pk001(LOCATION).encode('ascii')).decode()
+    result = simulate(payload=payload, imei="TESTIMEI1234")
+    assert [e['endpoint_type'] for e in result['endpoints']] == \
+        ['sqs', 'handset']
+
+    sqs_send.assert_not_called()
+    modem_send.assert_not_called()
+    assert counts(db) == before
+
+    with pytest.raises(SimulationError):
+        simulate(rbm_id=99)
+    with pytest.raises(SimulationError):
+        simulate(payload=payload, imei="UNKNOWN")
+    with pytest.raises(SimulationError):
+        simulate(payload="00", imei="TESTIMEI1234")
+    assert counts(db) == before
+
+
+def test_simulate_api(routed_buoy, flask_app):
+    with flask_app.test_client() as client:
+        resp = client.post("/v1/routing/simulate", json={'rbm_id': 1})
+        assert resp.status_code == 200
+        assert len(resp.json['endpoints']) == 2
+
+        resp = client.post("/v1/routing/simulate", json={'payload': "00"})
+        assert resp.status_code == 400
+
+
+def test_payload_size():
+    assert payload_size("ab" * 50, 'buoy') == (50, 1)
+    assert payload_size("ab" * 51, 'handset') == (51, 2)
+    assert payload_size(b"+DATA:PK004,1;", 'handset') == (14, 1)
+    assert payload_size('{"a": 1}', 'sqs') == (8, None)
@@ -0,0 +1,166 @@
+import os
+import threading
+import multiprocessing
+from urllib.parse import urlencode
+from unittest.mock import patch
+from utils import (
+    ROCKBLOCK_INCOMING,
+    ROCKBLOCK_BATCH,
+)
+import paikea.models as md
+import paikea.spool as spool
+from paikea.utils import parse_push
+
+
+def test_spool_append_and_read(tmp_path):
+    sp = spool.Spool(str(tmp_path), group_commit_wait=0)
+    bodies = [f"message {x}".encode('ascii') for x in range(5)]
+    for body in bodies:
+        sp.append(body)
+
+    segs = spool.segments(str(tmp_path))
+    assert len(segs) == 1
+    path, sealed = segs[0]
+    assert not sealed
+
+    records = spool.read_records(path)
+    assert [body for body, end in records] == bodies
+    assert records[-1][1] == os.path.getsize(path)
+
+    sp.seal()
+    path, sealed = spool.segments(str(tmp_path))[0]
+    assert sealed
+    assert path.endswith(spool.SEALED_SUFFIX)
+
+
+def test_spool_torn_record(tmp_path):
+    sp = spool.Spool(str(tmp_path), group_commit_wait=0)
+    sp.append(b"complete")
+    sp.seal()
+    path, sealed = spool.segments(str(tmp_path))[0]
+    with open(path, 'ab') as f:
+        f.write(spool.encode_record(b"torn record")[:-3])
+
+    records = spool.read_records(path)
+    assert [body for body, end in records] == [b"complete"]
+
+
+def test_spool_concurrent_append(tmp_path):
+    sp = spool.Spool(str(tmp_path), segment_bytes=256, group_commit_wait=0.001)
+
+    def writer(n):
+        for x in range(20):
+            sp.append(f"{n}:{x}".encode('ascii'))
+
+    threads = [threading.Thread(target=writer, args=(n, )) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    sp.seal()
+
+    bodies = []
+    for path, sealed in spool.segments(str(tmp_path)):
+        assert sealed
+        bodies.extend(body for body, end in spool.read_records(path))
+
+    assert len(bodies) == 80
+    assert len(set(bodies)) == 80
+
+
+def spool_writer(directory, appended, release):
+    sp = spool.Spool(directory, group_commit_wait=0)
+    sp.append(b"from another process")
+    appended.set()
+    release.wait(10)
+    # die without sealing
+    os._exit(0)
+
+
+def test_spool_abandoned_segment(tmp_path):
+    ctx = multiprocessing.get_context('fork')
+    appended, release = ctx.Event(), ctx.Event()
+    writer = ctx.Process(target=spool_writer,
+                         args=(str(tmp_path), appended, release))
+    writer.start()
+    assert appended.wait(10)
+
+    # the writer holds the lock on its segment, so it is left open
+    path, sealed = spool.segments(str(tmp_path))[0]
+    assert not sealed
+    assert path.endswith(spool.OPEN_SUFFIX)
+
+    release.set()
+    writer.join(10)
+    path, sealed = spool.segments(str(tmp_path))[0]
+    assert sealed
+    assert [body for body, end in spool.read_records(path)] == \
+        [b"from another process"]
+
+    # a segment whose writer died before locking it is removed
+    stale = tmp_path / f"{0:020d}-1{spool.NEW_SUFFIX}"
+    stale.write_bytes(b"")
+    assert len(spool.segments(str(tmp_path))) == 1
+    assert not stale.exists()
+
+
+@patch('paikea.tasks.on_new_rbm_batch')
+def test_spool_drain(on_new_rbm_batch, tmp_path, database):
+    db = database
+    sp = spool.Spool(str(tmp_path), group_commit_wait=0)
+    for msg in ROCKBLOCK_BATCH:
+        sp.append(urlencode(msg).encode('ascii'))
+
+    drained = spool.drain(str(tmp_path), batch_size=2)
+    assert drained == len(ROCKBLOCK_BATCH)
+    assert on_new_rbm_batch.delay.call_count == 3
+
+    msgs = db.session.query(md.RockBlockMessage).all()
+    assert len(msgs) == len(ROCKBLOCK_BATCH)
+    for msg in msgs:
+        assert msg.status.status == 'new'
+
+    # acknowledged records are not replayed, the open segment is kept
+    assert spool.drain(str(tmp_path)) == 0
+    assert len(spool.segments(str(tmp_path))) == 1
+
+    # a replayed push is a duplicate
+    sp.append(urlencode(ROCKBLOCK_BATCH[0]).encode('ascii'))
+    sp.append(urlencode(dict(ROCKBLOCK_BATCH[0], momsn='9')).encode('ascii'))
+    sp.seal()
+    assert spool.drain(str(tmp_path)) == 2
+    assert len(db.session.query(md.RockBlockMessage).all()) == \
+        len(ROCKBLOCK_BATCH) + 1
+    assert not spool.segments(str(tmp_path))
+
+
+@patch('paikea.tasks.on_new_rbm_batch')
+def test_spool_drain_bad_message(on_new_rbm_batch, tmp_path, database):
+    db = database
+    sp = spool.Spool(str(tmp_path), group_commit_wait=0)
+    sp.append(b"imei=1234&data=00")
+    sp.seal()
+
+    assert spool.drain(str(tmp_path)) == 1
+    assert not db.session.query(md.RockBlockMessage).all()
+    mpe = db.session.query(md.MessageParsingError).one()
+    assert mpe.msg_source == "Spool"
+    assert not on_new_rbm_batch.delay.called
+
+
+@patch('paikea.tasks.on_new_rbm')
+def test_spooled_incoming(on_new_rbm, tmp_path, flask_app, database):
+    db = database
+    flask_app.config['SPOOL_ENABLED'] = True
+    flask_app.config['SPOOL_DIR'] = str(tmp_path)
+
+    with flask_app.test_client() as client:
+        result = client.post('/rockblock/incoming', data=ROCKBLOCK_INCOMING[0])
+    assert result.data == b'OK'
+    assert not db.session.query(md.RockBlockMessage).all()
+    assert not on_new_rbm.delay.called
+
+    path, sealed = spool.segments(str(tmp_path))[0]
+    body, end = spool.read_records(path)[0]
+    assert parse_push(body)['imei'] == ROCKBLOCK_INCOMING[0]['imei']
+    flask_app.extensions['paikea_spool'].seal()
@@ -0,0 +1,118 @@
+import binascii
+import time
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from message_fixtures import pk001
+import paikea.models as md
+import paikea.stages as stages
+import paikea.tasks as tasks
+from paikea.ingest import store_rockblock_messages
+
+
+LOCATION = {'lat': 3745.7985, 'lon': -12223.4344, 'utc': '221236.000',
+            'ns': 'N', 'ew': 'W', 'cog': '13.4', 'sog': '1.2'}
+
+
+def push(pkt, momsn):
+    return {'imei': "TESTIMEI1234", 'momsn': momsn, 'serial': '13760',
+            'transmit_time': '20-10-02%2021%3A07%3A37',
+            'iridium_latitude': '37.7740', 'iridium_longitude': '-122.4050',
+            'iridium_cep': '4.0', 'iridium_session_status': '2',
+            'data': binascii.hexlify(pkt.encode('ascii')).decode('ascii')}
+
+
+def test_pipeline_stages(flask_app, database):
+    db = database
+    flask_app.config['STAGE_TIMING_ENABLED'] = True
+    modem = md.RockBlockModem(imei="TESTIMEI1234", serial='13760',
+                              device_type='buoy')
+    queue = md.SQS_Endpoint(queue_name='q', url="http://q.url/q")
+    db.session.add_all([modem, queue])
+    db.session.commit()
+    queue_id = queue.id
+    db.session.add(md.EndpointRoute(
+        source_device_type='buoy', source_device=modem.id, msg_type='pk001',
+        endpoint_type='sqs', endpoint_id=queue_id))
+    db.session.commit()
+
+    received_at = time.time() - 1
+    rbm_id, = store_rockblock_messages(
+        [push(pk001(LOCATION), '1')], received_at)
+
+    with patch.object(md.SQS_Endpoint, 'send', autospec=True):
+        tasks.process_rbm(rbm_id)
+
+    rows = db.session.query(md.MessageStage).filter_by(rbm_id=rbm_id).\
+        order_by(md.MessageStage.id).all()
+    assert [row.stage for row in rows] == list(stages.STAGES)
+    assert rows[0].at == received_at
+    assert [row.at for row in rows] == sorted(row.at for row in rows)
+    assert rows[-1].endpoint == f"sqs:{queue_id}"
+
+
+def test_no_stages_by_default(flask_app, database):
+    db = database
+    store_rockblock_messages([push(pk001(LOCATION), '1')])
+    assert db.session.query(md.MessageStage).count() == 0
+
+
+def test_stage_latency(flask_app, database):
+    db = database
+    start = time.time() - 600
+    steps = {'received': 0, 'committed': 0.01, 'started': 0.5,
+             'parsed': 0.52, 'formatted': 0.6}
+    for rbm_id in range(1, 101):
+        db.session.add_all([
+            md.MessageStage(rbm_id=rbm_id, stage=stage, at=start + rbm_id + t)
+            for stage, t in steps.items()])
+        db.session.add(md.MessageStage(
+            rbm_id=rbm_id, stage='sent', endpoint='sqs:1',
+            at=start + rbm_id + 0.6 + rbm_id / 1000))
+    # received before the window
+    db.session.add(md.MessageStage(rbm_id=999, stage='received',
+                                   at=start - 3600))
+    db.session.commit()
+
+    since = datetime.utcfromtimestamp(start)
+    result = stages.latency(since)
+    assert result['messages'] == 100
+    assert result['stages']['started'] == {
+        'count': 100, 'p50_ms': 490.0, 'p95_ms': 490.0, 'p99_ms': 490.0}
+    sent = result['stages']['sent']
+    assert (sent['p50_ms'], sent['p95_ms'], sent['p99_ms']) == \
+        (51.0, 95.0, 99.0)
+    assert result['endpoints']['sqs:1'] == sent
+    assert result['total']['p99_ms'] == 699.0
+
+    assert stages.latency(since, limit=10)['messages'] == 10
+
+    with flask_app.test_client() as client:
+        resp = client.get("/v1/stages/latency",
+                          query_string={'since': since.isoformat()})
+        assert resp.status_code == 200
+        assert resp.json['messages'] == 100
+        assert client.get("/v1/stages/latency?since=yesterday").\
+            status_code == 400
+
+    until = since + timedelta(seconds=50.5)
+    assert stages.latency(since, until)['messages'] == 50
+
+
+def test_record_deliveries_in_transaction(flask_app, database):
+    db = database
+    flask_app.config['STAGE_TIMING_ENABLED'] = True
+    rbm_id, = store_rockblock_messages([push(pk001(LOCATION), '1')])
+    record = md.PK001(rbm_id=rbm_id)
+    db.session.add(record)
+    db.session.commit()
+    result = {'msg_type': 'pk001', 'msg_id': record.id, 'status': 'sent',
+              'endpoint_type': 'sqs', 'endpoint_id': 1}
+
+    modem = md.RockBlockModem(imei="TESTIMEI1234", device_type='buoy')
+    db.session.add(modem)
+    stages.record_deliveries([result], time.time(), [time.time()])
+    # neither the stages nor the caller's pending work are committed
+    db.session.rollback()
+    assert db.session.query(md.RockBlockModem).count() == 0
+    assert db.session.query(md.MessageStage).filter(
+        md.MessageStage.stage.in_(['formatted', 'sent'])).count() == 0
@@ -1,5 +1,7 @@
 import time
+from unittest.mock import patch, MagicMock
 import pytest
+from sqlalchemy import event
 from message_fixtures import (
     single_test_rock_block_message,
     pk001,
@@ -10,6 +12,7 @@ from message_fixtures import (
 import paikea.tasks as tasks
 import paikea.models as md
 import paikea.paikea_protocol as protocol
+from paikea.formatters import message_id
 
 
 def count_mpes(db):
@@ -148,3 +151,239 @@ def test_on_parsing_error(database, flask_celery_app,
         assert mpe.msg_id == "45"
         assert mpe.error == "This is an error all about how"
         assert mpe.error_status == "new"
+
+
+@patch('paikea.tasks.send_to_endpoints')
+def test_process_rbm_pk001(send_to_endpoints, database):
+    db = database
+    loc_data = {
+        'lat': 3779.1234,
+        'lon': 12256.64322,
+        'utc': 104355.9374,
+        'ns': 'N',
+        'ew': 'W',
+        'cog': '167.3',
+        'sog': '2.5',
+    }
+    msg = single_test_rock_block_message(pk001(loc_data))
+    msg.status = md.RBMessageStatus(status='new')
+    db.session.add(msg)
+    db.session.commit()
+    msg_id = msg.id
+
+    tasks.process_rbm(msg_id)
+
+    rbm = db.session.query(md.RockBlockMessage).filter_by(id=msg_id).one()
+    assert rbm.status.status == 'processing'
+    assert rbm.rb.imei == rbm.imei
+    pk001_msg = db.session.query(md.PK001).filter_by(rbm_id=msg_id).one()
+    assert pk001_msg.device_NS == "N"
+    assert -float(pk001_msg.device_longitude) == \
+        pytest.approx(protocol.convert_degdm(str(loc_data['lon'])))
+    send_to_endpoints.assert_called_once()
+    args, kwargs = send_to_endpoints.call_args
+    assert args == (rbm.rb.id, rbm.rb.device_type, pk001_msg.id, 'pk001')
+    # the formatters are given the loaded message and its source
+    assert kwargs['context'].msg_id == pk001_msg.id
+    assert isinstance(kwargs['context'].rbm, md.RockBlockMessage)
+
+    # a message is only processed once
+    tasks.process_rbm(msg_id)
+    assert send_to_endpoints.call_count == 1
+
+
+@patch('paikea.tasks.send_to_endpoints')
+def test_process_rbm_command(send_to_endpoints, database):
+    db = database
+    msg = single_test_rock_block_message(pk005(True))
+    msg.status = md.RBMessageStatus(status='new')
+    db.session.add(msg)
+    db.session.commit()
+    msg_id = msg.id
+
+    tasks.process_rbm(msg_id)
+
+    rbm = db.session.query(md.RockBlockMessage).filter_by(id=msg_id).one()
+    cmd = db.session.query(md.DeviceCommandMessage).\
+        filter_by(source_msg_id=msg_id).one()
+    assert cmd.command == "PK005"
+    assert cmd.value == "1"
+    assert cmd.source_device_id == rbm.rb.id
+    send_to_endpoints.assert_called_once()
+    args, kwargs = send_to_endpoints.call_args
+    assert args == (rbm.rb.id, 'handset', cmd.id, 'command')
+    assert kwargs['context'].msg_id == cmd.id
+
+
+@patch('paikea.tasks.send_to_endpoints')
+def test_process_rbm_no_router(send_to_endpoints, database):
+    db = database
+    msg = single_test_rock_block_message("PK999;1")
+    msg.status = md.RBMessageStatus(status='new')
+    db.session.add(msg)
+    db.session.commit()
+    msg_id = msg.id
+
+    tasks.process_rbm(msg_id)
+
+    rbm = db.session.query(md.RockBlockMessage).filter_by(id=msg_id).one()
+    assert rbm.status.status == 'processing'
+    mpe = db.session.query(md.MessageParsingError).one()
+    assert mpe.msg_id == str(msg_id)
+    assert mpe.error == "No router for PK999"
+    assert not send_to_endpoints.called
+
+
+@patch('paikea.tasks.create_message')
+@patch('paikea.tasks.process_rbm')
+def test_on_new_rbm_pipeline_mode(process_rbm, create_message, flask_app,
+                                  database):
+    db = database
+    msg = single_test_rock_block_message(pk005(True))
+    msg.status = md.RBMessageStatus(status='new')
+    db.session.add(msg)
+    db.session.commit()
+
+    flask_app.config['PIPELINE_MODE'] = 'fused'
+    tasks.on_new_rbm(msg.id)
+    process_rbm.assert_called_once_with(msg.id)
+    assert not create_message.delay.called
+
+    flask_app.config['PIPELINE_MODE'] = 'staged'
+    tasks.on_new_rbm(msg.id)
+    create_message.delay.assert_called_once_with(msg.id)
+
+
+def test_claim_messages(database):
+    db = database
+    msg = single_test_rock_block_message(pk005(True))
+    msg.status = md.RBMessageStatus(status='new')
+    db.session.add(msg)
+    db.session.commit()
+    msg_id = msg.id
+
+    assert tasks.claim_messages([msg_id], 'first') == 1
+    assert tasks.claim_messages([msg_id], 'second') == 0
+    status = db.session.query(md.RBMessageStatus).\
+        filter_by(rbm_id=msg_id).one()
+    assert status.status == 'processing'
+    assert status.claimed_by == 'first'
+
+
+@patch('paikea.models.SQS_Endpoint.send_batch', return_value={})
+@patch('paikea.tasks.formatter_router')
+def test_process_new_rbms(formatter_router, sqs_send_batch, database):
+    db = database
+    modem = md.RockBlockModem(imei="TESTIMEI1234", device_type='buoy')
+    sqs = md.SQS_Endpoint(queue_name="queue1", url="http://notareal.url/q")
+    db.session.add_all([modem, sqs])
+    db.session.commit()
+    db.session.add(md.EndpointRoute(
+        source_device_type='buoy', source_device=modem.id, msg_type='pk001',
+        endpoint_type='sqs', endpoint_id=sqs.id))
+
+    loc_data = {
+        'lat': 3779.1234,
+        'lon': 12256.64322,
+        'utc': 104355.9374,
+        'ns': 'N',
+        'ew': 'W',
+        'cog': '167.3',
+        'sog': '2.5',
+    }
+    payloads = [pk001(loc_data), pk004(loc_data), pk001(loc_data), "PK999;1"]
+    for payload in payloads:
+        msg = single_test_rock_block_message(payload)
+        msg.status = md.RBMessageStatus(status='new')
+        db.session.add(msg)
+    db.session.commit()
+    formatter_router.return_value = \
+        lambda msg: f"formatted {message_id(msg)}"
+
+    statements = []
+
+    def count(*args):
+        statements.append(args[2].split()[:3])
+
+    event.listen(db.engine, 'before_cursor_execute', count)
+    try:
+        assert tasks.process_new_rbms(batch_size=3) == 3
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count)
+    # one insert per record type, whatever the number of records
+    inserts = [s[2] for s in statements if s[:2] == ['INSERT', 'INTO']]
+    assert (inserts.count('p_k001'), inserts.count('p_k004')) == (1, 1)
+    assert len(db.session.query(md.PK001).all()) == 2
+    assert len(db.session.query(md.PK004).all()) == 1
+    pk001_ids = [pm.id for pm in db.session.query(md.PK001)]
+    # both go to the queue in one batch
+    sqs_send_batch.assert_called_once_with(
+        [(f"formatted {pk_id}", None) for pk_id in pk001_ids])
+
+    assert tasks.process_new_rbms(batch_size=3) == 1
+    mpe = db.session.query(md.MessageParsingError).one()
+    assert mpe.error == "No router for PK999"
+    assert not db.session.query(md.RBMessageStatus).\
+        filter_by(status='new').all()
+    assert tasks.process_new_rbms() == 0
+
+
+@patch('paikea.tasks.dispatch_grouped')
+def test_on_new_rbm_batch(dispatch_grouped, database):
+    db = database
+    db.session.add(md.RockBlockModem(imei="TESTIMEI1234",
+                                     device_type='buoy'))
+    loc_data = {
+        'lat': 3779.1234,
+        'lon': 12256.64322,
+        'utc': 104355.9374,
+        'ns': 'N',
+        'ew': 'W',
+        'cog': '167.3',
+        'sog': '2.5',
+    }
+    rbm_ids = []
+    for payload in [pk001(loc_data), pk004(loc_data), pk001(loc_data)]:
+        msg = single_test_rock_block_message(payload)
+        msg.status = md.RBMessageStatus(status='new')
+        db.session.add(msg)
+        db.session.commit()
+        rbm_ids.append(msg.id)
+
+    # the last is claimed elsewhere first
+    assert tasks.claim_messages(rbm_ids[2:], 'other') == 1
+    assert tasks.on_new_rbm_batch(rbm_ids) == 2
+    assert len(db.session.query(md.PK001).all()) == 1
+    assert len(db.session.query(md.PK004).all()) == 1
+    # all sent on from the one task
+    dispatch_grouped.assert_called_once()
+    assert len(dispatch_grouped.call_args[0][0]) == 2
+    assert tasks.on_new_rbm_batch(rbm_ids) == 0
+
+
+def test_queue_in_lane():
+    task = MagicMock()
+    tasks.queue_in_lane(task, 'PK001', 7)
+    task.delay.assert_called_once_with(7)
+
+    tasks.queue_in_lane(task, 'PK006', 8)
+    task.apply_async.assert_called_once_with(
+        (8,), queue='commands', priority=tasks.PRIORITY_COMMAND)
+    assert tasks.send_beacon.priority == tasks.PRIORITY_COMMAND
+    assert tasks.prepare_update_directory.priority == tasks.PRIORITY_FIRMWARE
+
+
+def test_lane_latency(flask_app, caplog):
+    headers = {}
+    tasks.stamp_published_at(headers=headers)
+    assert headers['published_at'] <= time.time()
+
+    task = MagicMock()
+    task.name = 'paikea.tasks.send_beacon'
+    task.request.published_at = time.time() - 10
+    task.request.delivery_info = {'routing_key': 'commands'}
+    with flask_app.app_context():
+        wait = tasks.log_lane_latency(task=task)
+    assert wait == pytest.approx(10, abs=1)
+    assert "Lane commands: paikea.tasks.send_beacon waited" in caplog.text
+    assert caplog.records[-1].levelname == 'WARNING'
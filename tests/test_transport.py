@@ -0,0 +1,85 @@
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+import requests
+from paikea.transport import Transport, get_transport
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    in_flight = 0
+    max_in_flight = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        cls = type(self)
+        with cls.lock:
+            cls.in_flight += 1
+            cls.max_in_flight = max(cls.max_in_flight, cls.in_flight)
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.path == '/slow':
+            time.sleep(0.5)
+        else:
+            time.sleep(0.05)
+        body = f"OK,{self.client_address[1]}".encode('ascii')
+        with cls.lock:
+            cls.in_flight -= 1
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    Handler.max_in_flight = 0
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_transport_keep_alive(server):
+    transport = Transport()
+    ports = {transport.post(f"{server}/MT", {'imei': '1'}).text
+             for _ in range(5)}
+    # every request reused the one connection
+    assert len(ports) == 1
+
+    stats = transport.stats()[server.split('//')[1]]
+    assert stats['requests'] == 5
+    assert stats['errors'] == 0
+    assert stats['p50_ms'] >= 50
+    transport.close()
+
+
+def test_transport_timeout(server):
+    transport = Transport(read_timeout=0.1)
+    with pytest.raises(requests.exceptions.Timeout):
+        transport.post(f"{server}/slow")
+    assert transport.stats()[server.split('//')[1]]['errors'] == 1
+    transport.close()
+
+
+def test_transport_max_per_host(server):
+    transport = Transport(max_per_host=2)
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        list(pool.map(lambda i: transport.post(f"{server}/MT"), range(8)))
+    assert Handler.max_in_flight == 2
+    transport.close()
+
+
+def test_get_transport(flask_app):
+    with flask_app.app_context():
+        transport = get_transport()
+        assert get_transport() is transport
+        assert transport.timeout == (
+            flask_app.config['HTTP_CONNECT_TIMEOUT'],
+            flask_app.config['HTTP_READ_TIMEOUT'])
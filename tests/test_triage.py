@@ -0,0 +1,104 @@
+from unittest.mock import patch
+import pytest
+from sqlalchemy import event
+from message_fixtures import (
+    single_test_rock_block_message,
+    pk001,
+)
+import paikea.models as md
+import paikea.triage as triage
+
+
+LOCATION = {'lat': 3745.7985, 'lon': -12223.4344, 'utc': '221236.000',
+            'ns': 'N', 'ew': 'W', 'cog': '13.4', 'sog': '1.2'}
+OLD_ERROR = "No router for PK001"
+
+
+@pytest.fixture
+def parsing_errors(database):
+    db = database
+    db.session.add(md.RockBlockModem(imei="TESTIMEI1234", serial='13760',
+                                     device_type='buoy'))
+    for momsn, pkt in enumerate([pk001(LOCATION)] * 3 + ["PK001;lat:bad"]):
+        rbm = single_test_rock_block_message(pkt)
+        rbm.momsn = momsn
+        db.session.add(rbm)
+    db.session.commit()
+
+    # rbm 1 failed twice, and 999 does not exist
+    for msg_id in ['1', '1', '2', '3', '4', '999']:
+        db.session.add(md.MessageParsingError(
+            msg_source='Iridium', msg_id=msg_id, error=OLD_ERROR,
+            error_status='new'))
+    db.session.add(md.MessageParsingError(
+        msg_source='Spool', msg_id='segment:10', error="Unreadable",
+        error_status='new'))
+    db.session.commit()
+    yield db
+
+
+def statuses(db):
+    return [status for status, in db.session.query(
+        md.MessageParsingError.error_status).
+        order_by(md.MessageParsingError.id)]
+
+
+def test_error_groups(parsing_errors):
+    groups = triage.error_groups()
+    assert [(g['msg_source'], g['error'], g['count'], g['retryable'])
+            for g in groups] == [('Iridium', OLD_ERROR, 6, True),
+                                 ('Spool', "Unreadable", 1, False)]
+    assert triage.error_groups('resolved') == []
+
+
+@patch('paikea.tasks.send_to_endpoints')
+def test_retry_errors(send_to_endpoints, parsing_errors):
+    db = parsing_errors
+    batches = []
+    updates = []
+
+    def count_updates(conn, cursor, statement, *args):
+        if statement.startswith("UPDATE message_parsing_error"):
+            updates.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', count_updates)
+    try:
+        totals = triage.retry_errors(error=OLD_ERROR, batch_size=2,
+                                     progress=lambda t: batches.append(
+                                         dict(t)))
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', count_updates)
+
+    assert len(updates) == 3
+    assert totals == {'retried': 6, 'resolved': 4, 'superseded': 1,
+                      'failed': 1}
+    assert [b['retried'] for b in batches] == [2, 4, 6]
+    assert db.session.query(md.PK001).count() == 3
+    assert statuses(db) == ['resolved'] * 4 + ['superseded', 'failed',
+                                               'new', 'new']
+
+    # the failure of the retry is the one left to triage
+    groups = triage.error_groups()
+    assert [(g['msg_source'], g['count']) for g in groups] == \
+        [('Iridium', 1), ('Spool', 1)]
+    assert groups[0]['error'] != OLD_ERROR
+
+    with pytest.raises(ValueError):
+        triage.retry_errors(msg_source='Spool')
+
+
+@patch('paikea.tasks.send_to_endpoints')
+def test_retry_errors_api(send_to_endpoints, flask_app, parsing_errors):
+    db = parsing_errors
+    with flask_app.test_client() as client:
+        resp = client.get("/v1/errors/groups")
+        assert resp.json[0]['count'] == 6
+
+        resp = client.post("/v1/errors/retry",
+                           json={'error': OLD_ERROR, 'limit': 3})
+        assert resp.json == {'retried': 3, 'resolved': 3, 'superseded': 0,
+                             'failed': 0}
+
+        resp = client.post("/v1/errors/retry", json={'msg_source': 'Spool'})
+        assert resp.status_code == 400
+    assert statuses(db)[:4] == ['resolved'] * 3 + ['new']
@@ -0,0 +1,69 @@
+from urllib.parse import urlencode
+import pytest
+from utils import ROCKBLOCK_INCOMING
+from paikea.utils import (
+    parse_push,
+    parse_batch_req,
+)
+from paikea.paikea_protocol import transmit_time_to_datetime
+
+
+def test_parse_push():
+    msg = ROCKBLOCK_INCOMING[0]
+    data = parse_push(urlencode(msg).encode('ascii'))
+
+    assert data['momsn'] == 441
+    # stored as sent
+    assert data['iridium_latitude'] == '37.7740'
+    assert data['iridium_longitude'] == '-122.4050'
+    assert data['iridium_cep'] == '2.0'
+    assert data['transmit_time'] == '20-03-15 22:12:51'
+    for key in ['imei', 'device_type', 'serial', 'iridium_session_status',
+                'data']:
+        assert data[key] == msg[key]
+
+    assert transmit_time_to_datetime(data['transmit_time']).hour == 22
+
+
+def test_parse_push_escapes():
+    body = b"imei=300434063836590&device_type=ROCK%2BBLOCK&serial=123456&" \
+        b"momsn=441&transmit_time=20-10-02%2021%3a07%3A37&" \
+        b"iridium_latitude=37.7740&iridium_longitude=-122.4050&" \
+        b"iridium_cep=2.0&iridium_session_status=0&data=50%254b"
+    data = parse_push(body)
+    assert data['device_type'] == 'ROCK+BLOCK'
+    assert data['transmit_time'] == '20-10-02 21:07:37'
+    assert data['data'] == '50%4b'
+
+
+def test_parse_push_keys():
+    msg = dict(ROCKBLOCK_INCOMING[0])
+    msg.pop('imei')
+    with pytest.raises(ValueError, match=r"Missing keys: \['imei'\]"):
+        parse_push(urlencode(msg).encode('ascii'))
+
+    msg = dict(ROCKBLOCK_INCOMING[0], extra='1')
+    with pytest.raises(ValueError, match=r"Extra keys: \['extra'\]"):
+        parse_push(urlencode(msg).encode('ascii'))
+
+    with pytest.raises(ValueError):
+        parse_push(b"imei&momsn=1")
+
+
+def test_parse_push_types():
+    msg = dict(ROCKBLOCK_INCOMING[0], momsn='four')
+    with pytest.raises(ValueError):
+        parse_push(urlencode(msg).encode('ascii'))
+
+    msg = dict(ROCKBLOCK_INCOMING[0], iridium_cep='near')
+    with pytest.raises(ValueError):
+        parse_push(urlencode(msg).encode('ascii'))
+
+
+def test_parse_batch_req_typed():
+    lines = [urlencode(msg).encode('ascii') for msg in ROCKBLOCK_INCOMING[:2]]
+    records, errors = parse_batch_req(b"\n".join(lines),
+                                      'application/x-www-form-urlencoded')
+    assert not errors
+    assert [r['momsn'] for r in records] == [441, 441]
+    assert records[0]['transmit_time'] == '20-03-15 22:12:51'
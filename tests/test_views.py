@@ -1,4 +1,12 @@
-from utils import ROCKBLOCK_INCOMING
+import os
+import json
+from urllib.parse import urlencode
+from unittest.mock import patch
+from sqlalchemy.exc import IntegrityError, OperationalError
+from utils import (
+    ROCKBLOCK_INCOMING,
+    ROCKBLOCK_BATCH,
+)
 from core_push_api_data import (gps_msg, ird_msg, ack_msg)
 from paikea.extensions import db
 import paikea.models as md
@@ -14,8 +22,143 @@ def test_rockblock_incoming(client):
     assert msg.status.status == 'new'
 
 
+def test_rockblock_incoming_commit_failed(flask_app, database):
+    body = urlencode(ROCKBLOCK_INCOMING[0])
+    headers = {'Content-Type': 'application/x-www-form-urlencoded'}
+    with flask_app.test_client() as client, \
+            patch('paikea.views.ingest_rockblock_message') as ingest:
+        ingest.side_effect = OperationalError("INSERT", {}, Exception())
+        result = client.post('/rockblock/incoming', data=body,
+                             headers=headers)
+        assert result.status_code == 500
+
+        # a duplicate is acknowledged
+        ingest.side_effect = IntegrityError("INSERT", {}, Exception())
+        result = client.post('/rockblock/incoming', data=body,
+                             headers=headers)
+        assert result.status_code == 200
+
+
 def test_rockstar_incoming(client):
     result = client.post('/rockstar/incoming', json=ird_msg)
     assert result.data == b'OK'
     msg = db.session.query(md.RockCorePushAPI).all()
     assert msg
+
+
+@patch('paikea.tasks.on_new_rbm_batch')
+def test_rockblock_incoming_batch(on_new_rbm_batch, flask_app, database):
+    db = database
+    form_lines = [urlencode(msg).encode('ascii') for msg in ROCKBLOCK_BATCH]
+    with flask_app.test_client() as client:
+        result = client.post('/rockblock/incoming/batch',
+                             data=b"\n".join(form_lines),
+                             content_type='application/x-www-form-urlencoded')
+    assert result.status_code == 200
+    assert result.json['received'] == len(ROCKBLOCK_BATCH)
+    assert result.json['stored'] == len(ROCKBLOCK_BATCH)
+
+    msgs = db.session.query(md.RockBlockMessage).all()
+    assert len(msgs) == len(ROCKBLOCK_BATCH)
+    for msg, sent in zip(msgs, ROCKBLOCK_BATCH):
+        assert msg.status.status == 'new'
+        # stored as sent, not as parsed numbers
+        assert (msg.iridium_latitude, msg.iridium_longitude) == \
+            (sent['iridium_latitude'], sent['iridium_longitude'])
+
+    rbm_ids = on_new_rbm_batch.delay.call_args[0][0]
+    assert rbm_ids == [msg.id for msg in msgs]
+
+    new_msgs = [dict(msg, momsn=str(1000 + x))
+                for x, msg in enumerate(ROCKBLOCK_BATCH[:2])]
+    ndjson = "\n".join(json.dumps(msg) for msg in new_msgs)
+    with flask_app.test_client() as client:
+        result = client.post('/rockblock/incoming/batch', data=ndjson,
+                             content_type='application/x-ndjson')
+    assert result.status_code == 200
+    assert result.json['stored'] == 2
+    assert len(db.session.query(md.RBMessageStatus).all()) == \
+        len(ROCKBLOCK_BATCH) + 2
+
+
+@patch('paikea.tasks.on_new_rbm_batch')
+def test_rockblock_incoming_batch_bad_line(on_new_rbm_batch, flask_app,
+                                           database):
+    db = database
+    bad_msg = dict(ROCKBLOCK_BATCH[0])
+    bad_msg.pop('imei')
+    ndjson = "\n".join([json.dumps(ROCKBLOCK_BATCH[0]), json.dumps(bad_msg)])
+    with flask_app.test_client() as client:
+        result = client.post('/rockblock/incoming/batch', data=ndjson,
+                             content_type='application/x-ndjson')
+    assert result.status_code == 400
+    assert result.json['errors'] == ["Line 2: Missing keys: ['imei']"]
+    assert not db.session.query(md.RockBlockMessage).all()
+    assert not on_new_rbm_batch.delay.called
+
+
+@patch('paikea.tasks.on_new_rbm_batch')
+@patch('paikea.tasks.on_new_rbm')
+def test_rockblock_incoming_duplicates(on_new_rbm, on_new_rbm_batch,
+                                       flask_app, database):
+    db = database
+    with flask_app.test_client() as client:
+        for x in range(3):
+            result = client.post('/rockblock/incoming',
+                                 data=ROCKBLOCK_BATCH[0])
+            assert result.data == b'OK'
+
+        lines = [urlencode(msg) for msg in ROCKBLOCK_BATCH[:2] * 2]
+        result = client.post('/rockblock/incoming/batch',
+                             data="\n".join(lines))
+        assert result.json['received'] == 4
+        assert result.json['stored'] == 1
+
+        result = client.get('/v1/ingest/duplicates')
+        assert result.json['duplicates'] == 5
+
+    assert len(db.session.query(md.RockBlockMessage).all()) == 2
+    assert on_new_rbm.delay.call_count == 1
+    assert on_new_rbm_batch.delay.call_count == 1
+
+
+def test_rockblock_messages_page(flask_app, database):
+    db = database
+    flask_app.template_folder = os.path.join(
+        os.path.dirname(__file__), os.pardir, 'templates')
+    for x in range(5):
+        imei = '300434063836590' if x % 2 else '300434063836591'
+        db.session.add(md.RockBlockMessage(imei=imei, momsn=x,
+                                           data=f"payload{x}"))
+    db.session.commit()
+    ids = [msg.id for msg in db.session.query(md.RockBlockMessage).
+           order_by(md.RockBlockMessage.id.desc())]
+
+    with flask_app.test_client() as client:
+        result = client.get('/rockblock/incoming?limit=2')
+        page = result.get_data(as_text=True)
+        assert result.status_code == 200
+        assert page.count('class="row message"') == 2
+        assert "payload4" in page and "payload3" in page
+        assert f"before={ids[1]}" in page
+
+        page = client.get(f'/rockblock/incoming?limit=2&before={ids[1]}').\
+            get_data(as_text=True)
+        assert "payload2" in page and "payload1" in page
+        assert "payload3" not in page
+
+        page = client.get('/rockblock/incoming?imei=300434063836590').\
+            get_data(as_text=True)
+        assert page.count('class="row message"') == 2
+        assert 'class="next"' not in page
+
+        page = client.get('/rockblock/incoming?until=2000-01-01T00:00:00').\
+            get_data(as_text=True)
+        assert page.count('class="row message"') == 0
+
+        result = client.get('/rockblock/incoming?since=yesterday')
+        assert result.status_code == 400
+
+        for limit in ['0', '-1']:
+            result = client.get(f'/rockblock/incoming?limit={limit}')
+            assert result.status_code == 400
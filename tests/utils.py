@@ -60,3 +60,8 @@ ROCKBLOCK_INCOMING = [
         'data': '6c61743a333734352e373938352c6c6f6e3a31323232332e343334342c7574633a3232313233362e303030',
     },
 ]
+
+
+# distinct pushes from the same modem
+ROCKBLOCK_BATCH = [dict(msg, momsn=str(441 + x))
+                   for x, msg in enumerate(ROCKBLOCK_INCOMING)]